@@ -0,0 +1,361 @@
+import logging
+import threading
+import time
+from collections import deque
+from functools import wraps
+from threading import Thread, Condition, Lock
+from typing import Callable, Dict, List, Optional
+
+import flight_recorder
+from metrics import QUEUE_DEPTH, QUEUE_WAIT, HANDLER_DURATION, counter
+
+log = logging.getLogger('pianobot')
+
+# Mailbox lanes, drained in this order: control calls (arming, disarming)
+# overtake anything already waiting in the lanes after them.
+CONTROL = 0
+NORMAL = 1
+BULK = 2
+LANES = 3
+
+# What a call does when its lane is full.
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+# An identical call (same method and arguments) already waiting absorbs the
+# new one; otherwise it blocks like BLOCK.
+COALESCE = "coalesce"
+
+DEFAULT_CAPACITY = 10000
+DEFAULT_BATCH_SIZE = 64
+# An actor whose handlers fail more than MAX_RESTARTS times within
+# RESTART_WINDOW seconds stops instead of carrying on.
+MAX_RESTARTS = 10
+RESTART_WINDOW = 60.0
+# A setup() that raised is tried again after this many seconds.
+SETUP_RETRY_DELAY = 1.0
+
+MESSAGES_DROPPED = counter("pianobot_actor_messages_dropped_total", "Actor calls dropped from a full mailbox lane.",
+                           ("actor", "method"))
+MESSAGES_COALESCED = counter("pianobot_actor_messages_coalesced_total",
+                             "Actor calls absorbed by an identical call already waiting.", ("actor", "method"))
+RESTARTS = counter("pianobot_actor_restarts_total", "Handler, setup and tick failures an actor carried on after.",
+                   ("actor",))
+TRACE_ACTOR_ERROR = flight_recorder.register("actor_error", "code=%d elapsed=%dus")
+
+
+class Mailbox(object):
+    """
+    Bounded FIFO lanes of pending calls, each a tuple of (function, args,
+    kwds, enqueued, coalescing key). get_batch() takes up to a batch of them
+    under one lock acquisition, lower lanes first.
+
+    After close(), calls are refused and get_batch() returns what is left,
+    then None.
+    """
+
+    def __init__(self, actor: str, capacity: int = DEFAULT_CAPACITY):
+        self.actor = actor
+        self.capacity = capacity
+        self._lanes = [deque() for _ in range(LANES)]
+        self._size = 0
+        self._unfinished = 0
+        self._waiting_keys = set()
+        self._closed = False
+        self._woken = False
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        self._all_done = Condition(self._lock)
+
+    def put(self, message: tuple, lane: int = NORMAL, overflow: str = BLOCK, block: bool = True) -> bool:
+        """
+        Queue `message`; returns False if it was refused or coalesced. With
+        block=False a full lane is allowed to grow instead, which is how an
+        actor calls itself without deadlocking.
+        """
+        key = message[4]
+        with self._lock:
+            if self._closed:
+                return False
+            if key is not None and key in self._waiting_keys:
+                MESSAGES_COALESCED.labels(self.actor, message[0].__name__).inc()
+                return False
+            queue = self._lanes[lane]
+            if len(queue) >= self.capacity:
+                if overflow == DROP_OLDEST:
+                    dropped = queue.popleft()
+                    self._forget(dropped)
+                    self._size -= 1
+                    self._unfinished -= 1
+                    MESSAGES_DROPPED.labels(self.actor, dropped[0].__name__).inc()
+                elif block:
+                    while len(queue) >= self.capacity and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+            queue.append(message)
+            if key is not None:
+                self._waiting_keys.add(key)
+            self._size += 1
+            self._unfinished += 1
+            self._not_empty.notify()
+            return True
+
+    def _forget(self, message: tuple) -> None:
+        if message[4] is not None:
+            self._waiting_keys.discard(message[4])
+
+    def get_batch(self, max_items: int, timeout: Optional[float] = None) -> Optional[List[tuple]]:
+        """Up to `max_items` calls; empty if `timeout` passed first, None once closed and drained."""
+        with self._lock:
+            if not self._size:
+                if self._closed:
+                    return None
+                if not self._woken:
+                    self._not_empty.wait(timeout)
+                self._woken = False
+                if not self._size:
+                    return None if self._closed else []
+            batch = []
+            for queue in self._lanes:
+                while queue and len(batch) < max_items:
+                    message = queue.popleft()
+                    self._forget(message)
+                    batch.append(message)
+            self._size -= len(batch)
+            self._not_full.notify_all()
+            return batch
+
+    def task_done(self, count: int = 1) -> None:
+        with self._lock:
+            self._unfinished -= count
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self) -> None:
+        """Wait until every queued call has been handled."""
+        with self._lock:
+            while self._unfinished > 0:
+                self._all_done.wait()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def wake(self) -> None:
+        """Make get_batch() return now, or as soon as it's next called, even with nothing queued."""
+        with self._lock:
+            self._woken = True
+            self._not_empty.notify()
+
+    def wait_closed(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for close(); returns whether it was closed."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_empty.wait(remaining)
+            return self._closed
+
+    def close(self, discard: bool = False) -> None:
+        with self._lock:
+            self._closed = True
+            if discard:
+                for queue in self._lanes:
+                    queue.clear()
+                self._waiting_keys.clear()
+                self._unfinished -= self._size
+                self._size = 0
+                self._all_done.notify_all()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+def queued(f: Optional[Callable] = None, lane: int = NORMAL, overflow: str = BLOCK):
+    """
+    Makes a method of an Actor asynchronous: calling it queues the call in
+    the actor's mailbox and returns None, and the actor thread runs it later.
+    Use as @queued or @queued(lane=CONTROL, overflow=COALESCE).
+    """
+
+    def decorate(f):
+        coalesce = overflow == COALESCE
+
+        @wraps(f)
+        def wrapper(self, *args, **kwds):
+            key = None
+            if coalesce:
+                key = (f, args, tuple(sorted(kwds.items()))) if kwds else (f, args)
+                try:
+                    hash(key)
+                except TypeError:
+                    key = None
+            self._mailbox.put((f, args, kwds, time.monotonic(), key), lane, overflow,
+                              threading.get_ident() != self.ident)
+
+        wrapper.underlying_method = f
+        return wrapper
+
+    return decorate(f) if f is not None else decorate
+
+
+class _Handler(object):
+    """Per-actor metrics and trace code for one @queued method, bound when the actor is created."""
+    __slots__ = ("name", "wait", "duration", "code")
+
+    def __init__(self, actor: str, name: str):
+        self.name = name
+        self.wait = QUEUE_WAIT.labels(actor, name)
+        self.duration = HANDLER_DURATION.labels(actor, name)
+        self.code = flight_recorder.register("%s.%s" % (actor, name), "wait=%dus duration=%dus")
+
+
+class Actor(Thread):
+    """
+    A thread that runs the calls made to its @queued methods, one at a time,
+    in the order they were made within each mailbox lane.
+
+    The thread takes calls off its mailbox in batches of up to `batch_size`.
+    tick() runs before each batch, and also whenever the mailbox has been
+    empty for wait_interval() seconds (`idle_interval` unless overridden) or
+    is woken with nothing in it. setup() runs on the thread
+    before the first call and teardown() after the last, once shutdown() has
+    closed the mailbox and everything queued before it has been handled.
+
+    A handler, setup() or tick() that raises is logged, traced and dumped
+    from the flight recorder, then restart() is called and the actor carries
+    on: with the next call, or for tick() with the batch it ran before. A
+    setup() that raised is tried again every SETUP_RETRY_DELAY seconds, and
+    calls wait in the mailbox until it succeeds. After more than MAX_RESTARTS
+    failures of any of them within RESTART_WINDOW seconds the actor gives up,
+    drops whatever is still queued, refuses further calls and stops.
+    """
+
+    _handlers: Dict[Callable, str] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Resolved once per class, so running a call never looks a method up by name.
+        cls._handlers = {}
+        for klass in reversed(cls.__mro__):
+            for attribute in vars(klass).values():
+                f = getattr(attribute, "underlying_method", None)
+                if f is not None:
+                    cls._handlers[f] = f.__name__
+
+    def __init__(self, actor: str, capacity: int = DEFAULT_CAPACITY, batch_size: int = DEFAULT_BATCH_SIZE,
+                 idle_interval: Optional[float] = None):
+        Thread.__init__(self, name=actor)
+        self._actor = actor
+        self._mailbox = Mailbox(actor, capacity)
+        self._batch_size = batch_size
+        self._idle_interval = idle_interval
+        self._dispatch = {f: _Handler(actor, name) for f, name in self._handlers.items()}
+        self._hook_codes = {name: flight_recorder.register("%s.%s" % (actor, name), "wait=%dus duration=%dus")
+                            for name in ("setup", "tick")}
+        self._failures: deque = deque()
+        QUEUE_DEPTH.labels(actor).set_function(self._mailbox.qsize)
+
+    def setup(self) -> None:
+        pass
+
+    def tick(self) -> None:
+        pass
+
+    def wait_interval(self) -> Optional[float]:
+        """How long to wait for calls before running tick() again; None to wait for a call or a wake."""
+        return self._idle_interval
+
+    def restart(self, error: Exception) -> None:
+        """Called on the actor thread after a handler, setup() or tick() raised `error`, before carrying on."""
+        pass
+
+    def teardown(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        self._mailbox.close()
+
+    def run(self) -> None:
+        mailbox = self._mailbox
+        while True:
+            carry_on = self._hook("setup", self.setup)
+            if carry_on is None:
+                break
+            if not carry_on:
+                self._give_up()
+                return
+            if mailbox.wait_closed(SETUP_RETRY_DELAY):
+                mailbox.close(discard=True)
+                return
+        while True:
+            batch = mailbox.get_batch(self._batch_size, self.wait_interval())
+            if batch is None:
+                break
+            if self._hook("tick", self.tick) is False:
+                mailbox.task_done(len(batch))
+                self._give_up()
+                break
+            if not batch:
+                continue
+            for i, message in enumerate(batch):
+                if not self._call(message):
+                    mailbox.task_done(len(batch) - i)
+                    self._give_up()
+                    break
+            else:
+                mailbox.task_done(len(batch))
+                continue
+            break
+        self.teardown()
+
+    def _give_up(self) -> None:
+        log.error("%s: more than %d failures in %.0fs, stopping", self._actor, MAX_RESTARTS, RESTART_WINDOW)
+        self._mailbox.close(discard=True)
+
+    def _hook(self, name: str, f: Callable[[], None]) -> Optional[bool]:
+        """Run setup() or tick(): None if it returned, otherwise whether the actor carries on."""
+        started = time.monotonic()
+        try:
+            f()
+        except Exception as e:
+            flight_recorder.record(TRACE_ACTOR_ERROR, self._hook_codes[name], int((time.monotonic() - started) * 1e6))
+            flight_recorder.TRACE.dump("%s-error" % self._actor.replace("/", "-"))
+            log.exception("%s: %s failed", self._actor, name)
+            return self._supervise(e)
+        return None
+
+    def _call(self, message: tuple) -> bool:
+        f, args, kwds, enqueued, _ = message
+        handler = self._dispatch[f]
+        started = time.monotonic()
+        handler.wait.observe(started - enqueued)
+        try:
+            f(self, *args, **kwds)
+        except Exception as e:
+            flight_recorder.record(TRACE_ACTOR_ERROR, handler.code, int((time.monotonic() - started) * 1e6))
+            flight_recorder.TRACE.dump("%s-error" % self._actor.replace("/", "-"))
+            log.exception("%s: %s failed", self._actor, handler.name)
+            return self._supervise(e)
+        finally:
+            elapsed = time.monotonic() - started
+            handler.duration.observe(elapsed)
+            flight_recorder.record(handler.code, int((started - enqueued) * 1e6), int(elapsed * 1e6))
+        return True
+
+    def _supervise(self, error: Exception) -> bool:
+        now = time.monotonic()
+        failures = self._failures
+        failures.append(now)
+        while failures[0] < now - RESTART_WINDOW:
+            failures.popleft()
+        if len(failures) > MAX_RESTARTS:
+            return False
+        RESTARTS.labels(self._actor).inc()
+        try:
+            self.restart(error)
+        except Exception:
+            log.exception("%s: restart failed", self._actor)
+            return False
+        return True
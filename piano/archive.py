@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Local index of recorded sessions.
+
+Recorder adds each session to an Archive when it stops, with the summary
+SessionStats made of it, so sessions can be found by length, date or key and
+takes of the same piece found by their melodic fingerprints without fetching
+anything from Drive. Sessions recorded before the archive existed are added
+with the backfill command, from whatever .stats.json, .events, .json or .mid
+files of theirs are at hand:
+
+    python archive.py backfill DIR... [--workers N]
+    python archive.py search [--min-minutes 10] [--key "C minor"] [--since 2024-01-01]
+    python archive.py similar piano-20240102193000
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from typing import Iterable, List, Optional, Tuple
+
+from session_stats import SessionStats
+
+DEFAULT_ARCHIVE_PATH = os.path.join(tempfile.gettempdir(), "pianobot-archive.sqlite")
+# similar() looks for sessions sharing the rarest PROBE_GRAMS grams of a
+# session's fingerprint, and compares the SIMILAR_CANDIDATES best of them.
+PROBE_GRAMS = 32
+SIMILAR_CANDIDATES = 100
+BACKFILL_BATCH_SIZE = 500
+# The sources a session can be summarized from by backfill, best first.
+BACKFILL_SOURCES = (".stats.json", ".events", ".json", ".mid")
+_SESSION_STAMP = re.compile(r"(\d{14})(?:-part\d+)?$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL UNIQUE,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    active REAL,
+    notes INTEGER NOT NULL,
+    notes_per_second REAL,
+    polyphony REAL,
+    lowest INTEGER,
+    highest INTEGER,
+    velocity REAL,
+    sustain REAL,
+    key TEXT,
+    public INTEGER,
+    source TEXT,
+    fingerprint_size INTEGER NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started);
+CREATE INDEX IF NOT EXISTS sessions_duration ON sessions (duration);
+CREATE INDEX IF NOT EXISTS sessions_key ON sessions (key, duration);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    gram INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (gram, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS fingerprints_id ON fingerprints (id);
+CREATE TABLE IF NOT EXISTS grams (
+    gram INTEGER PRIMARY KEY,
+    sessions INTEGER NOT NULL
+);
+"""
+
+log = logging.getLogger('pianobot')
+
+
+class Archive(object):
+    """
+    SQLite index of sessions: one row per session with the headline numbers of
+    its summary in indexed columns, and its fingerprint grams in a
+    (gram, session) table so the sessions sharing grams with one are found
+    through the primary key. How many sessions have each gram is kept
+    alongside, so similar() can start from the rare ones.
+
+    Safe to share between the recorders of several keyboards. Indexing is
+    best effort: a failure to write is logged rather than raised, as the
+    session itself is already published by then.
+    """
+
+    def __init__(self, path: str = DEFAULT_ARCHIVE_PATH):
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def add(self, session: str, started: float, summary: dict, public: Optional[bool] = None,
+            source: Optional[str] = None) -> None:
+        """Index a session from its SessionStats summary, replacing it if it's already there."""
+        try:
+            self.add_many([(session, started, summary, public, source)])
+        except sqlite3.Error:
+            log.exception("couldn't add %s to the archive", session)
+
+    def add_many(self, entries: Iterable[Tuple[str, float, dict, Optional[bool], Optional[str]]]) -> int:
+        """Index (session, started, summary, public, source) entries in one transaction."""
+        added = 0
+        with self._lock, self._db:
+            for session, started, summary, public, source in entries:
+                self._remove(session)
+                grams = summary.get("fingerprint") or []
+                pedals = summary.get("pedals", {}).get("sustain", {})
+                row = self._db.execute(
+                    "INSERT INTO sessions (session, started, duration, active, notes, notes_per_second, polyphony,"
+                    " lowest, highest, velocity, sustain, key, public, source, fingerprint_size, summary)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (session, started, summary["duration_seconds"], summary.get("active_seconds"), summary["notes"],
+                     summary["notes_per_second"]["mean"], summary["polyphony"]["mean"],
+                     summary["pitch"]["lowest"], summary["pitch"]["highest"], summary["velocity"]["mean"],
+                     pedals.get("down_fraction"), summary.get("key"), None if public is None else int(public),
+                     source, len(grams), json.dumps(summary, separators=(",", ":"))))
+                self._add_grams(row.lastrowid, grams)
+                added += 1
+        return added
+
+    def _add_grams(self, id: int, grams: List[int]) -> None:
+        db = self._db
+        db.executemany("INSERT OR IGNORE INTO fingerprints (gram, id) VALUES (?, ?)", ((gram, id) for gram in grams))
+        db.executemany("INSERT OR IGNORE INTO grams (gram, sessions) VALUES (?, 0)", ((gram,) for gram in grams))
+        db.executemany("UPDATE grams SET sessions = sessions + 1 WHERE gram = ?", ((gram,) for gram in grams))
+
+    def _remove(self, session: str) -> None:
+        db = self._db
+        row = db.execute("SELECT id FROM sessions WHERE session = ?", (session,)).fetchone()
+        if row is None:
+            return
+        db.execute("UPDATE grams SET sessions = sessions - 1"
+                   " WHERE gram IN (SELECT gram FROM fingerprints WHERE id = ?)", (row["id"],))
+        db.execute("DELETE FROM fingerprints WHERE id = ?", (row["id"],))
+        db.execute("DELETE FROM sessions WHERE id = ?", (row["id"],))
+
+    def __contains__(self, session: str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM sessions WHERE session = ?", (session,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM sessions").fetchone()[0]
+
+    def sessions(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT session FROM sessions")}
+
+    def get(self, session: str) -> Optional[dict]:
+        """The summary a session was indexed with, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT summary FROM sessions WHERE session = ?", (session,)).fetchone()
+        return json.loads(row["summary"]) if row is not None else None
+
+    def search(self, min_seconds: Optional[float] = None, max_seconds: Optional[float] = None,
+               key: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+               min_notes: Optional[int] = None, public: Optional[bool] = None, limit: int = 100) -> List[dict]:
+        """Sessions matching all the given conditions, most recent first, without their full summaries."""
+        conditions = []
+        parameters: list = []
+        for condition, value in (("duration >= ?", min_seconds), ("duration <= ?", max_seconds),
+                                 ("key = ?", key), ("started >= ?", since), ("started < ?", until),
+                                 ("notes >= ?", min_notes), ("public = ?", None if public is None else int(public))):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        query = ("SELECT session, started, duration, active, notes, notes_per_second, polyphony, lowest, highest,"
+                 " velocity, sustain, key, public, source FROM sessions")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY started DESC LIMIT ?"
+        parameters.append(limit)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, parameters)]
+
+    def similar(self, session: str, limit: int = 10, min_similarity: float = 0.05) -> List[Tuple[str, float]]:
+        """
+        Sessions whose fingerprints overlap that of `session`, most similar
+        first, with the Jaccard similarity of the two fingerprints.
+
+        Candidates are the sessions sharing the most of its PROBE_GRAMS rarest
+        grams, so the scale runs and repeated notes every session has don't
+        make the lookup touch the whole table; only the best SIMILAR_CANDIDATES
+        of them are compared gram for gram.
+        """
+        with self._lock:
+            db = self._db
+            row = db.execute("SELECT id, fingerprint_size FROM sessions WHERE session = ?", (session,)).fetchone()
+            if row is None:
+                raise KeyError(session)
+            id, size = row
+            probe = [gram for gram, in db.execute(
+                "SELECT f.gram FROM fingerprints f JOIN grams g ON g.gram = f.gram"
+                " WHERE f.id = ? ORDER BY g.sessions LIMIT ?", (id, PROBE_GRAMS))]
+            if not probe:
+                return []
+            candidates = [candidate for candidate, in db.execute(
+                "SELECT id FROM fingerprints WHERE gram IN (%s) AND id != ?"
+                " GROUP BY id ORDER BY count(*) DESC LIMIT ?" % ",".join("?" * len(probe)),
+                probe + [id, SIMILAR_CANDIDATES])]
+            if not candidates:
+                return []
+            scored = sorted(((shared / (size + other_size - shared), name) for name, other_size, shared in db.execute(
+                "SELECT s.session, s.fingerprint_size, count(*) FROM fingerprints mine"
+                " JOIN fingerprints theirs ON theirs.gram = mine.gram JOIN sessions s ON s.id = theirs.id"
+                " WHERE mine.id = ? AND theirs.id IN (%s) GROUP BY theirs.id" % ",".join("?" * len(candidates)),
+                [id] + candidates)), reverse=True)
+        return [(name, round(similarity, 3)) for similarity, name in scored[:limit] if similarity >= min_similarity]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def session_started(session: str) -> Optional[float]:
+    """Wall-clock seconds a session started, from the timestamp in its name."""
+    match = _SESSION_STAMP.search(session)
+    if match is None:
+        return None
+    return time.mktime(time.strptime(match.group(1), '%Y%m%d%H%M%S'))
+
+
+def summarize_file(path: str) -> Tuple[str, Optional[float], Optional[dict]]:
+    """(session, started, summary) of a session file; the summary is None for a session without notes."""
+    name = os.path.basename(path)
+    suffix = next(suffix for suffix in BACKFILL_SOURCES if name.endswith(suffix))
+    session = name[:-len(suffix)]
+    started = session_started(session)
+    if suffix == ".stats.json":
+        with open(path, "rb") as f:
+            return session, started, json.loads(f.read().decode())
+    if suffix == ".mid":
+        return session, started, _replay(_midi_events(path))
+    if suffix == ".events":
+        from raw_event_log import RawEventLog
+        with open(path, "rb") as f:
+            events = [(event.t, event.message) for event in RawEventLog.read_from(f)]
+    else:
+        with open(path, "rb") as f:
+            events = [(event[0], event[2]) for event in json.loads(f.read().decode())]
+    if events and started is None:
+        started = events[0][0]
+    return session, started, _replay(events)
+
+
+def _midi_events(path: str):
+    from mido import MidiFile
+    t = 0.0
+    for message in MidiFile(path):
+        t += message.time
+        if not message.is_meta:
+            yield t, message.bytes()
+
+
+def _replay(events) -> Optional[dict]:
+    """Run (seconds, message) events through SessionStats the way Recorder does."""
+    stats = None
+    t = None
+    for seconds, message in events:
+        t = int(seconds * 1e9)
+        if stats is None:
+            stats = SessionStats(t)
+        status = message[0] & 0xF0
+        if status == 0x90 and message[2]:
+            stats.note_on(t, message[1], message[2])
+        elif status in (0x80, 0x90):
+            stats.note_off(t, message[1])
+        elif status == 0xB0:
+            stats.control_change(t, message[1], message[2])
+    if stats is None or not stats.notes:
+        return None
+    return stats.summary(t)
+
+
+def backfill_sources(directories: Iterable[str]) -> List[str]:
+    """
+    The best file to summarize each session in the directories from. The
+    parts of a segmented session are indexed as sessions of their own unless
+    the session has a .stats.json sidecar.
+    """
+    best = {}
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(".manifest.json"):
+                    continue
+                for rank, suffix in enumerate(BACKFILL_SOURCES):
+                    if name.endswith(suffix):
+                        session = name[:-len(suffix)]
+                        if session not in best or rank < best[session][0]:
+                            best[session] = (rank, os.path.join(root, name))
+                        break
+    summarized = {session for session, (rank, _) in best.items() if rank == 0}
+    return sorted(path for session, (_, path) in best.items()
+                  if session.rpartition("-part")[0] not in summarized)
+
+
+def backfill(archive: Archive, directories: Iterable[str], workers: Optional[int] = None,
+             force: bool = False) -> int:
+    """Summarize the sessions found in the directories on a pool of processes and index them."""
+    indexed = set() if force else archive.sessions()
+    paths = [path for path in backfill_sources(directories)
+             if force or os.path.basename(path).split(".", 1)[0] not in indexed]
+    added = 0
+    started = time.monotonic()
+    batch = []
+    with ProcessPoolExecutor(workers) as executor:
+        for path, (session, session_started, summary) in zip(
+                paths, executor.map(summarize_file, paths, chunksize=16)):
+            if summary is None or session_started is None:
+                log.info("skipping %s: no notes or no start time", path)
+                continue
+            batch.append((session, session_started, summary, None, os.path.basename(path)))
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                added += archive.add_many(batch)
+                batch = []
+                log.info("indexed %d of %d sessions, %.0f/s", added, len(paths), added / (time.monotonic() - started))
+    added += archive.add_many(batch)
+    return added
+
+
+def _date(text: str) -> float:
+    return time.mktime(time.strptime(text, '%Y-%m-%d'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archive", default=os.environ.get("ARCHIVE_PATH", DEFAULT_ARCHIVE_PATH))
+    commands = parser.add_subparsers(dest="command")
+    backfill_parser = commands.add_parser("backfill", help="index the session files in directories")
+    backfill_parser.add_argument("directories", nargs="+")
+    backfill_parser.add_argument("--workers", type=int, default=None, help="processes, one per CPU by default")
+    backfill_parser.add_argument("--force", action="store_true", help="re-index sessions already in the archive")
+    search_parser = commands.add_parser("search", help="list sessions")
+    search_parser.add_argument("--min-minutes", type=float)
+    search_parser.add_argument("--max-minutes", type=float)
+    search_parser.add_argument("--key", help='e.g. "C minor"')
+    search_parser.add_argument("--since", type=_date, help="YYYY-MM-DD")
+    search_parser.add_argument("--until", type=_date, help="YYYY-MM-DD")
+    search_parser.add_argument("--min-notes", type=int)
+    search_parser.add_argument("--limit", type=int, default=100)
+    similar_parser = commands.add_parser("similar", help="list the sessions most like one")
+    similar_parser.add_argument("session")
+    similar_parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    archive = Archive(args.archive)
+    if args.command == "backfill":
+        started = time.monotonic()
+        added = backfill(archive, args.directories, args.workers, args.force)
+        print("indexed %d sessions in %.1fs, %d in the archive" % (added, time.monotonic() - started, len(archive)))
+    elif args.command == "search":
+        for row in archive.search(
+                min_seconds=args.min_minutes * 60 if args.min_minutes is not None else None,
+                max_seconds=args.max_minutes * 60 if args.max_minutes is not None else None,
+                key=args.key, since=args.since, until=args.until, min_notes=args.min_notes, limit=args.limit):
+            print("%-32s %s %6.1f min %6d notes  %s" % (
+                row["session"], time.strftime("%Y-%m-%d %H:%M", time.localtime(row["started"])),
+                row["duration"] / 60, row["notes"], row["key"] or ""))
+    elif args.command == "similar":
+        try:
+            for session, similarity in archive.similar(args.session, args.limit):
+                print("%-32s %.3f" % (session, similarity))
+        except KeyError:
+            sys.exit("%s isn't in the archive" % args.session)
+    else:
+        parser.print_help()
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
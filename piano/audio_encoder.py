@@ -0,0 +1,72 @@
+from tempfile import SpooledTemporaryFile
+from typing import List, Optional
+
+from synth import SAMPLE_RATE, CHANNELS
+
+# Encoded output is kept in memory up to this size, then spills to disk.
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+AUDIO_FORMATS = {
+    # name: (extension, mime type, libsndfile format, libsndfile subtype)
+    "flac": ("flac", "audio/flac", "FLAC", "PCM_16"),
+    "ogg": ("ogg", "audio/ogg", "OGG", "VORBIS"),
+}
+
+
+class EncodedAudio(object):
+    """One encoded output of a render, spooled to memory or disk."""
+
+    def __init__(self, format_name: str, fileobj, sample_rate: int):
+        extension, mime, sf_format, sf_subtype = AUDIO_FORMATS[format_name]
+        self.format = format_name
+        self.extension = extension
+        self.mime = mime
+        self.fileobj = fileobj
+        # soundfile pulls in numpy; importing it here keeps both off the startup path.
+        import soundfile  # type: ignore
+        self._sound_file = soundfile.SoundFile(self.fileobj, mode="w", samplerate=sample_rate, channels=CHANNELS,
+                                               format=sf_format, subtype=sf_subtype)
+
+    @property
+    def size(self) -> int:
+        position = self.fileobj.tell()
+        self.fileobj.seek(0, 2)
+        size = self.fileobj.tell()
+        self.fileobj.seek(position)
+        return size
+
+    def write(self, pcm) -> None:
+        self._sound_file.buffer_write(pcm, dtype="int16")
+
+    def close(self) -> None:
+        self._sound_file.close()
+        self.fileobj.seek(0)
+
+
+class EncoderSink(object):
+    """
+    Render sink that encodes PCM into compressed files block by block.
+
+    Every block from the synth goes straight to each encoder, so the full PCM
+    stream is never held anywhere. Outputs go to files from `open_file(extension)`
+    (opened for reading and writing) or, by default, to spooled temporary files.
+    close() returns the EncodedAudio outputs, rewound and ready to be read.
+    """
+
+    def __init__(self, formats: List[str], spool_dir: Optional[str] = None, sample_rate: int = SAMPLE_RATE,
+                 open_file=None):
+        if open_file is None:
+            def open_file(extension):
+                return SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, dir=spool_dir)
+        self.pcm_bytes = 0
+        self._outputs = [EncodedAudio(name, open_file(AUDIO_FORMATS[name][0]), sample_rate) for name in formats]
+
+    def write(self, pcm) -> None:
+        self.pcm_bytes += len(pcm)
+        for output in self._outputs:
+            output.write(pcm)
+
+    def close(self) -> List[EncodedAudio]:
+        for output in self._outputs:
+            output.close()
+        return self._outputs
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Throughput of actor calls, and how long a control call waits behind bulk ones.
+
+Producer threads make no-op @queued calls as fast as they can while the actor
+runs them. The Actor runtime is compared with the loop that Publisher and
+Recorder used before it: an unbounded Queue, one get() per call, a new list
+per call and a getattr by method name, with the same metrics and tracing.
+
+Then a backlog of bulk calls is queued, followed by one control call, and the
+time until the control call runs is reported for both.
+
+    python benchmarks/bench_actor.py [--calls 200000] [--backlog 20000]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from functools import wraps
+from queue import Queue
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import flight_recorder  # noqa: E402
+from actor import Actor, queued, BULK, CONTROL  # noqa: E402
+from metrics import QUEUE_WAIT, HANDLER_DURATION  # noqa: E402
+
+
+def legacy_queued(f):
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        self = args[0]
+        self._queue.put([f.__name__, list(args[1:]), kwds, time.monotonic()])
+        return
+
+    wrapper.underlying_method = f
+    return wrapper
+
+
+class LegacyActor(Thread):
+    """The previous Queue-per-actor loop, with what call_queued did per call."""
+
+    def __init__(self):
+        Thread.__init__(self, daemon=True)
+        self._queue = Queue()
+        self.handled = 0
+        self.control_ran = None
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            name, args, kwds, enqueued = item
+            code = flight_recorder.register("legacy.%s" % name, "wait=%dus duration=%dus")
+            started = time.monotonic()
+            QUEUE_WAIT.labels("legacy", name).observe(started - enqueued)
+            try:
+                getattr(self, name).underlying_method(self, *args, **kwds)
+            finally:
+                elapsed = time.monotonic() - started
+                HANDLER_DURATION.labels("legacy", name).observe(elapsed)
+                flight_recorder.record(code, int((started - enqueued) * 1e6), int(elapsed * 1e6))
+            self._queue.task_done()
+
+    def shutdown(self):
+        self._queue.put(None)
+
+    def join_queue(self):
+        self._queue.join()
+
+    @legacy_queued
+    def bulk(self, i):
+        self.handled += 1
+
+    @legacy_queued
+    def control(self):
+        self.control_ran = time.perf_counter()
+
+
+class BenchActor(Actor):
+    def __init__(self, batch_size):
+        Actor.__init__(self, "bench/%d" % batch_size, capacity=1 << 20, batch_size=batch_size)
+        self.daemon = True
+        self.handled = 0
+        self.control_ran = None
+
+    def join_queue(self):
+        self._mailbox.join()
+
+    @queued(lane=BULK)
+    def bulk(self, i):
+        self.handled += 1
+
+    @queued(lane=CONTROL)
+    def control(self):
+        self.control_ran = time.perf_counter()
+
+
+def throughput(actor, calls, producers):
+    per_producer = calls // producers
+
+    def produce():
+        bulk = actor.bulk
+        for i in range(per_producer):
+            bulk(i)
+
+    threads = [threading.Thread(target=produce) for _ in range(producers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    actor.join_queue()
+    return per_producer * producers / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--backlog", type=int, default=20000)
+    args = parser.parse_args()
+
+    for label, make in (("legacy Queue loop", LegacyActor),
+                        ("Actor, batch 1", lambda: BenchActor(1)),
+                        ("Actor, batch 64", lambda: BenchActor(64))):
+        for producers in (1, 4):
+            actor = make()
+            actor.start()
+            rate = throughput(actor, args.calls, producers)
+            actor.shutdown()
+            actor.join()
+            print("%-18s %d producer(s): %9.0f calls/s" % (label, producers, rate))
+
+    for label, make in (("legacy Queue loop", LegacyActor), ("Actor, batch 64", lambda: BenchActor(64))):
+        actor = make()
+        # Queue the backlog before the actor starts, so it is all waiting when the control call arrives.
+        for i in range(args.backlog):
+            actor.bulk(i)
+        actor.control()
+        started = time.perf_counter()
+        actor.start()
+        actor.join_queue()
+        print("%-18s control call behind %d bulk calls ran after %.1f ms" % (
+            label, args.backlog, 1000 * (actor.control_ran - started)))
+        actor.shutdown()
+        actor.join()
+
+
+if __name__ == '__main__':
+    main()
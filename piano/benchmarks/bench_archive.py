@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Query latency of the session archive, and backfill throughput.
+
+Indexes --sessions synthetic sessions, each a take of one of --pieces random
+melodies played with a few wrong notes and skipped passages, or noodling
+around a scale. Then times range queries and similar() lookups, and reports
+how many of the sessions similar() ranks highest are takes of the same piece.
+
+Then writes --files short sessions as .events files and backfills an empty
+archive from them with 1 worker and with one per CPU.
+
+    python benchmarks/bench_archive.py [--sessions 20000] [--pieces 300] [--files 200]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from archive import Archive, backfill  # noqa: E402
+from bench_pipeline import percentile, session_stream  # noqa: E402
+from raw_event_log import RawEventLog  # noqa: E402
+from session_stats import MelodyFingerprint  # noqa: E402
+
+KEYS = ["%s %s" % (tonic, mode) for mode in ("major", "minor")
+        for tonic in ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")]
+SCALE = (0, 2, 4, 5, 7, 9, 11)
+DAY = 24 * 60 * 60
+
+
+def melody(rng, length):
+    note = 60
+    notes = []
+    for _ in range(length):
+        note = max(40, min(84, note + rng.choice((-7, -5, -4, -3, -2, -1, 1, 2, 3, 4, 5, 7, 0, 12, -12))))
+        notes.append(note)
+    return notes
+
+
+def take(rng, notes):
+    """A performance of `notes`: some wrong notes, some passages skipped, a different tempo."""
+    played = []
+    i = 0
+    while i < len(notes):
+        if rng.random() < 0.01:
+            i += rng.randrange(4, 30)
+            continue
+        played.append(notes[i] + (rng.choice((-1, 1)) if rng.random() < 0.03 else 0))
+        i += 1
+    return played
+
+
+def noodle(rng, length):
+    tonic = rng.randrange(48, 60)
+    degree = 0
+    notes = []
+    for _ in range(length):
+        degree = max(0, min(20, degree + rng.choice((-2, -1, -1, 1, 1, 2))))
+        notes.append(tonic + 12 * (degree // 7) + SCALE[degree % 7])
+    return notes
+
+
+def synthetic_summary(rng, notes):
+    fingerprint = MelodyFingerprint()
+    t = 0
+    for note in notes:
+        fingerprint.onset(t, note)
+        t += rng.randrange(100, 400) * 1000000
+    duration = t / 1e9
+    return {
+        "duration_seconds": duration, "active_seconds": duration * 0.9, "notes": len(notes),
+        "notes_per_second": {"mean": len(notes) / duration, "peak": 10},
+        "polyphony": {"mean": 2.0, "max": 6},
+        "pitch": {"lowest": min(notes), "highest": max(notes)},
+        "velocity": {"mean": 70.0},
+        "pedals": {"sustain": {"down_fraction": 0.5}},
+        "key": rng.choice(KEYS),
+        "fingerprint": fingerprint.grams(),
+    }
+
+
+def timed(f, repeat):
+    latencies = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = f()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return result, 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20000)
+    parser.add_argument("--pieces", type=int, default=300)
+    parser.add_argument("--files", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    directory = tempfile.mkdtemp(prefix="bench-archive-")
+    try:
+        archive = Archive(os.path.join(directory, "archive.sqlite"))
+        pieces = [melody(rng, rng.randrange(200, 1500)) for _ in range(args.pieces)]
+        played = {}
+        elapsed = 0.0
+        now = time.time()
+        batch = []
+        for i in range(args.sessions):
+            session = "piano-%s" % time.strftime('%Y%m%d%H%M%S', time.localtime(now - (args.sessions - i) * 3600))
+            if rng.random() < 0.6:
+                piece = rng.randrange(args.pieces)
+                played[session] = piece
+                notes = take(rng, pieces[piece])
+            else:
+                notes = noodle(rng, rng.randrange(100, 5000))
+            batch.append((session, now - (args.sessions - i) * 3600, synthetic_summary(rng, notes), False, None))
+            if len(batch) == 500 or i == args.sessions - 1:
+                started = time.perf_counter()
+                archive.add_many(batch)
+                elapsed += time.perf_counter() - started
+                batch = []
+        print("indexed %d sessions in %.1fs (%.0f/s, fingerprints included), %.1f MB" % (
+            args.sessions, elapsed, args.sessions / elapsed, os.path.getsize(archive.path) / 1e6))
+
+        for label, query in (
+                ("longer than 10 min in C minor", lambda: archive.search(min_seconds=600, key="C minor")),
+                ("last week", lambda: archive.search(since=now - 7 * DAY)),
+                ("5-10 min, last 90 days", lambda: archive.search(min_seconds=300, max_seconds=600,
+                                                                   since=now - 90 * DAY))):
+            rows, p50, p99 = timed(query, 50)
+            print("search %-32s %4d rows  p50 %6.2f ms  p99 %6.2f ms" % (label, len(rows), p50, p99))
+
+        sessions = rng.sample(sorted(played), 200)
+        latencies = []
+        hits = found = 0
+        for session in sessions:
+            started = time.perf_counter()
+            similar = archive.similar(session, limit=5)
+            latencies.append(time.perf_counter() - started)
+            found += len(similar)
+            hits += sum(1 for other, _ in similar if played.get(other) == played[session])
+        latencies.sort()
+        print("similar()  p50 %6.2f ms  p99 %6.2f ms, %.0f%% of %d results were takes of the same piece" % (
+            1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99), 100 * hits / max(found, 1), found))
+        archive.close()
+
+        files = os.path.join(directory, "files")
+        os.mkdir(files)
+        for i in range(args.files):
+            log = RawEventLog()
+            start = now - i * 3600
+            for t, message in session_stream(rng.randrange(60, 600)):
+                log.append(start + t, 0.0, message)
+            name = "piano-%s.events" % time.strftime('%Y%m%d%H%M%S', time.localtime(start))
+            with open(os.path.join(files, name), "wb") as f:
+                log.write_to(f)
+        for workers in sorted({1, os.cpu_count() or 1}):
+            archive = Archive(os.path.join(directory, "backfill-%d.sqlite" % workers))
+            started = time.perf_counter()
+            added = backfill(archive, [files], workers=workers)
+            elapsed = time.perf_counter() - started
+            print("backfill %d .events files, %d worker(s): %.1fs, %.0f sessions/s" % (
+                added, workers, elapsed, added / elapsed))
+            archive.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Cost of tracing a MIDI message in the flight recorder.
+
+Times FlightRecorder.record() for a stream of note messages against the
+log.debug call it replaced in Keyboard.__call__, both with DEBUG off and
+with DEBUG on and a handler writing to an in-memory stream (a lower bound
+for a console), then checks that a dump decodes back to the same records.
+
+    python benchmarks/bench_flight_recorder.py [--events 200000]
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from flight_recorder import FlightRecorder, read_trace  # noqa: E402
+
+
+def messages(count):
+    for i in range(count):
+        yield [0x90 if i % 2 == 0 else 0x80, 36 + i % 60, 64 + i % 32]
+
+
+def time_per_message(fn, stream):
+    started = time.perf_counter()
+    for message in stream:
+        fn(message)
+    return 1e6 * (time.perf_counter() - started) / len(stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    args = parser.parse_args()
+    stream = list(messages(args.events))
+
+    recorder = FlightRecorder()
+    code = recorder.register("midi_in", "status=0x%02x data=0x%04x")
+    record = recorder.record
+
+    def trace(message):
+        record(code, message[0], message[1] << 8 | message[2])
+
+    log = logging.getLogger("bench_flight_recorder")
+    log.propagate = False
+
+    def debug(message):
+        log.debug("rtmidi message received: @%s: %s, delta=%f, data=%s", 0.0, message, 0.0005, None)
+
+    print("flight recorder:   %.3f us/message" % time_per_message(trace, stream))
+    log.setLevel(logging.INFO)
+    print("log.debug (off):   %.3f us/message" % time_per_message(debug, stream))
+    log.setLevel(logging.DEBUG)
+    log.addHandler(logging.StreamHandler(io.StringIO()))
+    print("log.debug (on):    %.3f us/message" % time_per_message(debug, stream))
+
+    out = io.BytesIO()
+    started = time.perf_counter()
+    count = recorder.write_to(out)
+    elapsed = time.perf_counter() - started
+    print("dump: %d records, %d bytes in %.1f ms" % (count, len(out.getvalue()), elapsed * 1000))
+
+    out.seek(0)
+    _, records = read_trace(out)
+    expected = [(m[0], m[1] << 8 | m[2]) for m in stream[-count:]]
+    same = [(a, b) for _, _, _, a, b in records] == expected
+    print("round trip: %s" % ("identical" if same else "MISMATCH"))
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Per-note cost of hotkey matching.
+
+Replays note-on/note-off pairs through HotkeyMatcher with a growing number of
+registered chord and sequence gestures, and through the previous list scan
+over every command's combo, which had to check every note of every command
+on each press of a hotkey note.
+
+    python benchmarks/bench_hotkeys.py [--events 200000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from hotkeys import HotkeyMatcher  # noqa: E402
+
+
+class LegacyHotkeys(object):
+    """The list-scanning check_hotkeys that Keyboard used before HotkeyMatcher."""
+
+    def __init__(self, commands):
+        self._commands = commands
+        self._special_keys = sum([command["combo"] for command in commands], [])
+        self._active = [False] * 128
+
+    def note_on(self, note, t):
+        self._active[note] = True
+        if note in self._special_keys:
+            for command in self._commands:
+                if all(self._active[x] for x in command["combo"]):
+                    command["fn"]()
+                    break
+
+    def note_off(self, note):
+        self._active[note] = False
+
+
+def commands(count):
+    # Three-note chords and sequences spread over the top two octaves, where
+    # the real hotkeys live, so played notes regularly hit candidates.
+    result = []
+    for i in range(count):
+        notes = [84 + i % 20, 86 + (i * 3) % 20, 88 + (i * 7) % 20]
+        if i % 2:
+            result.append({"sequence": notes, "window": 1.0, "fn": lambda: None})
+        else:
+            result.append({"combo": notes, "fn": lambda: None})
+    return result
+
+
+def notes_stream(n):
+    for i in range(n // 2):
+        yield 60 + (i * 5) % 48
+
+
+def run(matcher, notes):
+    started = time.perf_counter()
+    t = 0
+    for note in notes:
+        t += 50000000
+        matcher.note_on(note, t)
+        matcher.note_off(note)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    args = parser.parse_args()
+    notes = list(notes_stream(args.events))
+
+    for count in (2, 10, 50):
+        registered = commands(count)
+        chords = [command for command in registered if "combo" in command]
+        for label, matcher in (("HotkeyMatcher", HotkeyMatcher(registered)), ("list scan", LegacyHotkeys(chords))):
+            elapsed = run(matcher, notes)
+            print("%2d gestures %-14s %.3f us/note" % (count, label, 1e6 * elapsed / len(notes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the rtmidi callback ingestion path.
+
+Times Keyboard.__call__ writing into the Recorder's EventRing while a consumer
+thread drains it, for dense note traffic and for a sustain-pedal CC flood, and
+compares it with the previous two-Queue.put-per-message path. Messages are
+replayed as fast as possible, far above any real keyboard's rate, so the
+ring's drop counter also shows how overflow is handled.
+
+    python benchmarks/bench_ingest.py [--events 200000]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from event_ring import EventRing  # noqa: E402
+from fakes import FakeMidiIn  # noqa: E402
+from keyboard import Keyboard  # noqa: E402
+
+
+class RingOnlyRecorder(object):
+    def __init__(self):
+        self.events = EventRing()
+
+
+class LegacyQueueRecorder(object):
+    """Reproduces the cost of the previous `queued` record_raw_event/record_event calls."""
+
+    def __init__(self):
+        self._queue = Queue()
+        self.events = self
+
+    def push(self, t, message, deltatime):
+        self._queue.put(["record_raw_event", [t, message, deltatime, None], {}])
+        self._queue.put(["record_event", ["note_on", message[1], message[2], t, deltatime], {}])
+        return True
+
+
+def notes_stream(n):
+    for i in range(n // 2):
+        yield [0x90, 36 + i % 60, 64 + i % 60]
+        yield [0x80, 36 + i % 60, 0]
+
+
+def pedal_stream(n):
+    for i in range(n):
+        yield [0xB0, 64, i % 128]
+
+
+def consume(recorder, stop):
+    while not stop.is_set():
+        if isinstance(recorder, LegacyQueueRecorder):
+            while not recorder._queue.empty():
+                recorder._queue.get()
+        else:
+            recorder.events.drain()
+        time.sleep(0.01)
+
+
+def run(recorder, messages):
+    midi_in = FakeMidiIn()
+    keyboard = Keyboard(midi_in, [], recorder)
+    callback = midi_in.callback
+    stop = threading.Event()
+    consumer = threading.Thread(target=consume, args=(recorder, stop))
+    consumer.start()
+    started = time.perf_counter()
+    for message in messages:
+        callback((message, 0.0005))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    consumer.join()
+    keyboard.shutdown()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    args = parser.parse_args()
+
+    for stream_name, stream in (("notes", notes_stream), ("pedal flood", pedal_stream)):
+        for label, factory in (("event ring", RingOnlyRecorder), ("queue.put x2", LegacyQueueRecorder)):
+            messages = list(stream(args.events))
+            recorder = factory()
+            elapsed = run(recorder, messages)
+            dropped = recorder.events.dropped if isinstance(recorder.events, EventRing) else 0
+            print("%-12s %-13s %.3f us/callback, %d dropped" % (
+                stream_name, label, 1e6 * elapsed / len(messages), dropped))
+
+
+if __name__ == '__main__':
+    main()
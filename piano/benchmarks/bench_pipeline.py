@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Replay-driven load test of the whole recording and publishing pipeline.
+
+Plays a MIDI event stream into Keyboard through a fake rtmidi port. The stream
+is synthetic, or read from a recorded .mid or .events file. Events go through
+the real Recorder, MusicalFeedback and Publisher; Slack and Drive are local
+fake servers and rendering is stubbed. At the end the session is stopped and
+the harness waits for the outbox to drain.
+
+It reports callback latency percentiles, ingest ring and recorder queue depth
+over time, the sustained event rate, stop-to-published latency and peak RSS.
+With --output the report is also written as JSON (with the git commit),
+so runs on different commits can be compared.
+
+    python benchmarks/bench_pipeline.py --stream chords --seconds 60 --speed 0
+    python benchmarks/bench_pipeline.py --stream session --seconds 7200 --speed 100 --output session.json
+    python benchmarks/bench_pipeline.py --stream piano-20190119.events --speed 1
+
+Streams: chords (dense ten-note chords), pedal (sustain pedal CC storm),
+session (notes, chords and pedalling, like a practice session), or a path.
+--speed is a multiple of real time; 0 plays as fast as possible.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from archive import Archive  # noqa: E402
+from clock import monotonic_ns  # noqa: E402
+from fakes import FakeBackendServer, FakeMidiIn, FakeMidiOut, StubRenderService  # noqa: E402
+from keyboard import Keyboard  # noqa: E402
+from musical_feedback import MusicalFeedback  # noqa: E402
+from publisher import Publisher  # noqa: E402
+from raw_event_log import RawEventLog  # noqa: E402
+from recorder import Recorder  # noqa: E402
+
+SAMPLE_INTERVAL = 0.05
+
+
+class ReplayClock(object):
+    """Stamps events with their time in the stream, so sped-up replays keep their original timing."""
+
+    def __init__(self):
+        self.base = monotonic_ns()
+        self.t = 0.0
+
+    def __call__(self):
+        return self.base + int(self.t * 1e9)
+
+
+def chords_stream(seconds):
+    # Ten-note chords struck 8 times a second.
+    t = 0.0
+    while t < seconds:
+        root = 36 + int(t * 8) % 36
+        for i in range(10):
+            yield t, [0x90, root + 2 * i, 90]
+        t += 0.1
+        for i in range(10):
+            yield t, [0x80, root + 2 * i, 0]
+        t += 0.025
+
+
+def pedal_stream(seconds):
+    # Half-pedalling sends a continuous stream of sustain CC values.
+    t = 0.0
+    i = 0
+    while t < seconds:
+        yield t, [0xb0, 64, abs(127 - (i * 3) % 254)]
+        t += 0.002
+        i += 1
+
+
+def session_stream(seconds):
+    # A melody over pedalled chords, with a short pause every minute.
+    t = 0.0
+    i = 0
+    while t < seconds:
+        if i % 16 == 0:
+            yield t, [0xb0, 64, 127]
+            for note in (36, 43, 52):
+                yield t, [0x90, note, 70]
+        note = 60 + (i * 5) % 24
+        yield t, [0x90, note, 60 + i % 40]
+        t += 0.12
+        yield t, [0x80, note, 0]
+        if i % 16 == 15:
+            for note in (36, 43, 52):
+                yield t, [0x80, note, 0]
+            yield t, [0xb0, 64, 0]
+        t += 0.03
+        i += 1
+        if i % 400 == 0:
+            t += 4.0
+
+
+def file_stream(path):
+    if path.endswith(".events"):
+        with open(path, "rb") as f:
+            log = RawEventLog.read_from(f)
+        start = log.times[0] if len(log) else 0.0
+        for event in log:
+            yield event.t - start, event.message
+    else:
+        import mido  # type: ignore
+        t = 0.0
+        for message in mido.MidiFile(path):
+            t += message.time
+            if not message.is_meta:
+                yield t, message.bytes()
+
+
+STREAMS = {"chords": chords_stream, "pedal": pedal_stream, "session": session_stream}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stream", default="session", help="chords, pedal, session or a .mid/.events path")
+    parser.add_argument("--seconds", type=float, default=120, help="length of a synthetic stream")
+    parser.add_argument("--speed", type=float, default=0, help="multiple of real time, 0 for flat out")
+    parser.add_argument("--segment-seconds", type=float, default=None)
+    parser.add_argument("--slack-latency", type=float, default=0.2)
+    parser.add_argument("--drive-latency", type=float, default=0.5)
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pianobot-bench-")
+    slack = FakeBackendServer(args.slack_latency).start()
+    drive = FakeBackendServer(args.drive_latency).start()
+    publisher = Publisher(soundfont_path="", slack_api_token="token", slack_channel_public="public",
+                          slack_channel_private="private", google_credentials_json=None, google_folder_id="folder",
+                          slack_api_url=slack.url, google_api_url=drive.url, render_service=StubRenderService(),
+                          outbox_path=os.path.join(workdir, "outbox"))
+    publisher.start()
+    feedback = MusicalFeedback(FakeMidiOut())
+    feedback.start()
+    archive = Archive(os.path.join(workdir, "archive.sqlite"))
+    recorder_options = {"journal_path": os.path.join(workdir, "recording.journal"), "archive": archive}
+    if args.segment_seconds is not None:
+        recorder_options["segment_seconds"] = args.segment_seconds
+    recorder = Recorder(feedback, publisher, **recorder_options)
+    recorder.start()
+    midi_in = FakeMidiIn()
+    clock = ReplayClock()
+    keyboard = Keyboard(midi_in, [], recorder, clock=clock)
+    recorder.arm_recording()
+    recorder._mailbox.join()
+
+    samples = []
+    stop_sampling = threading.Event()
+
+    def sample():
+        started = time.monotonic()
+        while not stop_sampling.is_set():
+            samples.append((round(time.monotonic() - started, 3), len(recorder.events), recorder._mailbox.qsize()))
+            time.sleep(SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    stream = STREAMS[args.stream](args.seconds) if args.stream in STREAMS else file_stream(args.stream)
+    callback = midi_in.callback
+    latencies = []
+    previous = 0.0
+    count = 0
+    started = time.perf_counter()
+    for t, message in stream:
+        if args.speed:
+            wait = started + t / args.speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        clock.t = t
+        before = time.perf_counter()
+        callback((message, t - previous))
+        latencies.append(time.perf_counter() - before)
+        previous = t
+        count += 1
+    fed = time.perf_counter() - started
+    while len(recorder.events):
+        time.sleep(0.001)
+    ingested = time.perf_counter() - started
+
+    stopped = time.perf_counter()
+    recorder.stop_recording()
+    recorder._mailbox.join()
+    while publisher._outbox.pending():
+        time.sleep(0.01)
+    published = time.perf_counter() - stopped
+    stop_sampling.set()
+    sampler.join()
+
+    keyboard.shutdown()
+    recorder.shutdown()
+    feedback.shutdown()
+    publisher.shutdown()
+    recorder.join()
+    publisher.join()
+    slack.stop()
+    drive.stop()
+
+    latencies.sort()
+    report = {
+        "commit": git_commit(),
+        "stream": args.stream,
+        "seconds": round(previous, 3),
+        "speed": args.speed,
+        "events": count,
+        "dropped": recorder.events.dropped,
+        "callback_latency_us": {p: round(1e6 * percentile(latencies, float(p[1:])), 2)
+                                for p in ("p50", "p90", "p99", "p99.9")},
+        "callback_latency_max_us": round(1e6 * latencies[-1], 2) if latencies else 0.0,
+        # Events that made it into the recording, per second of wall time.
+        "events_per_second": round((count - recorder.events.dropped) / ingested, 1) if ingested else 0.0,
+        "feed_seconds": round(fed, 3),
+        "ingest_seconds": round(ingested, 3),
+        "max_ring_depth": max(s[1] for s in samples) if samples else 0,
+        "max_recorder_queue_depth": max(s[2] for s in samples) if samples else 0,
+        "stop_to_published_seconds": round(published, 3),
+        "slack_requests": len(slack.requests),
+        "drive_requests": len(drive.requests),
+        "archived_sessions": len(archive),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "depth_samples": samples,
+    }
+    for key, value in report.items():
+        if key != "depth_samples":
+            print("%-26s %s" % (key, value))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
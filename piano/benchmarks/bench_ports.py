@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+How the cost of serving several keyboards from one process scales with ports.
+
+For each port count, starts that many Instruments on fake rtmidi ports, all
+publishing through one Publisher (with local fake Slack and Drive servers and
+a stubbed renderer). It plays the same practice-like stream into every port
+from its own thread at a multiple of real time, then stops the sessions and
+waits for the outbox to drain.
+
+Per port count it reports threads and resident memory added per port,
+callback latency percentiles across all ports, dropped events and how long
+publishing all the sessions took.
+
+    python benchmarks/bench_ports.py [--ports 1,2,4,8] [--seconds 60] [--speed 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_pipeline import session_stream, percentile  # noqa: E402
+from fakes import FakeBackendServer, FakeMidiIn, FakeMidiOut, StubRenderService  # noqa: E402
+from pianobot import Instrument  # noqa: E402
+from publisher import Publisher  # noqa: E402
+
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def feed(instrument, midi_in, seconds, speed, latencies):
+    callback = midi_in.callback
+    previous = 0.0
+    started = time.perf_counter()
+    for t, message in session_stream(seconds):
+        wait = started + t / speed - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        before = time.perf_counter()
+        callback((message, t - previous))
+        latencies.append(time.perf_counter() - before)
+        previous = t
+
+
+def run(ports, args, slack, drive):
+    workdir = tempfile.mkdtemp(prefix="pianobot-bench-")
+    publisher = Publisher(soundfont_path="", slack_api_token="token", slack_channel_public="public",
+                          slack_channel_private="private", google_credentials_json=None, google_folder_id="folder",
+                          slack_api_url=slack.url, google_api_url=drive.url, render_service=StubRenderService(),
+                          outbox_path=os.path.join(workdir, "outbox"))
+    publisher.start()
+    threads_before = threading.active_count()
+    rss_before = rss_kb()
+
+    instruments = []
+    for i in range(ports):
+        midi_in = FakeMidiIn()
+        name = "port%d" % i if ports > 1 else None
+        instrument = Instrument("port %d" % i, publisher, name=name,
+                                journal_path=os.path.join(workdir, "recording-%d.journal" % i))
+        instrument.start()
+        instrument.connect(midi_in, FakeMidiOut())
+        instruments.append((instrument, midi_in))
+    for instrument, _ in instruments:
+        instrument.recorder._mailbox.join()
+
+    latencies = [[] for _ in instruments]
+    feeders = [threading.Thread(target=feed, args=(instrument, midi_in, args.seconds, args.speed, latencies[i]))
+               for i, (instrument, midi_in) in enumerate(instruments)]
+    for feeder in feeders:
+        feeder.start()
+    for feeder in feeders:
+        feeder.join()
+    threads = threading.active_count() - threads_before
+    rss = rss_kb() - rss_before
+
+    stopped = time.perf_counter()
+    for instrument, _ in instruments:
+        instrument.recorder.stop_recording()
+    for instrument, _ in instruments:
+        instrument.recorder._mailbox.join()
+    while publisher._outbox.pending():
+        time.sleep(0.01)
+    published = time.perf_counter() - stopped
+
+    dropped = sum(instrument.recorder.events.dropped for instrument, _ in instruments)
+    for instrument, _ in instruments:
+        instrument.shutdown()
+    publisher.shutdown()
+    publisher.join()
+
+    merged = sorted(sum(latencies, []))
+    print("%2d ports: %5.1f threads/port, %7.0f kB RSS/port, callback p50 %.1f us p99 %.1f us, "
+          "%d dropped, published in %.2fs" % (
+              ports, threads / ports, rss / ports, 1e6 * percentile(merged, 50), 1e6 * percentile(merged, 99),
+              dropped, published))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ports", default="1,2,4,8", help="comma-separated port counts to try")
+    parser.add_argument("--seconds", type=float, default=60, help="length of each port's stream")
+    parser.add_argument("--speed", type=float, default=20, help="multiple of real time to play at")
+    args = parser.parse_args()
+
+    slack = FakeBackendServer(0.05).start()
+    drive = FakeBackendServer(0.1).start()
+    for ports in (int(count) for count in args.ports.split(",")):
+        run(ports, args, slack, drive)
+    slack.stop()
+    drive.stop()
+
+
+if __name__ == '__main__':
+    main()
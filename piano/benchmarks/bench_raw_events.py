@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Memory and serialization cost of the raw-event log.
+
+Records the same synthetic stream of note and pedal messages into the old
+list-of-lists layout and into RawEventLog. It compares the Python heap used
+per event, the time and size of the JSON export against the binary .events
+file, and checks that the binary file reads back identically.
+
+    python benchmarks/bench_raw_events.py [--events 200000]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from raw_event_log import RawEventLog  # noqa: E402
+
+
+def messages(count):
+    t = 1500000000.0
+    for i in range(count):
+        t += 0.05
+        if i % 16 == 15:
+            yield t, 0.05, [0xb0, 64, (i * 7) % 128]
+        else:
+            yield t, 0.05, [0x90 if i % 2 == 0 else 0x80, 36 + i % 60, 64 + i % 32]
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    args = parser.parse_args()
+    n = args.events
+
+    def build_lists():
+        events = []
+        for t, deltatime, message in messages(n):
+            events.append([t, deltatime, list(message), None])
+        return events
+
+    def build_log():
+        log = RawEventLog()
+        for t, deltatime, message in messages(n):
+            log.append(t, deltatime, message)
+        return log
+
+    lists, lists_bytes = measure(build_lists)
+    log, log_bytes = measure(build_log)
+    print("lists:        %6.1f bytes/event" % (lists_bytes / n))
+    print("RawEventLog:  %6.1f bytes/event (%d bytes of columns)" % (log_bytes / n, log.nbytes))
+
+    started = time.perf_counter()
+    as_json = str.encode(json.dumps(lists))
+    json_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    out = io.BytesIO()
+    written = log.write_to(out)
+    binary_seconds = time.perf_counter() - started
+    print("json export:   %9d bytes in %.1f ms" % (len(as_json), json_seconds * 1000))
+    print("binary export: %9d bytes in %.1f ms" % (written, binary_seconds * 1000))
+
+    out.seek(0)
+    back = RawEventLog.read_from(out)
+    same = json.loads(back.to_json().decode()) == json.loads(as_json.decode())
+    print("round trip: %s" % ("identical" if same else "MISMATCH"))
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
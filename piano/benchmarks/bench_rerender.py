@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Throughput of the bulk re-render CLI.
+
+Writes --sessions synthetic sessions of 1 to 10 minutes as raw .events files
+and re-renders them with MIDI rebuilt from the raw events, encoding FLAC for
+real but with a stub synth rendering silence at --realtime-factor, on 1
+worker and on one per CPU. Then runs again to show up-to-date sessions being
+skipped, and once more after dropping half the checkpoint, as an interrupted
+run resumes.
+
+    python benchmarks/bench_rerender.py [--sessions 20] [--realtime-factor 50]
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import rerender  # noqa: E402
+from bench_pipeline import session_stream  # noqa: E402
+from fakes import StubSynth  # noqa: E402
+from raw_event_log import RawEventLog  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--realtime-factor", type=float, default=50.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # Worker processes are forked, so they pick the stub up too.
+    rerender.Synth = lambda soundfont, sample_rate, name: StubSynth(soundfont, sample_rate, name,
+                                                                     realtime_factor=args.realtime_factor)
+    rng = random.Random(1)
+    directory = tempfile.mkdtemp(prefix="bench-rerender-")
+    try:
+        sessions = os.path.join(directory, "sessions")
+        os.mkdir(sessions)
+        soundfont = os.path.join(directory, "stub.sf2")
+        with open(soundfont, "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+        audio_seconds = 0.0
+        for i in range(args.sessions):
+            seconds = rng.randrange(60, 600)
+            audio_seconds += seconds
+            log = RawEventLog()
+            for t, message in session_stream(seconds):
+                log.append(1.7e9 + i * 3600 + t, 0.0, message)
+            with open(os.path.join(sessions, "piano-%d.events" % (20240101000000 + i * 10000)), "wb") as f:
+                log.write_to(f)
+        print("%d sessions, %.0f minutes of playing" % (args.sessions, audio_seconds / 60))
+
+        output = os.path.join(directory, "output")
+        runs = [("%d worker(s)" % workers, workers, True) for workers in sorted({1, os.cpu_count() or 1})]
+        runs += [("again, all up to date", None, False), ("resumed, half left", None, False)]
+        for label, workers, fresh in runs:
+            if fresh:
+                shutil.rmtree(output, ignore_errors=True)
+            elif label.startswith("resumed"):
+                checkpoint = os.path.join(output, rerender.CHECKPOINT_NAME)
+                with open(checkpoint) as f:
+                    lines = f.readlines()
+                with open(checkpoint, "w") as f:
+                    f.writelines(lines[-len(lines) // 2:] if lines else [])
+            started = time.perf_counter()
+            counts = rerender.run([sessions], output, soundfont, ["flac"], rebuild=True, workers=workers)
+            elapsed = time.perf_counter() - started
+            print("%-22s %3d rendered %3d skipped in %6.2fs: %6.1f sessions/min" % (
+                label, counts["rendered"], counts["skipped"], elapsed,
+                (counts["rendered"] + counts["skipped"]) / elapsed * 60))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Per-event cost of the piano-roll feed on the MIDI callback.
+
+Plays dense note and pedal traffic at --rate messages a second (0 for as fast
+as possible) into Keyboard
+through a fake rtmidi port, without a roll source and then with a
+PianoRollFeed on a local port and 0, 1 and 10 WebSocket viewers reading it.
+One more run adds a stalled viewer that never reads, to show its frames being
+dropped without slowing the others down; it lasts at least 20 seconds so the
+stalled viewer's socket buffers fill up.
+
+Reports callback latency percentiles, and per viewer the frames and bytes
+received a second.
+
+    python benchmarks/bench_roll.py [--rate 2000] [--seconds 5]
+"""
+import argparse
+import base64
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_pipeline import percentile  # noqa: E402
+from fakes import FakeMidiIn  # noqa: E402
+from keyboard import Keyboard  # noqa: E402
+from metrics import REGISTRY  # noqa: E402
+from piano_roll import PianoRollFeed  # noqa: E402
+
+
+class Viewer(threading.Thread):
+    def __init__(self, port, read=True):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        if not read:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          b"Sec-WebSocket-Key: " + key + b"\r\nSec-WebSocket-Version: 13\r\n\r\n")
+        self.read = read
+        self.frames = 0
+        self.bytes = 0
+        self.stopped = False
+
+    def run(self):
+        if not self.read:
+            return
+        buf = b""
+        while not self.stopped:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            self.bytes += len(data)
+            buf += data
+            if self.frames == 0 and b"\r\n\r\n" in buf:
+                buf = buf.split(b"\r\n\r\n", 1)[1]
+                self.frames = -1
+            while len(buf) >= 2:
+                length = buf[1] & 0x7F
+                offset = 2
+                if length == 126:
+                    if len(buf) < 4:
+                        break
+                    length, = struct.unpack("!H", buf[2:4])
+                    offset = 4
+                if len(buf) < offset + length:
+                    break
+                buf = buf[offset + length:]
+                self.frames += 1
+
+    def close(self):
+        self.stopped = True
+        self.sock.close()
+
+
+def stream(rate, seconds):
+    for i in range(int((rate or 200000) * seconds)):
+        if i % 16 == 15:
+            yield [0xB0, 64, 127 if i % 32 == 15 else 0]
+        elif i % 2:
+            yield [0x80, 36 + (i // 2) % 60, 0]
+        else:
+            yield [0x90, 36 + (i // 2) % 60, 40 + i % 80]
+
+
+def run(label, rate, seconds, viewers=None, stalled=False):
+    feed = None
+    clients = []
+    roll = None
+    if viewers is not None:
+        feed = PianoRollFeed(port=0)
+        feed.start()
+        roll = feed.add_source()
+        clients = [Viewer(feed.port) for _ in range(viewers)]
+        if stalled:
+            clients.append(Viewer(feed.port, read=False))
+        for client in clients:
+            client.start()
+        time.sleep(0.2)
+    dropped_before = REGISTRY.snapshot().get("pianobot_roll_frames_dropped_total", 0)
+
+    midi_in = FakeMidiIn()
+    keyboard = Keyboard(midi_in, [], roll=roll)
+    callback = midi_in.callback
+    latencies = []
+    started = time.perf_counter()
+    for i, message in enumerate(stream(rate, seconds)):
+        wait = started + i / rate - time.perf_counter() if rate else 0
+        if wait > 0:
+            time.sleep(wait)
+        before = time.perf_counter()
+        callback((message, 0.0005))
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - started
+    time.sleep(0.1)
+    keyboard.shutdown()
+
+    readers = [client for client in clients if client.read]
+    line = "%-22s callback p50 %5.2f us p99 %6.2f us" % (label, 1e6 * percentile(sorted(latencies), 50),
+                                                         1e6 * percentile(sorted(latencies), 99))
+    if readers:
+        line += ", %5.1f frames/s %7.0f B/s per viewer" % (sum(c.frames for c in readers) / len(readers) / elapsed,
+                                                           sum(c.bytes for c in readers) / len(readers) / elapsed)
+    if stalled:
+        line += ", %d frames dropped" % (REGISTRY.snapshot().get("pianobot_roll_frames_dropped_total", 0) -
+                                         dropped_before)
+    print(line)
+    for client in clients:
+        client.close()
+    if feed is not None:
+        feed.shutdown()
+        feed.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=2000, help="MIDI messages a second")
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    run("no roll", args.rate, args.seconds)
+    for viewers in (0, 1, 10):
+        run("%d viewers" % viewers, args.rate, args.seconds, viewers)
+    run("10 viewers + stalled", args.rate, max(args.seconds, 20), 10, stalled=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Checks SMFWriter against mido and times both encoders.
+
+Encodes the same synthetic event stream (notes, sustain pedal, gaps long
+enough to need multi-byte delta times) once the way Recorder used to, with a
+mido Message per event and MidiFile.save(), and once with SMFWriter. Exits
+non-zero if the two files are not byte-for-byte identical.
+
+    python benchmarks/bench_smf.py [--events 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+from mido import MidiFile, MidiTrack, Message, bpm2tempo  # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from smf_writer import SMFWriter  # noqa: E402
+
+DEFAULT_BPM = 120
+STATUS = {"note_on": 0x90, "note_off": 0x80, "control_change": 0xB0}
+
+
+def synthetic_stream(n, seed=0):
+    rng = random.Random(seed)
+    t = 1.5e9 + rng.random()
+    events = []
+    for i in range(n):
+        t += rng.choice((0.0, 0.0005, 0.013, 0.25, 0.7, 3.2, 9.9)) * rng.random()
+        kind = rng.random()
+        if kind < 0.45:
+            events.append(("note_on", rng.randrange(21, 109), rng.randrange(1, 128), t))
+        elif kind < 0.9:
+            events.append(("note_off", rng.randrange(21, 109), rng.randrange(0, 128), t))
+        else:
+            events.append(("control_change", rng.choice((64, 66, 67)), rng.randrange(0, 128), t))
+    return events
+
+
+def encode_mido(events):
+    midifile = MidiFile()
+    track = MidiTrack()
+    midifile.tracks.append(track)
+    last = None
+    for event, note, velocity, t in events:
+        if last is None:
+            last = t
+        # int(second2tick(...)) with the pinned mido 1.2.9, spelled out since 1.3 rounds.
+        ticks = int((t - last) / (bpm2tempo(DEFAULT_BPM) * 1e-6 / midifile.ticks_per_beat))
+        if event == "control_change":
+            track.append(Message(event, control=note, value=velocity, time=ticks))
+        else:
+            track.append(Message(event, note=note, velocity=velocity, time=ticks))
+        last = t
+    out = BytesIO()
+    midifile.save(file=out)
+    return bytes(out.getbuffer())
+
+
+def encode_smf_writer(events):
+    writer = SMFWriter(DEFAULT_BPM)
+    last = None
+    for event, note, velocity, t in events:
+        if last is None:
+            last = t
+        writer.append(writer.seconds_to_ticks(t - last), STATUS[event], note, velocity)
+        last = t
+    return writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    events = synthetic_stream(args.events)
+    timings = {}
+    outputs = {}
+    for label, encoder in (("mido", encode_mido), ("SMFWriter", encode_smf_writer)):
+        started = time.perf_counter()
+        outputs[label] = encoder(events)
+        timings[label] = time.perf_counter() - started
+        print("%-10s %d bytes, %.2f us/event" % (label, len(outputs[label]), 1e6 * timings[label] / len(events)))
+
+    for n in (0, 1, 2, 3, 100):
+        if bytes(encode_smf_writer(events[:n])) != encode_mido(events[:n]):
+            print("MISMATCH for the first %d events" % n)
+            sys.exit(1)
+    if bytes(outputs["SMFWriter"]) != outputs["mido"]:
+        print("MISMATCH: SMFWriter output differs from mido")
+        sys.exit(1)
+    print("identical output, %.1fx faster" % (timings["mido"] / timings["SMFWriter"]))
+
+
+if __name__ == '__main__':
+    main()
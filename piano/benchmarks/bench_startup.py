@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+How long a fresh process takes to start capturing MIDI.
+
+Each run starts a new interpreter that imports the bot, builds and starts a
+Publisher (against a local fake Drive server, with a stubbed renderer and
+the real HTTP backends) and one Instrument on a fake MIDI port, then plays a
+single note. The child reports the startup phases it reached, measured from
+process start; the parent prints their median over all runs.
+
+    python benchmarks/bench_startup.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, os.pardir))
+
+PHASES = ("imported", "publisher", "midi_open", "first_event", "backends_ready")
+
+
+def child(drive_url):
+    import startup
+    from fakes import FakeMidiIn, FakeMidiOut, StubRenderService
+    from pianobot import Instrument
+    from publisher import Publisher
+    startup.reached("imported")
+
+    workdir = tempfile.mkdtemp(prefix="pianobot-bench-")
+    publisher = Publisher(soundfont_path="", slack_api_token="token", slack_channel_public="public",
+                          slack_channel_private="private", google_credentials_json=None, google_folder_id="folder",
+                          slack_api_url=drive_url, google_api_url=drive_url, render_service=StubRenderService(),
+                          outbox_path=os.path.join(workdir, "outbox"))
+    publisher.start()
+    startup.reached("publisher")
+
+    midi_in = FakeMidiIn()
+    instrument = Instrument("port", publisher, journal_path=os.path.join(workdir, "recording.journal"))
+    instrument.start()
+    instrument.connect(midi_in, FakeMidiOut())
+    midi_in.callback(([0x90, 60, 64], 0.0))
+
+    while "backends_ready" not in startup._reached:
+        time.sleep(0.001)
+    phases = {phase: child.value for (phase,), child in startup.STARTUP._children.items()}
+    instrument.shutdown()
+    publisher.shutdown()
+    publisher.join()
+    print(json.dumps(phases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    from fakes import FakeBackendServer
+    drive = FakeBackendServer(0.0).start()
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", drive.url],
+                                check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(output.decode().splitlines()[-1]))
+    drive.stop()
+    for phase in PHASES:
+        print("%-15s %6.1f ms" % (phase, 1000 * statistics.median(run[phase] for run in runs)))
+
+
+if __name__ == '__main__':
+    main()
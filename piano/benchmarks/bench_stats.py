@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Cost of the running session statistics.
+
+Feeds a synthetic practice session of --seconds through SessionStats the way
+Recorder does, and reports the cost per event, the time summary() takes at
+the end of the session and the size of the published sidecar.
+
+    python benchmarks/bench_stats.py [--seconds 7200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bench_pipeline import session_stream  # noqa: E402
+from session_stats import SessionStats, describe  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=7200)
+    args = parser.parse_args()
+
+    events = [(int(t * 1e9), message) for t, message in session_stream(args.seconds)]
+    stats = SessionStats(0)
+    started = time.perf_counter()
+    for t, message in events:
+        status = message[0] & 0xF0
+        if status == 0x90 and message[2]:
+            stats.note_on(t, message[1], message[2])
+        elif status in (0x80, 0x90):
+            stats.note_off(t, message[1])
+        elif status == 0xB0:
+            stats.control_change(t, message[1], message[2])
+    elapsed = time.perf_counter() - started
+
+    import numpy  # noqa: F401  # imported up front so the summary is timed without it
+    summarized = time.perf_counter()
+    summary = stats.summary()
+    summary_seconds = time.perf_counter() - summarized
+
+    print("%d events: %.2f us/event, summary in %.1f ms, sidecar %d bytes" % (
+        len(events), 1e6 * elapsed / len(events), 1000 * summary_seconds,
+        len(json.dumps(summary, separators=(",", ":")))))
+    print(describe("piano-bench", summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for ResettableTimer.
+
+Replays a synthetic MIDI event stream (2 kHz by default) and, like Recorder,
+resets an idle timer and a rearm timer on every event, while periodically
+starting new "sessions" that create fresh timers. Reports resets per second
+and the number of live threads, for the shared scheduler and for the old
+thread-per-timer implementation.
+
+    python benchmarks/bench_timers.py [--rate 2000] [--seconds 5] [--sessions 20]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from resettable_timer import ResettableTimer  # noqa: E402
+
+
+class LegacyResettableTimer(Thread):
+    """The previous thread-per-timer implementation, kept for comparison."""
+
+    def __init__(self, interval, fn, name=""):
+        Thread.__init__(self, daemon=True)
+        self._interval = interval
+        self._fn = fn
+        self._finished = Event()
+        self._reset = True
+
+    def cancel(self):
+        self._finished.set()
+
+    def run(self):
+        while self._reset:
+            self._reset = False
+            self._finished.wait(self._interval)
+        if not self._finished.is_set():
+            self._fn()
+        self._finished.set()
+
+    def reset(self, interval=None):
+        self._reset = True
+        self._finished.set()
+        self._finished.clear()
+
+
+def run_stream(factory, rate: int, seconds: float, sessions: int):
+    fired = []
+    rearm = factory(180, lambda: fired.append("rearm"), "recording_rearm")
+    rearm.start()
+    timers = [rearm]
+
+    period = 1.0 / rate
+    total_events = int(rate * seconds)
+    events_per_session = max(1, total_events // max(1, sessions))
+    idle = None
+    resets = 0
+    max_threads = threading.active_count()
+    reset_time = 0.0
+
+    started = time.perf_counter()
+    next_event = started
+    for i in range(total_events):
+        if i % events_per_session == 0:
+            if idle is not None:
+                idle.cancel()
+            idle = factory(10, lambda: fired.append("idle"), "recording_idle")
+            idle.start()
+            timers.append(idle)
+            max_threads = max(max_threads, threading.active_count())
+
+        t0 = time.perf_counter()
+        rearm.reset()
+        idle.reset()
+        reset_time += time.perf_counter() - t0
+        resets += 2
+
+        next_event += period
+        delay = next_event - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.perf_counter() - started
+    max_threads = max(max_threads, threading.active_count())
+
+    for timer in timers:
+        timer.cancel()
+
+    return {
+        "events": total_events,
+        "elapsed_s": elapsed,
+        "achieved_rate_hz": total_events / elapsed,
+        "resets": resets,
+        "reset_cost_us": 1e6 * reset_time / resets,
+        "resets_per_s_capacity": resets / reset_time if reset_time else float("inf"),
+        "max_threads": max_threads,
+        "fired": len(fired),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=2000, help="synthetic events per second")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--sessions", type=int, default=20, help="recording sessions started during the run")
+    args = parser.parse_args()
+
+    for label, factory in (("shared scheduler", ResettableTimer), ("thread per timer", LegacyResettableTimer)):
+        result = run_stream(factory, args.rate, args.seconds, args.sessions)
+        print("%-17s %d events in %.2fs (%.0f Hz), %.2f us/reset, %.0f resets/s capacity, max %d threads" % (
+            label, result["events"], result["elapsed_s"], result["achieved_rate_hz"], result["reset_cost_us"],
+            result["resets_per_s_capacity"], result["max_threads"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+End-to-end publish latency against local stand-in Slack and Drive servers.
+
+Publishes a few sessions through Publisher with a stub synth and reports the
+time from publish_midi_file to the last upload finishing. The total is compared
+with what the same requests would take one after another.
+
+    python benchmarks/bench_uploads.py [--sessions 3] [--slack-latency 0.3] [--drive-latency 1.0]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from fakes import FakeBackendServer, StubRenderService  # noqa: E402
+from publisher import Publisher  # noqa: E402
+from raw_event_log import RawEventLog  # noqa: E402
+from smf_writer import SMFWriter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=3)
+    parser.add_argument("--slack-latency", type=float, default=0.3)
+    parser.add_argument("--drive-latency", type=float, default=1.0)
+    parser.add_argument("--public", action="store_true")
+    parser.add_argument("--drive-failures", type=int, default=0, help="fail this many Drive uploads first")
+    args = parser.parse_args()
+
+    slack = FakeBackendServer(args.slack_latency).start()
+    drive = FakeBackendServer(args.drive_latency, failures=args.drive_failures).start()
+    published = []
+    done = threading.Semaphore(0)
+
+    def on_published(session):
+        published.append(session)
+        done.release()
+
+    publisher = Publisher(soundfont_path="", slack_api_token="token", slack_channel_public="public",
+                          slack_channel_private="private", google_credentials_json=None, google_folder_id="folder",
+                          slack_api_url=slack.url, google_api_url=drive.url, on_published=on_published,
+                          render_service=StubRenderService(), audio_formats=["flac", "ogg"],
+                          outbox_path=tempfile.mkdtemp(prefix="pianobot-bench-"))
+    publisher.start()
+
+    midi = SMFWriter(120)
+    for i in range(200):
+        midi.append(24, 0x90, 60 + i % 12, 80)
+        midi.append(24, 0x80, 60 + i % 12, 0)
+    midi_bytes = midi.close()
+
+    raw_events = RawEventLog()
+    raw_events.append(0.0, 0.0, [0x90, 60, 80])
+    for i in range(args.sessions):
+        prefix = "piano-bench-%d" % i
+        publisher.publish_midi_file(prefix, midi_bytes, public=args.public)
+        publisher.publish_raw_data(prefix, raw_events)
+    for _ in range(args.sessions):
+        done.acquire()
+    publisher.shutdown()
+    publisher.join()
+
+    drive_uploads = [r for r in drive.requests if r[1] == "POST"]
+    serial = len(slack.requests) * args.slack_latency + len(drive_uploads) * args.drive_latency
+    for session in published:
+        print("%s: published in %.2fs, %d bytes uploaded, %d failed attempts" % (
+            session.file_prefix, session.finished - session.started, session.bytes_uploaded, session.failed_uploads))
+    total = max(s.finished for s in published) - min(s.started for s in published)
+    print("%d slack + %d drive requests: %.2fs total, %.2fs if sent one after another" % (
+        len(slack.requests), len(drive_uploads), total, serial))
+    slack.stop()
+    drive.stop()
+
+
+if __name__ == '__main__':
+    main()
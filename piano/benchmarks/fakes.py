@@ -0,0 +1,211 @@
+"""
+Local stand-ins for the services pianobot talks to, used by the benchmarks.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synth import FRAMES_PER_BLOCK, CHANNELS, SAMPLE_WIDTH, SAMPLE_RATE  # noqa: E402
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.record(self.command, self.path, 0)
+        self._reply(200, {"items": []})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        failing = self.server.record(self.command, self.path, len(body))
+        time.sleep(self.server.latency)
+        if failing:
+            self._reply(503, {"ok": False, "error": "unavailable"})
+        elif self.path.startswith("/upload/drive/") and "uploadType=resumable" in self.path:
+            upload_id = uuid.uuid4().hex
+            self.server.resumable[upload_id] = (int(self.headers["X-Upload-Content-Length"]), bytearray())
+            self._reply(200, {}, {"Location": "%s/upload/drive/v2/files?uploadType=resumable&upload_id=%s" % (
+                self.server.url, upload_id)})
+        elif self.path.startswith("/upload/drive/"):
+            self._reply(200, {"id": uuid.uuid4().hex})
+        else:
+            self._reply(200, {"ok": True})
+
+    def do_PUT(self):
+        # Drive's resumable protocol: chunks carry "Content-Range: bytes a-b/total",
+        # an empty "bytes */total" asks how much has been committed.
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        failing = self.server.record(self.command, self.path, len(body))
+        time.sleep(self.server.latency)
+        upload_id = self.path.rsplit("upload_id=", 1)[-1]
+        if upload_id not in self.server.resumable:
+            self._reply(404, {})
+            return
+        total, received = self.server.resumable[upload_id]
+        if failing:
+            self._reply(503, {})
+            return
+        content_range = self.headers.get("Content-Range", "")
+        if body and content_range.startswith("bytes ") and not content_range.startswith("bytes */"):
+            start = int(content_range[6:].split("-")[0])
+            if start == len(received):
+                received.extend(body)
+        if len(received) >= total:
+            self.server.completed.append((upload_id, bytes(received)))
+            self._reply(200, {"id": upload_id})
+        elif received:
+            self._reply(308, {}, {"Range": "bytes=0-%d" % (len(received) - 1)})
+        else:
+            self._reply(308, {})
+
+
+class FakeMidiIn(object):
+    """Stands in for rtmidi.MidiIn: whoever calls `callback` plays the keyboard."""
+
+    def __init__(self):
+        self.callback = None
+
+    def ignore_types(self, **kwargs):
+        pass
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+    def close_port(self):
+        pass
+
+
+class FakeMidiOut(object):
+    """Stands in for rtmidi.MidiOut and counts what would have been played."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, message):
+        self.sent += 1
+
+    def close_port(self):
+        pass
+
+
+class FakeBackendServer(ThreadingMixIn, HTTPServer):
+    """
+    Accepts Slack Web API and Drive upload requests on 127.0.0.1, answers
+    each after `latency` seconds and records what it received. The first
+    `failures` POST or PUT requests, and those whose 1-based position is in
+    `fail_requests`, are answered with HTTP 503. Drive's
+    resumable upload protocol is supported.
+    """
+    daemon_threads = True
+    handler = _Handler
+
+    def __init__(self, latency: float = 0.0, failures: int = 0, fail_requests=()):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), self.handler)
+        self.latency = latency
+        self.failures = failures
+        self.fail_requests = set(fail_requests)
+        self.requests = []
+        self.resumable = {}
+        self.completed = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def record(self, method, path, size) -> bool:
+        with self._lock:
+            self.requests.append((time.monotonic(), method, path, size))
+            if len(self.requests) in self.fail_requests:
+                return True
+            if method in ("POST", "PUT") and self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRenderService(object):
+    """Stands in for RenderService: "renders" silence at a fixed real-time factor."""
+
+    def __init__(self, seconds_per_session: float = 5.0, realtime_factor: float = 50.0):
+        self.sample_rate = SAMPLE_RATE
+        self._frames = int(seconds_per_session * SAMPLE_RATE)
+        self._realtime_factor = realtime_factor
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def submit(self, midi_bytes, sink) -> Future:
+        future = Future()
+
+        def render():
+            block = bytes(FRAMES_PER_BLOCK * CHANNELS * SAMPLE_WIDTH)
+            remaining = self._frames
+            while remaining > 0:
+                n = min(remaining, FRAMES_PER_BLOCK)
+                sink.write(memoryview(block)[:n * CHANNELS * SAMPLE_WIDTH])
+                remaining -= n
+            time.sleep(self._frames / SAMPLE_RATE / self._realtime_factor)
+            future.set_result(sink.close())
+
+        threading.Thread(target=render, daemon=True).start()
+        return future
+
+
+class StubSynth(object):
+    """Stands in for Synth: "renders" as much silence as the MIDI file lasts, at a fixed real-time factor."""
+
+    def __init__(self, soundfont_path: str, sample_rate: int = SAMPLE_RATE, name: str = "synth",
+                 realtime_factor: float = 50.0):
+        self.sample_rate = sample_rate
+        self._realtime_factor = realtime_factor
+
+    def render(self, midi_bytes, sink) -> int:
+        from io import BytesIO
+        from mido import MidiFile  # type: ignore
+
+        frames = int(MidiFile(file=BytesIO(midi_bytes)).length * self.sample_rate)
+        block = bytes(FRAMES_PER_BLOCK * CHANNELS * SAMPLE_WIDTH)
+        remaining = frames
+        while remaining > 0:
+            n = min(remaining, FRAMES_PER_BLOCK)
+            sink.write(memoryview(block)[:n * CHANNELS * SAMPLE_WIDTH])
+            remaining -= n
+        time.sleep(frames / self.sample_rate / self._realtime_factor)
+        return frames
+
+    def close(self) -> None:
+        pass
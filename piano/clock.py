@@ -0,0 +1,80 @@
+import logging
+import time
+from threading import Lock
+
+from metrics import gauge
+
+log = logging.getLogger('pianobot')
+
+NANOSECONDS = 1000000000
+REANCHOR_INTERVAL = 60 * NANOSECONDS
+# Wall-clock steps bigger than this are logged; smaller ones are NTP slewing.
+DRIFT_WARNING = NANOSECONDS // 10
+
+# time.monotonic_ns() and time.time_ns() are new in Python 3.7; the image runs 3.6.
+if hasattr(time, "monotonic_ns"):
+    monotonic_ns = time.monotonic_ns
+    time_ns = time.time_ns
+else:
+    def monotonic_ns() -> int:
+        return int(time.monotonic() * NANOSECONDS)
+
+    def time_ns() -> int:
+        return int(time.time() * NANOSECONDS)
+
+DRIFT = gauge("pianobot_clock_drift_seconds",
+              "How far the wall clock moved against the monotonic clock over the last re-anchor interval.")
+DRIFT_TOTAL = gauge("pianobot_clock_drift_total_seconds",
+                    "How far the wall clock has moved against the monotonic clock since startup.")
+
+
+class EventClock(object):
+    """
+    Maps integer-nanosecond monotonic timestamps to wall-clock time.
+
+    Events are stamped with monotonic_ns(), which never jumps and has no
+    accumulated float error, so intervals between events are exact. Wall-clock
+    time is only needed to name and date a session; it comes from an anchor
+    pair of (monotonic, wall) readings that is refreshed every
+    REANCHOR_INTERVAL, and the difference between what the old anchor predicted
+    and what the wall clock says is the drift since the last anchor.
+    """
+
+    def __init__(self, reanchor_interval: int = REANCHOR_INTERVAL):
+        self._reanchor_interval = reanchor_interval
+        self._lock = Lock()
+        # One tuple so readers never see the monotonic half of one anchor with the wall half of another.
+        self._anchor = (monotonic_ns(), time_ns())
+        self.drift = 0
+        self.drift_total = 0
+        DRIFT.set_function(lambda: self.drift / NANOSECONDS)
+        DRIFT_TOTAL.set_function(lambda: self.drift_total / NANOSECONDS)
+
+    def reanchor(self) -> int:
+        """Take a fresh anchor; returns the drift in nanoseconds since the previous one."""
+        with self._lock:
+            mono = monotonic_ns()
+            wall = time_ns()
+            anchor_mono, anchor_wall = self._anchor
+            drift = (wall - anchor_wall) - (mono - anchor_mono)
+            self._anchor = (mono, wall)
+            self.drift = drift
+            self.drift_total += drift
+        if abs(drift) >= DRIFT_WARNING:
+            log.warning("clock: wall clock stepped by %.3fs against the monotonic clock", drift / NANOSECONDS)
+        return drift
+
+    def maybe_reanchor(self) -> None:
+        if monotonic_ns() - self._anchor[0] >= self._reanchor_interval:
+            self.reanchor()
+
+    def wall_ns(self, t: int) -> int:
+        """Wall-clock time in nanoseconds since the epoch of monotonic timestamp `t`."""
+        mono, wall = self._anchor
+        return wall + (t - mono)
+
+    def wall_seconds(self, t: int) -> float:
+        return self.wall_ns(t) / NANOSECONDS
+
+
+CLOCK = EventClock()
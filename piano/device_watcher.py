@@ -0,0 +1,92 @@
+import logging
+import time
+from threading import Thread, Event
+from typing import Callable, List, Optional
+
+import rtmidi  # type: ignore
+
+try:
+    import alsa_midi  # type: ignore
+except ImportError:
+    alsa_midi = None
+
+log = logging.getLogger('pianobot')
+
+# How long to wait for an announce event before re-listing the ports anyway.
+ANNOUNCE_TIMEOUT = 5.0
+# Without the ALSA sequencer, ports are listed this often, so a plug-in is
+# still noticed well within a second.
+POLL_INTERVAL = 0.25
+
+
+class DeviceWatcher(Thread):
+    """
+    Calls on_change(ports, detected) with the list of MIDI input port names
+    whenever it changes, and once at startup. `detected` is the monotonic time
+    the change was noticed.
+
+    Changes are noticed through the ALSA sequencer's announce events when the
+    alsa_midi package is available; otherwise, or if the sequencer can't be
+    opened, the ports are polled every POLL_INTERVAL seconds. Either way the
+    port names come from rtmidi, so they match what open_midiport() expects.
+    """
+
+    def __init__(self, on_change: Callable[[List[str], float], None], poll_interval: float = POLL_INTERVAL):
+        Thread.__init__(self, name="device_watcher", daemon=True)
+        self._on_change = on_change
+        self._poll_interval = poll_interval
+        self._stopped = Event()
+        self._probe = None
+        self._ports: Optional[List[str]] = None
+
+    def run(self) -> None:
+        if alsa_midi is not None:
+            try:
+                self._watch_announcements()
+                return
+            except Exception:
+                log.exception("device watcher: ALSA sequencer unavailable, polling for MIDI ports instead")
+        self._poll()
+
+    def _watch_announcements(self) -> None:
+        client = alsa_midi.SequencerClient("pianobot-watcher")
+        try:
+            port = client.create_port("announce", caps=alsa_midi.WRITE_PORT,
+                                      type=alsa_midi.PortType.APPLICATION)
+            # System:Announce broadcasts client and port start/exit events.
+            port.connect_from(alsa_midi.SYSTEM_ANNOUNCE)
+            log.info("device watcher: listening for ALSA sequencer announcements")
+            self.check()
+            while not self._stopped.is_set():
+                event = client.event_input(timeout=ANNOUNCE_TIMEOUT)
+                # Each client or port announcement (or the timeout) is a cue to re-list;
+                # a burst of them for one device costs a few cheap port listings.
+                if event is None or event.type in (alsa_midi.EventType.PORT_START, alsa_midi.EventType.PORT_EXIT,
+                                                   alsa_midi.EventType.CLIENT_START,
+                                                   alsa_midi.EventType.CLIENT_EXIT):
+                    self.check()
+        finally:
+            client.close()
+
+    def _poll(self) -> None:
+        while True:
+            self.check()
+            if self._stopped.wait(self._poll_interval):
+                return
+
+    def check(self) -> None:
+        """List the ports now and report them if they changed."""
+        detected = time.monotonic()
+        try:
+            if self._probe is None:
+                self._probe = rtmidi.MidiIn()
+            ports = self._probe.get_ports()
+        except Exception as e:
+            log.debug("device watcher: could not list MIDI ports: %s", e)
+            return
+        if ports != self._ports:
+            self._ports = ports
+            self._on_change(ports, detected)
+
+    def shutdown(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,105 @@
+from array import array
+from typing import List, Optional
+
+EVENT_RING_CAPACITY = 8192
+
+
+class EventRing(object):
+    """
+    Preallocated single-producer/single-consumer ring of MIDI event records.
+
+    The rtmidi callback thread is the only writer of `_head` and the consumer
+    thread is the only writer of `_tail`, so neither side needs a lock: a slot
+    is filled before `_head` moves past it and is only reused after `_tail`
+    has. Each record is (timestamp, deltatime, status, data1, data2, length),
+    with the timestamp in integer monotonic nanoseconds; messages longer than three bytes (sysex) keep their bytes in a side slot.
+
+    When the ring is full the event is counted in `dropped` and discarded
+    rather than blocking the callback.
+
+    A consumer about to sleep sets `waiting` and then checks the ring once
+    more; push() calls the function given to set_wakeup() when it finds
+    `waiting` set after adding an event. Either the consumer sees the event
+    or the producer sees the flag, so the consumer never sleeps through an
+    event, and the producer only pays for a wake-up at the start of a burst.
+    """
+
+    def __init__(self, capacity: int = EVENT_RING_CAPACITY):
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._times = array('q', bytes(8 * capacity))
+        self._deltas = array('d', bytes(8 * capacity))
+        self._bytes = array('B', bytes(4 * capacity))
+        self._long_messages: List[Optional[List[int]]] = [None] * capacity
+        self._head = 0
+        self._tail = 0
+        self.dropped = 0
+        self.waiting = False
+        self._wakeup = None
+
+    def __len__(self) -> int:
+        return self._head - self._tail
+
+    def set_wakeup(self, wakeup) -> None:
+        self._wakeup = wakeup
+
+    def push(self, t: int, message, deltatime: float) -> bool:
+        head = self._head
+        if head - self._tail >= self._capacity:
+            self.dropped += 1
+            return False
+        i = head & self._mask
+        self._times[i] = t
+        self._deltas[i] = deltatime
+        length = len(message)
+        j = i << 2
+        b = self._bytes
+        b[j] = message[0]
+        if length == 3:
+            b[j + 1] = message[1]
+            b[j + 2] = message[2]
+            b[j + 3] = 3
+        elif length < 3:
+            b[j + 1] = message[1] if length > 1 else 0
+            b[j + 2] = 0
+            b[j + 3] = length
+        else:
+            b[j + 1] = 0
+            b[j + 2] = 0
+            b[j + 3] = 255
+            self._long_messages[i] = list(message)
+        self._head = head + 1
+        if self.waiting:
+            self.waiting = False
+            if self._wakeup is not None:
+                self._wakeup()
+        return True
+
+    def drain(self, limit: int = EVENT_RING_CAPACITY) -> list:
+        """
+        Remove up to `limit` records and return them as
+        (t, deltatime, status, data1, data2, message) tuples, oldest first.
+        """
+        tail = self._tail
+        head = min(self._head, tail + limit)
+        if head == tail:
+            return []
+        mask = self._mask
+        times = self._times
+        deltas = self._deltas
+        b = self._bytes
+        batch = []
+        for seq in range(tail, head):
+            i = seq & mask
+            j = i << 2
+            length = b[j + 3]
+            if length == 255:
+                message = self._long_messages[i]
+                self._long_messages[i] = None
+            else:
+                message = list(b[j:j + length])
+            batch.append((times[i], deltas[i], b[j], b[j + 1], b[j + 2], message))
+        self._tail = head
+        return batch
@@ -0,0 +1,148 @@
+from typing import Callable, List, Optional
+
+NUMBER_OF_NOTES = 128
+NANOSECONDS = 1000000000
+
+
+def _window_ns(window: Optional[float]) -> Optional[int]:
+    return int(window * NANOSECONDS) if window is not None else None
+
+
+class _Chord(object):
+    __slots__ = ("notes", "mask", "fn", "window")
+
+    def __init__(self, notes: List[int], fn: Callable[[], None], window: Optional[float]):
+        self.notes = notes
+        self.mask = sum(1 << note for note in set(notes))
+        self.fn = fn
+        self.window = _window_ns(window)
+
+
+class _Sequence(object):
+    __slots__ = ("notes", "fallback", "fn", "window", "progress", "pressed_at", "last_press")
+
+    def __init__(self, notes: List[int], fn: Callable[[], None], window: Optional[float]):
+        self.notes = notes
+        # fallback[i]: the length of the longest proper prefix of notes[:i + 1]
+        # that is also its suffix, as in Knuth-Morris-Pratt.
+        self.fallback = [0] * len(notes)
+        k = 0
+        for i in range(1, len(notes)):
+            while k and notes[i] != notes[k]:
+                k = self.fallback[k - 1]
+            if notes[i] == notes[k]:
+                k += 1
+            self.fallback[i] = k
+        self.fn = fn
+        self.window = _window_ns(window)
+        self.progress = 0
+        # When each note matched so far was pressed.
+        self.pressed_at = [0] * len(notes)
+        self.last_press = 0
+
+
+class HotkeyMatcher(object):
+    """
+    Matches held-note chords and ordered note sequences against the keyboard.
+
+    Held notes are one integer bitmask. Every note maps to the gestures that
+    include it, so a note-on only looks at those: a chord fires when its mask
+    is a subset of the held notes, a sequence advances when the note is the
+    next one it expects and no other note was pressed since the previous one;
+    otherwise it keeps the longest run of notes just played that starts it.
+    Commands are dicts like the ones Keyboard takes:
+
+        {"combo": [105, 107, 108], "fn": ...}            all held at once
+        {"combo": [...], "window": 0.25, "fn": ...}      ... pressed within 250ms
+        {"sequence": [60, 64, 67], "fn": ...}            pressed in this order
+        {"sequence": [...], "window": 1.0, "fn": ...}    ... within one second
+
+    Windows are given in seconds; note_on() takes monotonic nanoseconds.
+    Notes of a chord that fired are added to `hotkey_notes` until released.
+    """
+
+    def __init__(self, commands: List[dict]):
+        self.active = 0
+        self.hotkey_notes = 0
+        self._pressed_at = [0] * NUMBER_OF_NOTES
+        self._presses = 0
+        self._chords: List[List[_Chord]] = [[] for _ in range(NUMBER_OF_NOTES)]
+        self._sequences: List[List[_Sequence]] = [[] for _ in range(NUMBER_OF_NOTES)]
+        for command in commands:
+            self.add(command)
+
+    def add(self, command: dict) -> None:
+        window = command.get("window")
+        if "sequence" in command:
+            sequence = _Sequence(list(command["sequence"]), command["fn"], window)
+            for note in set(sequence.notes):
+                self._sequences[note].append(sequence)
+        else:
+            chord = _Chord(list(command["combo"]), command["fn"], window)
+            for note in set(chord.notes):
+                self._chords[note].append(chord)
+
+    def is_active(self, note: int) -> bool:
+        return bool(self.active >> note & 1)
+
+    def note_on(self, note: int, t: int) -> bool:
+        """Mark `note` held at `t` and run the first gesture it completes; returns whether one ran."""
+        active = self.active | 1 << note
+        self.active = active
+        self._pressed_at[note] = t
+        self._presses += 1
+        chords = self._chords[note]
+        if chords:
+            for chord in chords:
+                if active & chord.mask == chord.mask and (chord.window is None or self._within(chord, t)):
+                    self.hotkey_notes |= chord.mask
+                    chord.fn()
+                    return True
+        sequences = self._sequences[note]
+        if sequences:
+            for sequence in sequences:
+                if self._advance(sequence, note, t):
+                    sequence.fn()
+                    return True
+        return False
+
+    def note_off(self, note: int) -> bool:
+        """Mark `note` released; returns whether it was part of a chord that fired."""
+        bit = 1 << note
+        if self.active & bit:
+            self.active ^= bit
+        if self.hotkey_notes & bit:
+            self.hotkey_notes ^= bit
+            return True
+        return False
+
+    def _within(self, chord: _Chord, t: int) -> bool:
+        # `note` was just pressed at `t`, so the chord's oldest press bounds the spread.
+        pressed_at = self._pressed_at
+        return t - min(pressed_at[n] for n in chord.notes) <= chord.window
+
+    def _advance(self, sequence: _Sequence, note: int, t: int) -> bool:
+        notes = sequence.notes
+        progress = sequence.progress
+        pressed_at = sequence.pressed_at
+        if progress and self._presses != sequence.last_press + 1:
+            progress = 0
+        # When `note` doesn't continue the match (or would take it past the
+        # window), the notes matched last may still start the sequence again,
+        # as C-C in C-C-C-D does for C-C-D: fall back to the longest of those.
+        window = sequence.window
+        while progress and (notes[progress] != note or window is not None and t - pressed_at[0] > window):
+            fallback = sequence.fallback[progress - 1]
+            pressed_at[:fallback] = pressed_at[progress - fallback:progress]
+            progress = fallback
+        if progress == 0 and notes[0] != note:
+            sequence.progress = 0
+            return False
+        pressed_at[progress] = t
+        sequence.last_press = self._presses
+        progress += 1
+        if progress == len(notes):
+            sequence.progress = 0
+            return True
+        sequence.progress = progress
+        return False
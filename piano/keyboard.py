@@ -3,40 +3,62 @@ import time
 
 from rtmidi.midiconstants import NOTE_ON, NOTE_OFF, ACTIVE_SENSING, CONTROL_CHANGE  # type: ignore
 
+import flight_recorder
+from clock import monotonic_ns
+from hotkeys import HotkeyMatcher
+from metrics import histogram
 from resettable_timer import ResettableTimer
 
 NUMBER_OF_PIANO_KEYS: int = 120
 ACTIVE_SENSE_TIMEOUT: int = 3
 
+CALLBACK_DURATION = histogram("pianobot_midi_callback_seconds", "Time spent in the rtmidi callback.")
+
+TRACE_MIDI_IN = flight_recorder.register("midi_in", "status=0x%02x data=0x%04x")
+TRACE_UNRECOGNIZED = flight_recorder.register("midi_unrecognized", "status=0x%02x length=%d")
+TRACE_NOTE_OFF_INACTIVE = flight_recorder.register("note_off_inactive", "note=%d velocity=%d")
+TRACE_ACTIVE_SENSE_TIMEOUT = flight_recorder.register("active_sense_timeout", "timeout=%ds")
+
 log = logging.getLogger('pianobot')
 
 class Keyboard(object):
-    def __init__(self, midi_in, commands=[], recorder=None):
+    def __init__(self, midi_in, commands=[], recorder=None, clock=monotonic_ns, on_first_event=None, roll=None):
         self._midi_in = midi_in
+        # A piano_roll.RollSource mirroring key and pedal state for live viewers.
+        self._roll = roll
+        self._on_first_event = on_first_event
+        # Events are stamped with this, in integer nanoseconds, when the callback runs.
+        self._clock = clock
         self._active_notes = [None] * NUMBER_OF_PIANO_KEYS
         self._active_notes_velocity = [None] * NUMBER_OF_PIANO_KEYS
-        self._active_hotkey = [False] * NUMBER_OF_PIANO_KEYS
-        self._commands = commands
-        self._special_keys = sum([commands[cmd]['combo'] for cmd in range(len(commands))], [])
+        self._hotkeys = HotkeyMatcher(commands)
         self._recorder = recorder
+        self._ingest = recorder.events.push if recorder else None
+        self._trace = flight_recorder.record
+        self._callback_duration = CALLBACK_DURATION.labels()
 
         self._midi_in.ignore_types(sysex=False, timing=False, active_sense=False)
-        self._wallclock = time.time()
         self._midi_in.set_callback(self)
         self._timedout = False
         self._no_midi_timeout = None
 
     # Called as a callback by rtmidi
     def __call__(self, event, data=None):
+        started = time.perf_counter()
+        t = self._clock()
         message, deltatime = event
-        self._wallclock += deltatime
-
-        t = self._wallclock
         event_type = message[0]
-        log.debug("rtmidi message received: @%s: %s, delta=%f, data=%s", t, message, deltatime, data)
+        if self._on_first_event is not None:
+            on_first_event, self._on_first_event = self._on_first_event, None
+            on_first_event(t)
+        if len(message) == 3:
+            self._trace(TRACE_MIDI_IN, event_type, message[1] << 8 | message[2])
+        else:
+            self._trace(TRACE_MIDI_IN, event_type, message[1] << 8 if len(message) == 2 else 0)
 
-        if event_type != ACTIVE_SENSING:
-            self._recorder.record_raw_event(t, message, deltatime, data)
+        # Recording happens on the Recorder thread, which drains this ring in batches.
+        if event_type != ACTIVE_SENSING and self._ingest is not None:
+            self._ingest(t, message, deltatime)
 
         if event_type == NOTE_ON:
             self.note_on(t, message[1], message[2], deltatime)
@@ -47,7 +69,8 @@ class Keyboard(object):
         elif event_type == ACTIVE_SENSING:
             self._on_active_sense()
         else:
-            print("Unrecognized message: %s" % message)
+            self._trace(TRACE_UNRECOGNIZED, event_type, len(message))
+        self._callback_duration.observe(time.perf_counter() - started)
 
     def _on_active_sense(self):
         if self._no_midi_timeout is None:
@@ -63,49 +86,30 @@ class Keyboard(object):
         self._timedout = False
 
     def connection_timeout(self):
+        self._trace(TRACE_ACTIVE_SENSE_TIMEOUT, ACTIVE_SENSE_TIMEOUT)
         self._timedout = True
 
     def is_note_active(self, note):
-        return self._active_notes[note] is not None and self._active_notes_velocity[note] is not None
-
-    def check_hotkeys(self, note):
-        if note in self._special_keys:
-            for cmd in self._commands:
-                combo = cmd['combo']
-                if all(self.is_note_active(x) for x in combo):
-                    for x in combo:
-                        self._active_hotkey[x] = True
-                    fn = cmd['fn']
-                    fn()
-                    break
+        return self._hotkeys.is_active(note)
 
     def control_change(self, t, note, velocity, deltatime):
-        if self._recorder:
-            self._recorder.record_event("control_change", note, velocity, t, deltatime)
+        if self._roll is not None:
+            self._roll.controller(note, velocity)
 
     def note_on(self, t, note, velocity, deltatime):
         self._active_notes[note] = t
         self._active_notes_velocity[note] = velocity
-        self.check_hotkeys(note)
-
-        if self._recorder:
-            self._recorder.record_event("note_on", note, velocity, t, deltatime)
+        self._hotkeys.note_on(note, t)
+        if self._roll is not None:
+            self._roll.note(note, velocity)
 
     def note_off(self, t, note, velocity, deltatime):
         if not self.is_note_active(note):
-            print("guard fail: %s note wasn't active when note off" % note)
-
-        if self._recorder:
-            self._recorder.record_event("note_off", note, velocity, t, deltatime)
+            self._trace(TRACE_NOTE_OFF_INACTIVE, note, velocity)
 
-        start_time = self._active_notes[note]
-        # initial_velocity = self._active_notes_velocity[note]
         self._active_notes[note] = None
         self._active_notes_velocity[note] = None
-
-        if self._active_hotkey[note]:
-            self._active_hotkey[note] = False
-        # else:
-        #     duration = t - start_time
-        # if self._recorder:
-        #     self._recorder.record_note(note, velocity, duration, start_time)
+        # Note durations are paired up by the Recorder's SessionStats.
+        self._hotkeys.note_off(note)
+        if self._roll is not None:
+            self._roll.note(note, 0)
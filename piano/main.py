@@ -1,20 +1,42 @@
 #!/usr/bin/env python
 
-import json
 import logging
 import os
-from base64 import b64decode
 
+import flight_recorder
+import startup
+from archive import Archive, DEFAULT_ARCHIVE_PATH
+from metrics import MetricsServer, DEFAULT_METRICS_PORT, DEFAULT_DUMP_INTERVAL
 from pianobot import Pianobot
+from piano_roll import PianoRollFeed, DEFAULT_ROLL_PORT
 from publisher import Publisher
+from recorder import SEGMENT_MAX_SECONDS
 
-MIDI_PORT_NAME = os.environ["MIDI_PORT_NAME"]
+# One or more comma-separated MIDI port names, each served as its own keyboard.
+MIDI_PORT_NAMES = [name.strip() for name in os.environ["MIDI_PORT_NAME"].split(",") if name.strip()]
 SLACK_CHANNEL_PUBLIC = os.environ["SLACK_CHANNEL_PUBLIC"]
 SLACK_CHANNEL_PRIVATE = os.environ["SLACK_CHANNEL_PRIVATE"]
 SLACK_API_TOKEN = os.environ["SLACK_API_TOKEN"]
-GOOGLE_CREDENTIALS_JSON_STRING = json.loads(b64decode(os.environ["GOOGLE_CREDENTIALS_JSON"]))
+# Base64-encoded service account key, decoded by the publisher thread.
+GOOGLE_CREDENTIALS_JSON_STRING = os.environ["GOOGLE_CREDENTIALS_JSON"]
 GOOGLE_FOLDER_ID = os.environ["GOOGLE_FOLDER_ID"]
 SOUNDFONT_PATH = os.environ["SOUNDFONT_PATH"]
+AUDIO_FORMATS = os.environ.get("AUDIO_FORMATS", "flac").split(",")
+RAW_DATA_FORMATS = os.environ.get("RAW_DATA_FORMATS", "events").split(",")
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH")
+RECORDING_JOURNAL_PATH = os.environ.get("RECORDING_JOURNAL_PATH")
+# Publish sessions longer than this many seconds in segments, e.g. SEGMENT_SECONDS=600; off by default.
+SEGMENT_SECONDS = float(os.environ.get("SEGMENT_SECONDS", SEGMENT_MAX_SECONDS))
+# Prometheus metrics on localhost; METRICS_PORT=0 turns the endpoint off.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", DEFAULT_METRICS_PORT)) or None
+METRICS_DUMP_PATH = os.environ.get("METRICS_DUMP_PATH")
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", DEFAULT_DUMP_INTERVAL))
+FLIGHT_RECORDER_DIR = os.environ.get("FLIGHT_RECORDER_DIR")
+# Live piano-roll WebSocket feed for the display on localhost; ROLL_PORT=0 turns it off.
+ROLL_PORT = int(os.environ.get("ROLL_PORT", DEFAULT_ROLL_PORT))
+# Local SQLite index of sessions, for `python archive.py search|similar`.
+ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", DEFAULT_ARCHIVE_PATH)
+RENDER_WORKERS = int(os.environ["RENDER_WORKERS"]) if "RENDER_WORKERS" in os.environ else None
 
 if os.environ.get("DEBUG", False):
     logging.basicConfig(level=logging.DEBUG)
@@ -22,6 +44,17 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 if __name__ == "__main__":
+    startup.reached("imported")
+    # `kill -USR1` dumps the flight recorder; so does GET /trace on the metrics port.
+    if FLIGHT_RECORDER_DIR:
+        flight_recorder.TRACE.directory = FLIGHT_RECORDER_DIR
+    flight_recorder.install_signal_handler()
+    metrics = MetricsServer(port=METRICS_PORT, dump_path=METRICS_DUMP_PATH, dump_interval=METRICS_DUMP_INTERVAL)
+    metrics.start()
+    startup.reached("metrics")
+    roll = PianoRollFeed(port=ROLL_PORT) if ROLL_PORT else None
+    if roll is not None:
+        roll.start()
     try:
         publisher = Publisher(
             soundfont_path=SOUNDFONT_PATH,
@@ -29,14 +62,30 @@ if __name__ == "__main__":
             slack_channel_public=SLACK_CHANNEL_PUBLIC,
             slack_channel_private=SLACK_CHANNEL_PRIVATE,
             google_credentials_json=GOOGLE_CREDENTIALS_JSON_STRING,
-            google_folder_id=GOOGLE_FOLDER_ID
+            google_folder_id=GOOGLE_FOLDER_ID,
+            render_workers=RENDER_WORKERS,
+            audio_formats=AUDIO_FORMATS,
+            raw_data_formats=RAW_DATA_FORMATS,
+            outbox_path=OUTBOX_PATH
         )
         publisher.start()
+        startup.reached("publisher")
+        archive = Archive(ARCHIVE_PATH)
 
         pianobot = Pianobot(
-            port_name=MIDI_PORT_NAME,
-            publisher=publisher
+            port_names=MIDI_PORT_NAMES,
+            publisher=publisher,
+            segment_seconds=SEGMENT_SECONDS,
+            journal_path=RECORDING_JOURNAL_PATH,
+            roll=roll,
+            archive=archive
         )
         pianobot.run()
+    except Exception:
+        flight_recorder.TRACE.dump("crash")
+        raise
     finally:
         publisher.shutdown()
+        if roll is not None:
+            roll.shutdown()
+        metrics.shutdown()
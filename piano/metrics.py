@@ -0,0 +1,255 @@
+import io
+import json
+import logging
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread, Lock, Event
+from typing import Callable, Dict, List, Optional, Tuple
+
+import flight_recorder
+
+log = logging.getLogger('pianobot')
+
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+DEFAULT_METRICS_PORT = 9464
+DEFAULT_DUMP_INTERVAL = 60
+
+
+class _Value(object):
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the value from `function` whenever metrics are collected."""
+        self.function = function
+
+    def samples(self, name: str, labels: str):
+        yield name, labels, self.function() if self.function is not None else self.value
+
+
+class _Counter(_Value):
+    __slots__ = ()
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+
+class _Gauge(_Value):
+    __slots__ = ()
+
+    def set(self, value) -> None:
+        self.value = value
+
+
+class _Histogram(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield name + "_bucket", _join_labels(labels, 'le="%g"' % bound), cumulative
+        yield name + "_bucket", _join_labels(labels, 'le="+Inf"'), self.count
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+class Metric(object):
+    """
+    A named metric with a fixed set of label names. labels(*values) returns
+    the child for one combination of label values; look it up once and keep
+    it to keep the label lookup off hot paths. A metric without labels can
+    be updated directly.
+    """
+
+    def __init__(self, kind: str, name: str, help: str, label_names: Tuple[str, ...], factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._factory = factory
+        self._children: Dict[tuple, object] = {}
+        self._lock = Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._factory()
+        return child
+
+    def __getattr__(self, name):
+        if name.startswith("_") or self.label_names:
+            raise AttributeError(name)
+        return getattr(self.labels(), name)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            labels = ",".join('%s="%s"' % (name, _escape(str(value)))
+                              for name, value in zip(self.label_names, values))
+            for sample in child.samples(self.name, labels):
+                yield sample
+
+
+class Registry(object):
+    """
+    Counters, gauges and histograms for the whole process.
+
+    Updates are plain attribute increments with no locking; two threads
+    updating the same child at the same instant can, rarely, lose a count,
+    which is an acceptable price for keeping them cheap.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = Lock()
+
+    def _get(self, kind: str, name: str, help: str, label_names, factory) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Metric(kind, name, help, tuple(label_names), factory)
+            return metric
+
+    def counter(self, name: str, help: str, label_names=()) -> Metric:
+        return self._get("counter", name, help, label_names, _Counter)
+
+    def gauge(self, name: str, help: str, label_names=()) -> Metric:
+        return self._get("gauge", name, help, label_names, _Gauge)
+
+    def histogram(self, name: str, help: str, label_names=(), buckets=LATENCY_BUCKETS) -> Metric:
+        return self._get("histogram", name, help, label_names, lambda: _Histogram(buckets))
+
+    def collect(self) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def exposition(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.collect():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s{%s} %s" % (name, labels, _format_value(value)) if labels else
+                             "%s %s" % (name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, float]:
+        return {"%s{%s}" % (name, labels) if labels else name: value
+                for metric in self.collect() for name, labels, value in metric.samples()}
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+QUEUE_WAIT = histogram("pianobot_queue_wait_seconds", "Time from enqueueing an actor call to running it.",
+                       ("actor", "method"))
+HANDLER_DURATION = histogram("pianobot_handler_seconds", "Time spent running an actor call.", ("actor", "method"))
+QUEUE_DEPTH = gauge("pianobot_queue_depth", "Items waiting in a queue.", ("queue",))
+
+
+def _join_labels(labels: str, extra: str) -> str:
+    return labels + "," + extra if labels else extra
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/trace":
+            out = io.BytesIO()
+            flight_recorder.TRACE.write_to(out)
+            body = out.getvalue()
+            content_type = "application/octet-stream"
+        elif path in ("/", "/metrics"):
+            body = self.server.registry.exposition().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(Thread):
+    """
+    Serves the registry as Prometheus text on http://<host>:<port>/metrics and
+    a flight recorder dump on /trace. If `dump_path` is set, it also appends a JSON snapshot to that file every
+    `dump_interval` seconds for offline analysis.
+    """
+
+    def __init__(self, port: int = DEFAULT_METRICS_PORT, host: str = "127.0.0.1", dump_path: Optional[str] = None,
+                 dump_interval: float = DEFAULT_DUMP_INTERVAL, registry: Registry = REGISTRY):
+        Thread.__init__(self, name="metrics", daemon=True)
+        self._server = HTTPServer((host, port), _Handler) if port is not None else None
+        if self._server is not None:
+            self._server.registry = registry
+        self._dump_path = dump_path
+        self._dump_interval = dump_interval
+        self._registry = registry
+        self._serving = False
+        self._stopped = Event()
+
+    @property
+    def port(self) -> Optional[int]:
+        return self._server.server_address[1] if self._server is not None else None
+
+    def run(self) -> None:
+        if self._server is not None:
+            self._serving = True
+            Thread(target=self._server.serve_forever, name="metrics_http", daemon=True).start()
+            log.info("serving metrics on http://%s:%d/metrics", *self._server.server_address)
+        while self._dump_path and not self._stopped.wait(self._dump_interval):
+            self.dump()
+
+    def dump(self) -> None:
+        record = json.dumps({"time": time.time(), "metrics": self._registry.snapshot()}, separators=(",", ":"))
+        try:
+            with open(self._dump_path, "a") as f:
+                f.write(record + "\n")
+        except OSError as e:
+            log.warning("metrics: could not write %s: %s", self._dump_path, e)
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        if self._dump_path:
+            self.dump()
+        if self._serving:
+            self._server.shutdown()
+        if self._server is not None:
+            self._server.server_close()
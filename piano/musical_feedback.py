@@ -1,56 +1,38 @@
-import time
-from queue import Queue
-from threading import Thread
-from typing import List
+from typing import List, Optional
 
-from rtmidi.midiconstants import NOTE_ON, NOTE_OFF  # type: ignore
+from sequencer import OutputSequencer, notes_phrase, chords_phrase
 
-from publisher import queued
 
+class MusicalFeedback(object):
+    """
+    Plays short phrases on the keyboard to acknowledge commands. Phrases are
+    scheduled on an OutputSequencer, so callers never block and a new sound
+    cuts off the one still playing.
+    """
 
-class MusicalFeedback(Thread):
-    def __init__(self, out):
-        Thread.__init__(self)
-        self._out = out
-        self._queue = Queue()
+    def __init__(self, out, name: Optional[str] = None):
+        self._sequencer = OutputSequencer(out, name="musical_feedback/%s" % name if name else "musical_feedback")
 
-    def run(self):
-        while True:
-            item = self._queue.get()
-            if item is None:
-                self._queue.task_done()
-                break
-            else:
-                f = getattr(self, item[0])
-                f.underlying_method(self, *item[1], **item[2])
-                self._queue.task_done()
+    def start(self):
+        self._sequencer.start()
 
     def shutdown(self):
-        self._queue.put(None)
+        self._sequencer.shutdown()
 
-    def _chord(self, notes: List[int], duration_in_secs: float):
-        for note in notes:
-            self._out.send_message([NOTE_ON, note, 112])
-        time.sleep(duration_in_secs)
-        for note in notes:
-            self._out.send_message([NOTE_OFF, note, 0])
+    def set_output(self, out):
+        self._sequencer.set_output(out)
+
+    def _chords(self, chords: List[List[int]], duration_in_secs: float):
+        self._sequencer.play(chords_phrase(chords, duration_in_secs, 112))
 
     def _play_notes(self, notes: List[int], duration_in_secs: float, velocity: int):
-        for note in notes:
-            self._out.send_message([NOTE_ON, note, velocity])
-            time.sleep(duration_in_secs)
-            self._out.send_message([NOTE_OFF, note, velocity])
+        self._sequencer.play(notes_phrase(notes, duration_in_secs, velocity))
 
-    @queued
     def sad_sound(self):
         self._play_notes([60, 60, 59, 59, 58, 58, 57, 57], 0.1, 120)
 
-    @queued
     def happy_sound(self):
         self._play_notes([100, 100, 101, 101, 102, 102, 103, 103], 0.1, 120)
 
-    @queued
     def happy_chords(self):
-        self._chord([60, 64, 67], 0.5)
-        self._chord([61, 65, 68], 0.5)
-        self._chord([60, 64, 67], 0.5)
+        self._chords([[60, 64, 67], [61, 65, 68], [60, 64, 67]], 0.5)
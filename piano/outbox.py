@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional
+
+log = logging.getLogger('pianobot')
+
+JOURNAL_NAME = "journal.log"
+ARTIFACTS_DIR = "artifacts"
+STATE_DIR = "state"
+# Rewrite the journal once it holds this many records for finished jobs.
+COMPACT_AFTER = 500
+# Ids of finished jobs remembered (and kept across compaction) to reject duplicates.
+REMEMBER_DONE = 1000
+
+
+def job_id(*parts: str) -> str:
+    """Idempotency key for a job: the same parts always give the same id."""
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+
+class Outbox(object):
+    """
+    Durable queue of publishing jobs.
+
+    Jobs are JSON records appended (and fsynced) to a journal. The files they
+    upload live next to it under artifacts/. Replaying the journal on startup
+    gives back every job that was added but never completed, so nothing
+    accepted by Publisher is lost if the process exits or the network is down.
+    A torn last line from a crash mid-append is ignored.
+
+    Each job has an id that doubles as its idempotency key: adding a job
+    whose id is pending or recently completed is a no-op.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._artifacts = os.path.join(path, ARTIFACTS_DIR)
+        os.makedirs(self._artifacts, exist_ok=True)
+        self._state = os.path.join(path, STATE_DIR)
+        os.makedirs(self._state, exist_ok=True)
+        self._journal_path = os.path.join(path, JOURNAL_NAME)
+        self._lock = Lock()
+        self._pending: Dict[str, dict] = OrderedDict()
+        self._attempts: Dict[str, int] = {}
+        self._done: Dict[str, bool] = OrderedDict()
+        self._garbage = 0
+        # Artifacts stored for jobs that haven't been added yet.
+        self._reserved = set()
+        self._replay()
+        self._collect_artifacts(startup=True)
+        self._journal = open(self._journal_path, "a")
+
+    def _replay(self) -> None:
+        if not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning("outbox: ignoring unreadable journal record %r", line[:80])
+                    continue
+                op = record.get("op")
+                if op == "add":
+                    job = record["job"]
+                    if job["id"] not in self._done:
+                        self._pending[job["id"]] = job
+                elif op == "retry":
+                    self._attempts[record["id"]] = record["attempts"]
+                    self._garbage += 1
+                elif op == "done":
+                    self._pending.pop(record["id"], None)
+                    self._attempts.pop(record["id"], None)
+                    self._remember_done(record["id"])
+                    self._garbage += 1
+        if self._pending:
+            log.info("outbox: %d unfinished jobs replayed from %s", len(self._pending), self._journal_path)
+        self._compact()
+
+    def _append(self, record: dict) -> None:
+        self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _remember_done(self, id: str) -> None:
+        self._done[id] = True
+        while len(self._done) > REMEMBER_DONE:
+            self._done.popitem(last=False)
+
+    def _compact(self) -> None:
+        if self._garbage < COMPACT_AFTER:
+            return
+        compacted = self._journal_path + ".compact"
+        with open(compacted, "w") as journal:
+            for id in self._done:
+                journal.write(json.dumps({"op": "done", "id": id}, separators=(",", ":")) + "\n")
+            for job in self._pending.values():
+                journal.write(json.dumps({"op": "add", "job": job}, separators=(",", ":")) + "\n")
+                if job["id"] in self._attempts:
+                    journal.write(json.dumps({"op": "retry", "id": job["id"], "attempts": self._attempts[job["id"]]},
+                                             separators=(",", ":")) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(compacted, self._journal_path)
+        if hasattr(self, "_journal"):
+            self._journal.close()
+            self._journal = open(self._journal_path, "a")
+        self._garbage = 0
+        self._collect_artifacts()
+
+    def _collect_artifacts(self, startup: bool = False) -> None:
+        referenced = set(self._reserved)
+        for job in self._pending.values():
+            referenced.update(job.get("artifacts", []))
+        for name in os.listdir(self._artifacts):
+            path = os.path.join(self._artifacts, name)
+            # Partial files belong to writes in progress, unless we just started.
+            if path not in referenced and (startup or not name.endswith(".partial")):
+                os.remove(path)
+        if startup:
+            for name in os.listdir(self._state):
+                if name.split(".")[0] not in self._pending:
+                    os.remove(os.path.join(self._state, name))
+
+    def artifact_path(self, name: str) -> str:
+        return os.path.join(self._artifacts, os.path.basename(name))
+
+    def state_path(self, id: str) -> str:
+        """Where job `id` can keep state across attempts and restarts; removed when it completes."""
+        return os.path.join(self._state, id + ".json")
+
+    def put_artifact(self, name: str, data) -> str:
+        """
+        Durably store `data` as artifact `name` and return its path. `data` is
+        bytes, a file object, or anything with a write_to(fileobj) method.
+        """
+        path = self.artifact_path(name)
+        partial = path + ".partial"
+        with open(partial, "wb") as f:
+            if hasattr(data, "write_to"):
+                data.write_to(f)
+            elif hasattr(data, "read"):
+                data.seek(0)
+                shutil.copyfileobj(data, f)
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._reserved.add(path)
+            os.replace(partial, path)
+        return path
+
+    def commit_artifact(self, partial_path: str) -> str:
+        """Make a fully written `<name>.partial` file under artifacts/ durable as `<name>`."""
+        path = partial_path[:-len(".partial")]
+        with open(partial_path, "rb+") as f:
+            os.fsync(f.fileno())
+        with self._lock:
+            self._reserved.add(path)
+            os.replace(partial_path, path)
+        return path
+
+    def add(self, job: dict) -> bool:
+        with self._lock:
+            self._reserved.difference_update(job.get("artifacts", []))
+            if job["id"] in self._pending or job["id"] in self._done:
+                return False
+            self._append({"op": "add", "job": job})
+            self._pending[job["id"]] = job
+            return True
+
+    def retry(self, id: str) -> int:
+        """Records a failed attempt at job `id`; returns the number of attempts so far."""
+        with self._lock:
+            attempts = self._attempts.get(id, 0) + 1
+            self._attempts[id] = attempts
+            self._append({"op": "retry", "id": id, "attempts": attempts})
+            self._garbage += 1
+            return attempts
+
+    def attempts(self, id: str) -> int:
+        return self._attempts.get(id, 0)
+
+    def complete(self, id: str) -> None:
+        with self._lock:
+            if self._pending.pop(id, None) is None:
+                return
+            self._attempts.pop(id, None)
+            self._append({"op": "done", "id": id})
+            if os.path.exists(self.state_path(id)):
+                os.remove(self.state_path(id))
+            self._remember_done(id)
+            self._garbage += 1
+            if self._garbage >= COMPACT_AFTER:
+                self._compact()
+            elif not self._pending:
+                self._collect_artifacts()
+
+    def get(self, id: str) -> Optional[dict]:
+        return self._pending.get(id)
+
+    def pending(self) -> List[dict]:
+        with self._lock:
+            return list(self._pending.values())
+
+    def close(self) -> None:
+        with self._lock:
+            self._journal.close()
@@ -0,0 +1,410 @@
+import base64
+import hashlib
+import logging
+import selectors
+import socket
+import struct
+import time
+from collections import deque
+from threading import Thread, Lock
+from typing import Dict, List, Optional
+
+from metrics import counter, gauge
+
+log = logging.getLogger('pianobot')
+
+DEFAULT_ROLL_PORT = 9465
+MAX_FPS = 60
+MAX_CLIENTS = 16
+# A client with this many frames still unsent has them dropped and gets a
+# keyframe once it catches up; one that makes no progress for
+# SLOW_CLIENT_TIMEOUT seconds is disconnected.
+MAX_PENDING_FRAMES = 8
+SLOW_CLIENT_TIMEOUT = 10.0
+# Kept small so a lagging viewer's backlog is dropped here rather than
+# buffered by the kernel, where it would show up as seconds of display lag.
+SEND_BUFFER_BYTES = 16 * 1024
+MAX_REQUEST_BYTES = 8192
+
+NOTES = 128
+# Pedal controllers follow the notes in each source's state.
+PEDALS = (64, 66, 67)  # sustain, sostenuto, soft
+PEDAL_INDEX = {controller: NOTES + i for i, controller in enumerate(PEDALS)}
+ENTRIES = NOTES + len(PEDALS)
+
+# Frames are binary WebSocket messages: a header of kind, source index,
+# sequence number, milliseconds since the feed started and entry count,
+# followed by (index, value, flags) byte triples. Indexes below 128 are notes
+# with their velocity as the value, then the pedals in PEDALS order.
+# A keyframe lists every non-zero entry of a source; a delta lists the
+# entries that changed since the previous frame.
+FRAME_HEADER = struct.Struct("<BBIIH")
+KEYFRAME = 1
+DELTA = 2
+REMOVED = 3
+# Set on a note struck again since the previous frame, even if it has already been released.
+FLAG_STRUCK = 1
+
+_WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_OP_CLOSE = 0x8
+_OP_PING = 0x9
+_OP_PONG = 0xA
+
+ROLL_CLIENTS = gauge("pianobot_roll_clients", "Piano-roll viewers connected.")
+ROLL_FRAMES = counter("pianobot_roll_frames_total", "Piano-roll frames encoded.", ("kind",))
+ROLL_FRAMES_DROPPED = counter("pianobot_roll_frames_dropped_total", "Piano-roll frames dropped for slow viewers.")
+ROLL_BYTES = counter("pianobot_roll_sent_bytes_total", "Bytes sent to piano-roll viewers.")
+
+
+class RollSource(object):
+    """
+    Key and pedal state of one keyboard. Only its MIDI callback writes to it,
+    one byte per event; the feed thread reads it when building a frame.
+    """
+    __slots__ = ("index", "values", "strikes")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.values = bytearray(ENTRIES)
+        self.strikes = bytearray(ENTRIES)
+
+    def note(self, note: int, velocity: int) -> None:
+        self.values[note] = velocity
+        if velocity:
+            self.strikes[note] = (self.strikes[note] + 1) & 0xFF
+
+    def controller(self, controller: int, value: int) -> None:
+        index = PEDAL_INDEX.get(controller)
+        if index is not None:
+            self.values[index] = value
+
+    def clear(self) -> None:
+        self.values[:] = bytes(ENTRIES)
+
+
+def _ws_frame(payload: bytes, opcode: int = 0x2) -> bytes:
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _frame(kind: int, source: int, sequence: int, ms: int, entries: bytes) -> bytes:
+    return _ws_frame(FRAME_HEADER.pack(kind, source, sequence & 0xFFFFFFFF, ms & 0xFFFFFFFF, len(entries) // 3) +
+                     entries)
+
+
+class _Client(object):
+    __slots__ = ("sock", "address", "inbuf", "upgraded", "pending", "out", "needs_keyframe", "progressed",
+                 "closing", "writing")
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = b""
+        self.upgraded = False
+        self.pending: deque = deque()
+        self.out: Optional[memoryview] = None
+        self.needs_keyframe = False
+        # When the client last took data or had nothing waiting.
+        self.progressed = time.monotonic()
+        self.closing = False
+        self.writing = False
+
+
+class PianoRollFeed(Thread):
+    """
+    Streams the note and pedal state of every keyboard to piano-roll viewers
+    over WebSocket on localhost.
+
+    MIDI callbacks only write into their RollSource. This thread compares the
+    sources with what it last sent at most MAX_FPS times a second, encodes the
+    differences once as a delta frame and queues the same bytes for every
+    viewer, so however fast someone plays, viewers cost the callback nothing
+    and get at most MAX_FPS small frames a second. With no viewers connected
+    the sources aren't read at all.
+
+    Sockets are non-blocking. A viewer that falls MAX_PENDING_FRAMES behind
+    has its backlog dropped and is sent a keyframe once its socket drains.
+    """
+
+    def __init__(self, port: int = DEFAULT_ROLL_PORT, host: str = "127.0.0.1", max_fps: float = MAX_FPS):
+        Thread.__init__(self, name="piano_roll", daemon=True)
+        self._interval = 1.0 / max_fps
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(MAX_CLIENTS)
+        self._listener.setblocking(False)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._clients: Dict[socket.socket, _Client] = {}
+        self._sources: List[Optional[RollSource]] = []
+        self._sent: Dict[int, tuple] = {}
+        self._removed: List[int] = []
+        self._lock = Lock()
+        self._sequence = 0
+        self._epoch = time.monotonic()
+        self._stopped = False
+
+    @property
+    def port(self) -> int:
+        return self._listener.getsockname()[1]
+
+    def add_source(self) -> RollSource:
+        with self._lock:
+            index = len(self._sources)
+            for i, source in enumerate(self._sources):
+                if source is None:
+                    index = i
+                    break
+            else:
+                self._sources.append(None)
+            source = self._sources[index] = RollSource(index)
+            return source
+
+    def remove_source(self, source: RollSource) -> None:
+        with self._lock:
+            if self._sources[source.index] is source:
+                self._sources[source.index] = None
+                self._removed.append(source.index)
+
+    def shutdown(self) -> None:
+        self._stopped = True
+        self._wakeup_w.send(b"x")
+
+    def run(self) -> None:
+        log.info("serving the piano roll on ws://%s:%d/", *self._listener.getsockname())
+        next_frame = time.monotonic()
+        try:
+            while not self._stopped:
+                if self._clients:
+                    timeout = max(0.0, next_frame - time.monotonic())
+                else:
+                    timeout = None
+                for key, events in self._selector.select(timeout):
+                    sock = key.fileobj
+                    if sock is self._listener:
+                        self._accept()
+                    elif sock is self._wakeup_r:
+                        self._wakeup_r.recv(64)
+                    else:
+                        client = self._clients.get(sock)
+                        if client is None:
+                            continue
+                        if events & selectors.EVENT_READ:
+                            self._read(client)
+                        if events & selectors.EVENT_WRITE and client.sock in self._clients:
+                            self._flush(client)
+                now = time.monotonic()
+                if now >= next_frame:
+                    if self._clients:
+                        self._publish(now)
+                    next_frame = max(next_frame + self._interval, now)
+        finally:
+            for client in list(self._clients.values()):
+                self._drop(client)
+            self._selector.close()
+            self._listener.close()
+            self._wakeup_r.close()
+            self._wakeup_w.close()
+
+    def _accept(self) -> None:
+        try:
+            sock, address = self._listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(self._clients) >= MAX_CLIENTS:
+            sock.close()
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        self._clients[sock] = _Client(sock, address)
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def _read(self, client: _Client) -> None:
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(client)
+            return
+        client.inbuf += data
+        if len(client.inbuf) > MAX_REQUEST_BYTES:
+            self._drop(client)
+        elif not client.upgraded:
+            self._handshake(client)
+        else:
+            self._control_frames(client)
+
+    def _handshake(self, client: _Client) -> None:
+        end = client.inbuf.find(b"\r\n\r\n")
+        if end < 0:
+            return
+        request, client.inbuf = client.inbuf[:end], client.inbuf[end + 4:]
+        headers = {}
+        for line in request.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get(b"sec-websocket-key")
+        if key is None or b"websocket" not in headers.get(b"upgrade", b"").lower():
+            client.closing = True
+            self._send(client, b"HTTP/1.1 426 Upgrade Required\r\nUpgrade: websocket\r\nContent-Length: 0\r\n"
+                               b"Connection: close\r\n\r\n")
+            return
+        accept = base64.b64encode(hashlib.sha1(key + _WEBSOCKET_GUID).digest())
+        self._send(client, b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                           b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        client.upgraded = True
+        ROLL_CLIENTS.set(sum(1 for c in self._clients.values() if c.upgraded))
+        log.info("piano roll: viewer connected from %s:%d", *client.address[:2])
+        for frame in self._keyframes():
+            self._send(client, frame)
+
+    def _control_frames(self, client: _Client) -> None:
+        # Viewers only ever need to send close and ping; everything else is read and ignored.
+        buf = client.inbuf
+        while len(buf) >= 2:
+            opcode = buf[0] & 0x0F
+            length = buf[1] & 0x7F
+            offset = 2
+            if length == 126:
+                if len(buf) < 4:
+                    break
+                length, = struct.unpack("!H", buf[2:4])
+                offset = 4
+            elif length == 127:
+                if len(buf) < 10:
+                    break
+                length, = struct.unpack("!Q", buf[2:10])
+                offset = 10
+            masked = buf[1] & 0x80
+            if len(buf) < offset + (4 if masked else 0) + length:
+                break
+            payload = buf[offset + (4 if masked else 0):offset + (4 if masked else 0) + length]
+            if masked:
+                mask = buf[offset:offset + 4]
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+            buf = buf[offset + (4 if masked else 0) + length:]
+            if opcode == _OP_CLOSE:
+                client.closing = True
+                client.inbuf = b""
+                self._send(client, _ws_frame(b"", _OP_CLOSE))
+                return
+            elif opcode == _OP_PING:
+                self._send(client, _ws_frame(payload, _OP_PONG))
+        client.inbuf = buf
+
+    def _keyframes(self) -> List[bytes]:
+        ms = int((time.monotonic() - self._epoch) * 1000)
+        frames = []
+        with self._lock:
+            sources = [source for source in self._sources if source is not None]
+        for source in sources:
+            values = self._sent.get(source.index, (bytes(ENTRIES), None))[0]
+            entries = bytearray()
+            for index, value in enumerate(values):
+                if value:
+                    entries += bytes((index, value, 0))
+            frames.append(_frame(KEYFRAME, source.index, self._sequence, ms, bytes(entries)))
+            ROLL_FRAMES.labels("keyframe").inc()
+        return frames
+
+    def _publish(self, now: float) -> None:
+        ms = int((now - self._epoch) * 1000)
+        with self._lock:
+            sources = [source for source in self._sources if source is not None]
+            removed, self._removed = self._removed, []
+        frames = []
+        for index in removed:
+            self._sent.pop(index, None)
+            self._sequence += 1
+            frames.append(_frame(REMOVED, index, self._sequence, ms, b""))
+        for source in sources:
+            values = bytes(source.values)
+            strikes = bytes(source.strikes)
+            sent = self._sent.get(source.index)
+            if sent is None:
+                sent = (bytes(ENTRIES), strikes)
+            if values == sent[0] and strikes == sent[1]:
+                continue
+            entries = bytearray()
+            for index in range(ENTRIES):
+                struck = strikes[index] != sent[1][index]
+                if struck or values[index] != sent[0][index]:
+                    entries += bytes((index, values[index], FLAG_STRUCK if struck else 0))
+            self._sent[source.index] = (values, strikes)
+            self._sequence += 1
+            frames.append(_frame(DELTA, source.index, self._sequence, ms, bytes(entries)))
+            ROLL_FRAMES.labels("delta").inc()
+        for client in list(self._clients.values()):
+            if not client.upgraded or client.closing:
+                continue
+            if now - client.progressed > SLOW_CLIENT_TIMEOUT and (client.out is not None or client.pending):
+                log.warning("piano roll: dropping viewer %s:%d, stalled for %.0fs", client.address[0],
+                            client.address[1], now - client.progressed)
+                self._drop(client)
+                continue
+            for frame in frames:
+                if len(client.pending) >= MAX_PENDING_FRAMES:
+                    ROLL_FRAMES_DROPPED.inc(len(client.pending))
+                    client.pending.clear()
+                    client.needs_keyframe = True
+                if not client.needs_keyframe:
+                    client.pending.append(frame)
+            self._flush(client)
+
+    def _send(self, client: _Client, data: bytes) -> None:
+        client.pending.append(data)
+        self._flush(client)
+
+    def _flush(self, client: _Client) -> None:
+        sock = client.sock
+        while True:
+            if client.out is None:
+                if not client.pending:
+                    if client.needs_keyframe:
+                        client.needs_keyframe = False
+                        client.pending.extend(self._keyframes())
+                        continue
+                    break
+                client.out = memoryview(client.pending.popleft())
+            try:
+                sent = sock.send(client.out)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self._drop(client)
+                return
+            ROLL_BYTES.inc(sent)
+            client.progressed = time.monotonic()
+            client.out = client.out[sent:] if sent < len(client.out) else None
+        if client.closing and client.out is None and not client.pending:
+            self._drop(client)
+            return
+        waiting = client.out is not None or bool(client.pending)
+        if not waiting:
+            client.progressed = time.monotonic()
+        if waiting != client.writing:
+            client.writing = waiting
+            self._selector.modify(sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if waiting else 0))
+
+    def _drop(self, client: _Client) -> None:
+        if self._clients.pop(client.sock, None) is None:
+            return
+        self._selector.unregister(client.sock)
+        client.sock.close()
+        if client.upgraded:
+            log.info("piano roll: viewer %s:%d disconnected", *client.address[:2])
+        ROLL_CLIENTS.set(sum(1 for c in self._clients.values() if c.upgraded))
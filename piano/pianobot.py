@@ -1,75 +1,257 @@
 import logging
+import os
+import re
 import time
+from threading import RLock
+from typing import Dict, List, Optional
 
-import rtmidi  # type: ignore
 from rtmidi.midiutil import open_midiport  # type: ignore
 
+import flight_recorder
+import startup
+from archive import Archive
+from device_watcher import DeviceWatcher
 from keyboard import Keyboard
+from metrics import histogram
 from musical_feedback import MusicalFeedback
+from piano_roll import PianoRollFeed
 from publisher import Publisher
-from recorder import Recorder
+from recorder import Recorder, SEGMENT_MAX_SECONDS, DEFAULT_JOURNAL_PATH
 
 log = logging.getLogger('pianobot')
 
+TIMEOUT_CHECK_INTERVAL = 1
 
-class Pianobot(object):
-    def __init__(self, port_name: str, publisher: Publisher):
-        self._port_name = port_name
-        self._publisher = publisher
+PLUG_TO_FIRST_EVENT = histogram("pianobot_midi_plug_to_first_event_seconds",
+                                "Time from a MIDI port appearing to the first message received from it.")
+
+
+class Instrument(object):
+    """
+    One keyboard on one MIDI port, with its own Keyboard, Recorder and
+    MusicalFeedback. Every instrument publishes through the Publisher it is
+    given, so sessions from all ports share one render pool and outbox.
+
+    The recorder and feedback outlive the port: disconnect() closes the MIDI
+    ports and keeps an interrupted session open, and connect() picks it up
+    again with freshly opened ones.
+    """
+
+    def __init__(self, port_name: str, publisher: Publisher, name: Optional[str] = None,
+                 segment_seconds: float = SEGMENT_MAX_SECONDS, journal_path: Optional[str] = None,
+                 roll: Optional[PianoRollFeed] = None, archive: Optional[Archive] = None):
+        self.port_name = port_name
+        self.name = name
         self._midi_in = None
         self._midi_out = None
+        self.feedback = MusicalFeedback(None, name=name)
+        self.recorder = Recorder(self.feedback, publisher, segment_seconds=segment_seconds,
+                                 journal_path=journal_path, name=name, archive=archive)
+        self.keyboard = None
+        self._was_connected = False
+        self._roll = roll
+        self.roll_source = roll.add_source() if roll is not None else None
 
-    def _open_midi(self):
-        try:
-            port_names = rtmidi.MidiIn().get_ports()
-            port_number = port_names.index(self._port_name)
-        except (ValueError, IOError) as e:
-            log.debug("_open_midi, port_names=%s, e=%s", port_names, e)
-            return False
-        try:
-            if self._midi_in is None:
-                self._midi_in, _ = open_midiport(port_number, "input", use_virtual=False, interactive=False)
-            if self._midi_out is None:
-                self._midi_out, _ = open_midiport(port_number, "output", use_virtual=False, interactive=False)
-        except IOError as e:
-            log.debug("_open_midi, port_number=%s, in=%s, out=%s, IOError=%s", self._port_number, self._midi_in is not None, self._midi_out is not None, e)
-            return False
-        return True
+    def start(self) -> None:
+        self.feedback.start()
+        self.recorder.start()
+        self.recorder.arm_recording()
 
-    def run(self):
-        log.info("Trying to connect to %s", self._port_name)
-        while not self._open_midi():
-            time.sleep(2)
-        log.info("Connected to %s", self._port_name)
+    @property
+    def connected(self) -> bool:
+        return self.keyboard is not None
 
-        musical_feedback = MusicalFeedback(self._midi_out)
-        musical_feedback.start()
+    def connect(self, midi_in, midi_out, detected: Optional[float] = None) -> None:
+        """Start taking events from `midi_in`; `detected` is when the port was seen to appear."""
+        self._midi_in = midi_in
+        self._midi_out = midi_out
+        self.feedback.set_output(midi_out)
+        recorder = self.recorder
 
-        recorder = Recorder(musical_feedback, self._publisher)
-        recorder.start()
+        def first_event(t):
+            startup.reached("first_event")
+            if detected is not None:
+                PLUG_TO_FIRST_EVENT.observe(time.monotonic() - detected)
 
-        keyboard = Keyboard(self._midi_in, [{
+        self.keyboard = Keyboard(midi_in, [{
             "combo": [105, 107, 108],
             "fn": lambda: recorder.arm_public()
         }, {
             "combo": [102, 104, 106],
             "fn": lambda: recorder.disarm_recording()
-        }], recorder)
+        }], recorder, on_first_event=first_event, roll=self.roll_source)
+        startup.reached("midi_open")
+        if self._was_connected:
+            recorder.reconnected()
+        self._was_connected = True
+
+    def disconnect(self) -> None:
+        if self.keyboard is None:
+            return
+        self.keyboard.shutdown()
+        self.keyboard = None
+        if self.roll_source is not None:
+            self.roll_source.clear()
+        self.feedback.set_output(None)
+        self._midi_in.close_port()
+        self._midi_out.close_port()
+        self._midi_in = None
+        self._midi_out = None
+        self.recorder.disconnected()
+
+    @property
+    def timed_out(self) -> bool:
+        return self.keyboard is not None and self.keyboard._timedout
+
+    def shutdown(self) -> None:
+        self.disconnect()
+        if self.roll_source is not None:
+            self._roll.remove_source(self.roll_source)
+        self.feedback.shutdown()
+        self.recorder.shutdown()
+
+
+class Pianobot(object):
+    """
+    Serves a set of MIDI ports, each as an Instrument of its own, all
+    publishing through one Publisher. add_port() and remove_port() change the
+    set while running without touching the other instruments; run() returns
+    once none are left.
 
-        recorder.arm_recording()
+    A DeviceWatcher reports ports appearing and disappearing. An instrument
+    whose port goes away, or whose active sensing times out, is disconnected in
+    place and reconnected as soon as the port is listed again, keeping its
+    recorder, any interrupted session and the publisher's outbox.
 
+    With a single configured port, its sessions and recording journal keep
+    their unqualified names. Every other port, configured or added at
+    runtime, is named after the port, and that name is added to its session
+    file names, journal path and metric labels.
+
+    Given a PianoRollFeed, each instrument streams its key and pedal state to
+    piano-roll viewers as a source of its own, cleared while disconnected.
+    Given an Archive, every instrument's sessions are indexed in it.
+    """
+
+    def __init__(self, port_names: List[str], publisher: Publisher, segment_seconds: float = SEGMENT_MAX_SECONDS,
+                 journal_path: Optional[str] = None, roll: Optional[PianoRollFeed] = None,
+                 archive: Optional[Archive] = None):
+        self._port_names = list(port_names)
+        self._publisher = publisher
+        self._segment_seconds = segment_seconds
+        self._journal_path = journal_path or DEFAULT_JOURNAL_PATH
+        self._roll = roll
+        self._archive = archive
+        self._instruments: Dict[str, Instrument] = {}
+        self._available: List[str] = []
+        self._lock = RLock()
+        self._watcher = DeviceWatcher(self._ports_changed)
+
+    def add_port(self, port_name: str) -> None:
+        with self._lock:
+            if port_name in self._instruments:
+                return
+            name = self._instrument_name(port_name)
+            instrument = Instrument(port_name, self._publisher, name=name, segment_seconds=self._segment_seconds,
+                                    journal_path=self._journal_for(name), roll=self._roll,
+                                    archive=self._archive)
+            self._instruments[port_name] = instrument
+            instrument.start()
+            self._reconcile(self._available, time.monotonic())
+
+    def remove_port(self, port_name: str) -> None:
+        with self._lock:
+            instrument = self._instruments.pop(port_name, None)
+            if instrument is not None:
+                log.info("Disconnecting from %s", port_name)
+                instrument.shutdown()
+
+    def instruments(self) -> List[Instrument]:
+        with self._lock:
+            return list(self._instruments.values())
+
+    def _instrument_name(self, port_name: str) -> Optional[str]:
+        # Called with the lock held. Ports added at runtime are named too, so
+        # a keyboard plugged in next to the configured one never shares its
+        # journal, session names or metric labels.
+        if self._port_names == [port_name]:
+            return None
+        base = re.sub(r'[^a-z0-9]+', '-', port_name.lower()).strip('-') or "port"
+        taken = {instrument.name for instrument in self._instruments.values()}
+        name = base
+        n = 1
+        while name in taken:
+            n += 1
+            name = "%s-%d" % (base, n)
+        return name
+
+    def _journal_for(self, name: Optional[str]) -> str:
+        if name is None:
+            return self._journal_path
+        root, ext = os.path.splitext(self._journal_path)
+        return "%s-%s%s" % (root, name, ext)
+
+    def _open_midi(self, port_name: str, available: List[str]):
+        try:
+            port_number = available.index(port_name)
+        except ValueError:
+            return None
+        midi_in = None
+        try:
+            midi_in, _ = open_midiport(port_number, "input", use_virtual=False, interactive=False)
+            midi_out, _ = open_midiport(port_number, "output", use_virtual=False, interactive=False)
+        except IOError as e:
+            log.debug("_open_midi, port=%s, port_number=%s, in=%s, IOError=%s", port_name, port_number,
+                      midi_in is not None, e)
+            if midi_in is not None:
+                midi_in.close_port()
+            return None
+        return midi_in, midi_out
+
+    def _ports_changed(self, available: List[str], detected: float) -> None:
+        with self._lock:
+            self._available = available
+            self._reconcile(available, detected)
+
+    def _reconcile(self, available: List[str], detected: float) -> None:
+        # Called with the lock held, from the watcher thread or run().
+        for port_name, instrument in self._instruments.items():
+            if instrument.connected and port_name not in available:
+                log.warning("MIDI device %s went away", port_name)
+                instrument.disconnect()
+            elif not instrument.connected and port_name in available:
+                ports = self._open_midi(port_name, available)
+                if ports is not None:
+                    instrument.connect(ports[0], ports[1], detected)
+                    log.info("Connected to %s in %.0fms", port_name, 1000 * (time.monotonic() - detected))
+
+    def _reconnect_timed_out(self) -> None:
+        with self._lock:
+            timed_out = [instrument for instrument in self._instruments.values() if instrument.timed_out]
+            for instrument in timed_out:
+                log.warning("MIDI device %s timed out, reconnecting", instrument.port_name)
+                instrument.disconnect()
+            if timed_out:
+                flight_recorder.TRACE.dump("midi-timeout")
+                self._reconcile(self._available, time.monotonic())
+
+    def run(self):
+        log.info("Trying to connect to %s", ", ".join(self._port_names))
+        for port_name in self._port_names:
+            self.add_port(port_name)
+        self._watcher.start()
         try:
-            while not keyboard._timedout:
-                time.sleep(1)
-            print("Exiting because MIDI device timed out.")
+            while self.instruments():
+                time.sleep(TIMEOUT_CHECK_INTERVAL)
+                self._reconnect_timed_out()
+            print("Exiting because no MIDI ports are left.")
         except KeyboardInterrupt:
             print('Exiting due to Ctrl-C.')
         finally:
             print("Shutting down...")
-            musical_feedback.shutdown()
-            recorder.shutdown()
-            keyboard.shutdown()
-            self._midi_in.close_port()
-            self._midi_out.close_port()
-            self._midi_in = None
-            self._midi_out = None
+            self._watcher.shutdown()
+            with self._lock:
+                instruments = list(self._instruments.values())
+                self._instruments.clear()
+            for instrument in instruments:
+                instrument.shutdown()
@@ -1,125 +1,352 @@
-from io import BytesIO
-from queue import Queue
-from tempfile import NamedTemporaryFile
-
+import logging
 import os
-from threading import Thread
+import random
+import resource
+import tempfile
+import time
+import uuid
+from threading import Lock
+from typing import Dict, List, Optional
 
-from google.oauth2 import service_account  # type: ignore
-from googleapiclient.discovery import build  # type: ignore
-from googleapiclient.http import MediaIoBaseUpload  # type: ignore
-from midi2audio import FluidSynth  # type: ignore
-from slackclient import SlackClient  # type: ignore
 import json
 
-from functools import wraps
+import startup
+from actor import Actor, queued, BULK, COALESCE
+from audio_encoder import EncoderSink
+from metrics import QUEUE_DEPTH, counter, histogram
+from outbox import Outbox, job_id
+from raw_event_log import RawEventLog
+from resettable_timer import ResettableTimer
+from session_stats import describe
+from synth import RenderService
+from upload_stage import UploadStage
+from uploaders import (SlackBackend, DriveBackend, drive_credentials, SLACK_API_URL, GOOGLE_API_URL,
+                       RESUMABLE_UPLOAD_THRESHOLD)
+
+log = logging.getLogger('pianobot')
+
+
+DEFAULT_AUDIO_FORMATS = ["flac"]
+# "events" is the binary RawEventLog format, "json" the older JSON form.
+DEFAULT_RAW_DATA_FORMATS = ["events"]
+DEFAULT_OUTBOX_PATH = os.path.join(tempfile.gettempdir(), "pianobot-outbox")
+SLACK_MAX_CONCURRENCY = 2
+# Slack messages go through their own single worker so they stay in order.
+SLACK_TEXT_CONCURRENCY = 1
+DRIVE_MAX_CONCURRENCY = 2
+RETRY_BACKOFF_BASE = 2.0
+RETRY_BACKOFF_MAX = 30 * 60
+# Uploads retry until they succeed; a render that keeps failing is given up on.
+MAX_ATTEMPTS = {"render": 3}
+
+SESSIONS_PUBLISHED = counter("pianobot_sessions_published_total", "Sessions whose jobs have all finished.")
+PCM_RENDERED = counter("pianobot_rendered_pcm_bytes_total", "Bytes of PCM audio rendered.")
+ENCODED = counter("pianobot_encoded_bytes_total", "Bytes of encoded audio produced.", ("format",))
+UPLOADED = counter("pianobot_uploaded_bytes_total", "Bytes uploaded.", ("destination",))
+UPLOAD_DURATION = histogram("pianobot_upload_seconds", "Time taken by one upload attempt.", ("destination",))
+FAILED_ATTEMPTS = counter("pianobot_failed_attempts_total", "Failed outbox job attempts.", ("kind",))
+
+
+class _PublishedSession(object):
+    """Counts the outstanding outbox jobs of one session and reports when they are all done."""
+
+    def __init__(self, file_prefix: str, on_published=None):
+        self.file_prefix = file_prefix
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.pcm_bytes = 0
+        self.encoded: Dict[str, int] = {}
+        self.bytes_uploaded = 0
+        self.failed_uploads = 0
+        self._pending = 0
+        self._on_published = on_published
+        self._lock = Lock()
+
+    def job_added(self) -> None:
+        with self._lock:
+            self._pending += 1
 
+    def attempt_failed(self) -> None:
+        with self._lock:
+            self.failed_uploads += 1
 
-def queued(f):
-    @wraps(f)
-    def wrapper(*args, **kwds):
-        self = args[0]
-        self._queue.put([f.__name__, list(args[1:]), kwds])
-        return
+    def rendered(self, pcm_bytes: int, outputs) -> None:
+        with self._lock:
+            self.pcm_bytes = pcm_bytes
+            for output in outputs:
+                self.encoded[output.format] = output.size
 
-    wrapper.underlying_method = f
-    return wrapper
+    def job_done(self, bytes_uploaded: int = 0) -> None:
+        with self._lock:
+            self._pending -= 1
+            self.bytes_uploaded += bytes_uploaded
+            if self._pending:
+                return
+            self.finished = time.monotonic()
+        log.info("published %s in %.2fs: %d bytes of PCM encoded to %s, %d bytes uploaded, %d failed attempts, "
+                 "peak RSS %d kB", self.file_prefix, self.finished - self.started, self.pcm_bytes,
+                 ", ".join("%s %d bytes" % item for item in self.encoded.items()), self.bytes_uploaded,
+                 self.failed_uploads, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        if self._on_published is not None:
+            self._on_published(self)
 
 
-GOOGLE_SCOPES = ['https://www.googleapis.com/auth/drive']
+class Publisher(Actor):
+    """
+    Publishes recordings through a durable outbox.
 
+    publish_* calls store their artifacts and jobs in the Outbox before
+    returning. The publisher thread then hands render jobs to the render pool
+    and upload jobs to the upload stage. Failed jobs are retried with
+    exponential backoff, and unfinished jobs are picked up again on startup.
+
+    Dispatches go in the bulk lane, so finished renders are handled ahead of a
+    backlog of replayed jobs, and a job dispatched again while it is still
+    waiting is only dispatched once.
+    """
 
-class Publisher(Thread):
     def __init__(self, soundfont_path: str, slack_api_token: str, slack_channel_public: str, slack_channel_private: str,
-                 google_credentials_json: str, google_folder_id: str):
-        Thread.__init__(self)
-        self._soundfont_path = soundfont_path
-        self._slack_client = SlackClient(slack_api_token)
+                 google_credentials_json: str, google_folder_id: str, render_workers: Optional[int] = None,
+                 audio_formats: Optional[List[str]] = None, outbox_path: Optional[str] = None,
+                 slack_api_url: str = SLACK_API_URL, google_api_url: str = GOOGLE_API_URL, on_published=None,
+                 render_service: Optional[RenderService] = None, raw_data_formats: Optional[List[str]] = None):
+        Actor.__init__(self, "publisher")
+        self._render_service = render_service or RenderService(soundfont_path, workers=render_workers)
+        self._audio_formats = audio_formats or DEFAULT_AUDIO_FORMATS
+        self._raw_data_formats = raw_data_formats or DEFAULT_RAW_DATA_FORMATS
+        self._outbox = Outbox(outbox_path or DEFAULT_OUTBOX_PATH)
+        # The backends are built by run(), on the publisher thread, so parsing
+        # credentials and importing HTTP clients doesn't hold up opening MIDI.
+        # Jobs published before then wait in the outbox and the mailbox.
+        self._backend_config = (slack_api_token, slack_api_url, google_credentials_json, google_folder_id,
+                                google_api_url)
+        self._slack: Optional[SlackBackend] = None
+        self._drive: Optional[DriveBackend] = None
         self._slack_channel_public = slack_channel_public
         self._slack_channel_private = slack_channel_private
-        service_credentials = service_account.Credentials.from_service_account_info(google_credentials_json,
-                                                                                    scopes=GOOGLE_SCOPES)
-        self._google_drive = build('drive', 'v2', credentials=service_credentials, cache_discovery=False)
-        self._google_folder_id = google_folder_id
-
-        self._queue: Queue = Queue()
+        self._uploads = UploadStage({
+            "slack": SLACK_MAX_CONCURRENCY,
+            "slack_text": SLACK_TEXT_CONCURRENCY,
+            "drive": DRIVE_MAX_CONCURRENCY,
+        })
+        self._sessions: Dict[str, _PublishedSession] = {}
+        self._sessions_lock = Lock()
+        self._on_published = on_published
+        # Jobs replayed from a previous run may have reached Drive before it stopped.
+        # Only those left in the outbox now are replayed, not ones published before setup() runs.
+        self._leftover = [job["id"] for job in self._outbox.pending()]
+        self._replayed = set()
+        QUEUE_DEPTH.labels("outbox").set_function(lambda: len(self._outbox.pending()))
 
     def shutdown(self) -> None:
-        self._queue.put(None)
-
-    def run(self) -> None:
-        while True:
-            item = self._queue.get()
-            if item is None:
-                self._queue.task_done()
-                break
-            else:
-                f = getattr(self, item[0])
-                f.underlying_method(self, *item[1], **item[2])
-                self._queue.task_done()
+        Actor.shutdown(self)
+        self._render_service.shutdown()
+        self._uploads.shutdown()
 
-    @queued
-    def publish_raw_data(self, file_prefix: str, data) -> None:
-        self.google_upload(file_prefix + ".json", "application/json", str.encode(json.dumps(data)))
+    def _start_backends(self) -> None:
+        slack_api_token, slack_api_url, google_credentials_json, google_folder_id, google_api_url = \
+            self._backend_config
+        # Uploads and messages share the Slack connection pool, so it has a connection for each of their workers.
+        self._slack = SlackBackend(slack_api_token, max_concurrency=SLACK_MAX_CONCURRENCY + SLACK_TEXT_CONCURRENCY,
+                                   base_url=slack_api_url)
+        credentials = drive_credentials(google_credentials_json) if google_credentials_json else None
+        self._drive = DriveBackend(credentials, google_folder_id, max_concurrency=DRIVE_MAX_CONCURRENCY,
+                                   base_url=google_api_url)
+        startup.reached("backends_ready")
+
+    def setup(self) -> None:
+        self._start_backends()
+        self._render_service.start()
+        self._uploads.start()
+        for id in self._leftover:
+            job = self._outbox.get(id)
+            if job is None:
+                continue
+            self._replayed.add(id)
+            self._track(job)
+            self.dispatch(id)
+        self._leftover = []
+
+    def teardown(self) -> None:
+        self._outbox.close()
+
+    def publish_raw_data(self, file_prefix: str, data: RawEventLog) -> None:
+        if "events" in self._raw_data_formats:
+            name = file_prefix + ".events"
+            path = self._outbox.put_artifact(name, data)
+            self._add_upload(file_prefix, "drive", name, "application/octet-stream", path)
+        if "json" in self._raw_data_formats:
+            name = file_prefix + ".json"
+            path = self._outbox.put_artifact(name, data.to_json())
+            self._add_upload(file_prefix, "drive", name, "application/json", path)
+
+    def publish_manifest(self, file_prefix: str, manifest: dict) -> None:
+        name = file_prefix + ".manifest.json"
+        path = self._outbox.put_artifact(name, str.encode(json.dumps(manifest, indent=2)))
+        self._add_upload(file_prefix, "drive", name, "application/json", path)
 
-    @queued
     def publish_midi_file(self, file_prefix: str, midi_bytes, public: bool) -> None:
-        with NamedTemporaryFile("wb", prefix=file_prefix + "-", suffix='.mid') as midi_output:
-            midi_output.write(midi_bytes)
-            midi_output.flush()
-
-            self.slack_upload_private(file_prefix + ".mid", midi_bytes)
-            self.google_upload(file_prefix + ".mid", "audio/midi", midi_bytes)
-            if public:
-                self.slack_upload_public(file_prefix + ".mid", midi_bytes)
-
-            wav_output_name = midi_output.name + ".wav"
-            fluidsynth = FluidSynth(self._soundfont_path)
-            fluidsynth.midi_to_audio(midi_output.name, wav_output_name)
-
-            with open(wav_output_name, "rb") as wav_file_handle:
-                wav_bytes = wav_file_handle.read()
-                self.slack_upload_private(file_prefix + ".wav", wav_bytes)
-                self.google_upload(file_prefix + ".wav", "audio/wav", wav_bytes)
-                if public:
-                    self.slack_upload_public(file_prefix + ".wav", wav_bytes)
-            os.remove(wav_output_name)
+        name = file_prefix + ".mid"
+        path = self._outbox.put_artifact(name, midi_bytes)
+        self._add_job({"id": job_id("render", file_prefix), "kind": "render", "session": file_prefix,
+                       "public": public, "artifacts": [path]})
+        self._add_uploads(file_prefix, name, "audio/midi", path, public)
+
+    def publish_stats(self, file_prefix: str, stats: dict, public: bool) -> None:
+        """Store a session summary from SessionStats as a sidecar and post it where the session goes."""
+        name = file_prefix + ".stats.json"
+        path = self._outbox.put_artifact(name, str.encode(json.dumps(stats, separators=(",", ":"))))
+        self._add_upload(file_prefix, "drive", name, "application/json", path)
+        text = describe(file_prefix, stats)
+        self.slack_text(text, private=True)
+        if public:
+            self.slack_text(text)
+
+    def slack_text(self, text: str, private: bool = False) -> None:
+        job = {"id": uuid.uuid4().hex, "kind": "text", "text": text}
+        if private:
+            job["channel"] = "private"
+        self._add_job(job)
+
+    def _add_uploads(self, file_prefix: str, name: str, mime: str, path: str, public: bool, drive: bool = True) -> None:
+        self._add_upload(file_prefix, "slack_private", name, mime, path)
+        if drive:
+            self._add_upload(file_prefix, "drive", name, mime, path)
+        if public:
+            self._add_upload(file_prefix, "slack_public", name, mime, path)
+
+    def _add_upload(self, file_prefix: str, destination: str, name: str, mime: str, path: str) -> None:
+        self._add_job({"id": job_id("upload", destination, name), "kind": "upload", "session": file_prefix,
+                       "destination": destination, "name": name, "mime": mime, "artifacts": [path]})
+
+    def _add_job(self, job: dict) -> None:
+        if self._outbox.add(job):
+            self._track(job)
+            self.dispatch(job["id"])
+
+    def _track(self, job: dict) -> None:
+        if "session" not in job:
+            return
+        with self._sessions_lock:
+            session = self._sessions.get(job["session"])
+            if session is None:
+                session = self._sessions[job["session"]] = _PublishedSession(job["session"], self._session_published)
+            session.job_added()
+
+    def _session(self, job: dict) -> Optional[_PublishedSession]:
+        return self._sessions.get(job.get("session"))
+
+    def _session_published(self, session: _PublishedSession) -> None:
+        SESSIONS_PUBLISHED.inc()
+        with self._sessions_lock:
+            self._sessions.pop(session.file_prefix, None)
+        if self._on_published is not None:
+            self._on_published(session)
+
+    @queued(lane=BULK, overflow=COALESCE)
+    def dispatch(self, id: str) -> None:
+        job = self._outbox.get(id)
+        if job is None:
+            return
+        if job["kind"] == "render":
+            # Encoded outputs are written straight into the outbox as .partial
+            # files and committed once the render has finished.
+            sink = EncoderSink(self._audio_formats, open_file=lambda extension: open(
+                self._outbox.artifact_path("%s.%s.partial" % (job["session"], extension)), "w+b"))
+            with open(job["artifacts"][0], "rb") as midi_file:
+                rendering = self._render_service.submit(midi_file.read(), sink)
+            rendering.add_done_callback(lambda f: self.rendered(id, f, sink.pcm_bytes))
+        elif job["kind"] == "text":
+            channel = self._slack_channel_private if job.get("channel") == "private" else self._slack_channel_public
+            future = self._uploads.submit("slack_text", self._slack.post_message, channel, job["text"])
+            future.add_done_callback(lambda f: self._finished(job, f))
+        else:
+            queue = "drive" if job["destination"] == "drive" else "slack"
+            future = self._uploads.submit(queue, self._run_upload, job)
+            future.add_done_callback(lambda f: self._finished(job, f))
 
     @queued
-    def slack_text(self, text: str) -> None:
-        res = self._slack_client.api_call(
-            "chat.postMessage",
-            channel=self._slack_channel_public,
-            text=text
-        )
+    def rendered(self, id: str, rendering, pcm_bytes: int) -> None:
+        job = self._outbox.get(id)
+        if job is None:
+            return
+        if rendering.exception() is not None:
+            self._retry(job, rendering.exception())
+            return
+        outputs = rendering.result()
+        PCM_RENDERED.inc(pcm_bytes)
+        for output in outputs:
+            ENCODED.labels(output.format).inc(output.size)
+        session = self._session(job)
+        if session is not None:
+            session.rendered(pcm_bytes, outputs)
+        # Drive archives every format; Slack gets the last (smallest) one.
+        preview = outputs[-1]
+        for output in outputs:
+            output.fileobj.close()
+            path = self._outbox.commit_artifact(output.fileobj.name)
+            name = "%s.%s" % (job["session"], output.extension)
+            if output is preview:
+                self._add_uploads(job["session"], name, output.mime, path, job["public"])
+            else:
+                self._add_upload(job["session"], "drive", name, output.mime, path)
+        self._complete(job)
+
+    def _run_upload(self, job: dict) -> int:
+        path = job["artifacts"][0]
+        started = time.monotonic()
+        with open(path, "rb") as data:
+            if job["destination"] == "drive":
+                check_existing = job["id"] in self._replayed or self._outbox.attempts(job["id"]) > 0
+                if os.path.getsize(path) > RESUMABLE_UPLOAD_THRESHOLD:
+                    self._drive.upload_resumable(job["name"], job["mime"], data, idempotency_key=job["id"],
+                                                 check_existing=check_existing,
+                                                 session_path=self._outbox.state_path(job["id"]))
+                else:
+                    self._drive.upload(job["name"], job["mime"], data, idempotency_key=job["id"],
+                                       check_existing=check_existing)
+            elif job["destination"] == "slack_public":
+                self.slack_upload_public(job["name"], data)
+            else:
+                self.slack_upload_private(job["name"], data)
+        UPLOAD_DURATION.labels(job["destination"]).observe(time.monotonic() - started)
+        size = os.path.getsize(path)
+        UPLOADED.labels(job["destination"]).inc(size)
+        return size
+
+    def _finished(self, job: dict, future) -> None:
+        if future.exception() is not None:
+            self._retry(job, future.exception())
+        else:
+            self._complete(job, future.result() if job["kind"] == "upload" else 0)
+
+    def _complete(self, job: dict, bytes_uploaded: int = 0) -> None:
+        self._outbox.complete(job["id"])
+        session = self._session(job)
+        if session is not None:
+            session.job_done(bytes_uploaded)
+
+    def _retry(self, job: dict, error: BaseException) -> None:
+        attempts = self._outbox.retry(job["id"])
+        FAILED_ATTEMPTS.labels(job["kind"]).inc()
+        session = self._session(job)
+        if session is not None:
+            session.attempt_failed()
+        if attempts >= MAX_ATTEMPTS.get(job["kind"], attempts + 1):
+            log.error("publisher: giving up on %s job %s after %d attempts: %s", job["kind"], job["id"], attempts,
+                      error)
+            self._complete(job)
+            return
+        delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+        log.warning("publisher: %s job %s failed (attempt %d), retrying in %.0fs: %s", job["kind"], job["id"],
+                    attempts, delay, error)
+        ResettableTimer(delay, self.dispatch, name="publisher_retry", args=[job["id"]]).start()
 
     def google_upload(self, name: str, mime: str, data) -> str:
-        file_metadata = {
-            'title': name,
-            'parents': [{'id': self._google_folder_id}]
-        }
-        bytes_to_upload = BytesIO(data)
-        media = MediaIoBaseUpload(bytes_to_upload,
-                                  mimetype=mime,
-                                  resumable=False)
-        file_insert = self._google_drive.files().insert(body=file_metadata,
-                                                        media_body=media,
-                                                        fields='id').execute()
-        return file_insert.get('id')
+        return self._drive.upload(name, mime, data)
 
     def slack_upload_public(self, name: str, data) -> None:
-        res = self._slack_client.api_call(
-            "files.upload",
-            channels=self._slack_channel_public,
-            file=data,
-            title=name
-        )
+        self._slack.upload(self._slack_channel_public, name, data)
 
-    @queued
     def slack_upload_private(self, name: str, data) -> None:
-        res = self._slack_client.api_call(
-            "files.upload",
-            channels=self._slack_channel_private,
-            file=data,
-            title=name
-        )
+        self._slack.upload(self._slack_channel_private, name, data)
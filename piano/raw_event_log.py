@@ -0,0 +1,99 @@
+import json
+import struct
+import sys
+from array import array
+from typing import Iterator, List
+
+# File layout: header, then the times, deltas, offsets and message byte
+# columns back to back, all little-endian.
+RAW_EVENTS_MAGIC = b'PBRE'
+RAW_EVENTS_VERSION = 1
+_HEADER = struct.Struct('<4sHxxQQ')
+
+
+class RawEvent(object):
+    """One recorded MIDI message, read out of a RawEventLog."""
+    __slots__ = ("t", "deltatime", "message")
+
+    def __init__(self, t: float, deltatime: float, message: List[int]):
+        self.t = t
+        self.deltatime = deltatime
+        self.message = message
+
+    def __repr__(self):
+        return "RawEvent(t=%r, deltatime=%r, message=%r)" % (self.t, self.deltatime, self.message)
+
+
+class RawEventLog(object):
+    """
+    Append-only log of the raw MIDI messages of a recording, stored in columns.
+
+    Times and deltatimes go in array('d') columns and the message bytes of all
+    events are concatenated in one array('B'), with array('I') holding where
+    each event's message ends. This comes to 23 bytes per three-byte
+    message instead of a few hundred for the equivalent nested lists.
+
+    write_to() dumps the columns straight from their buffers; to_json() gives
+    the older [[t, deltatime, message, null], ...] JSON form.
+    """
+
+    def __init__(self):
+        self.times = array('d')
+        self.deltas = array('d')
+        self.ends = array('I')
+        self.data = array('B')
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, t: float, deltatime: float, message) -> None:
+        self.times.append(t)
+        self.deltas.append(deltatime)
+        self.data.extend(message)
+        self.ends.append(len(self.data))
+
+    def __getitem__(self, i: int) -> RawEvent:
+        if i < 0:
+            i += len(self.times)
+        start = self.ends[i - 1] if i > 0 else 0
+        return RawEvent(self.times[i], self.deltas[i], self.data[start:self.ends[i]].tolist())
+
+    def __iter__(self) -> Iterator[RawEvent]:
+        start = 0
+        data = self.data
+        for t, deltatime, end in zip(self.times, self.deltas, self.ends):
+            yield RawEvent(t, deltatime, data[start:end].tolist())
+            start = end
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(column) * column.itemsize for column in (self.times, self.deltas, self.ends, self.data))
+
+    def write_to(self, fileobj) -> int:
+        """Write the log in the binary .events format; returns the number of bytes written."""
+        times, deltas, ends, data = self.times, self.deltas, self.ends, self.data
+        fileobj.write(_HEADER.pack(RAW_EVENTS_MAGIC, RAW_EVENTS_VERSION, len(times), len(data)))
+        for column in (times, deltas, ends, data):
+            column = memoryview(column)
+            if sys.byteorder != 'little':
+                column = array(column.format, column)
+                column.byteswap()
+            fileobj.write(memoryview(column).cast('B'))
+        return _HEADER.size + sum(len(column) * column.itemsize for column in (times, deltas, ends, data))
+
+    @classmethod
+    def read_from(cls, fileobj) -> 'RawEventLog':
+        magic, version, count, size = _HEADER.unpack(fileobj.read(_HEADER.size))
+        if magic != RAW_EVENTS_MAGIC or version != RAW_EVENTS_VERSION:
+            raise ValueError("not a raw events file (magic %r, version %d)" % (magic, version))
+        log = cls()
+        for column, length in ((log.times, count), (log.deltas, count), (log.ends, count), (log.data, size)):
+            column.frombytes(fileobj.read(length * column.itemsize))
+            if len(column) != length:
+                raise ValueError("raw events file is truncated")
+            if sys.byteorder != 'little':
+                column.byteswap()
+        return log
+
+    def to_json(self) -> bytes:
+        return str.encode(json.dumps([[event.t, event.deltatime, event.message, None] for event in self]))
@@ -1,53 +1,124 @@
 import logging
+import os
+import tempfile
 import time
-from io import BytesIO
-from queue import Queue
-from threading import Thread
-from typing import List, Any
+from typing import List, Optional
 
-from mido import MidiFile, MidiTrack, Message, second2tick, bpm2tempo  # type: ignore
+from rtmidi.midiconstants import NOTE_ON, NOTE_OFF, CONTROL_CHANGE  # type: ignore
 
+import flight_recorder
+from actor import Actor, queued, CONTROL, COALESCE
+from archive import Archive
+from clock import CLOCK, NANOSECONDS
+from event_ring import EventRing
+from metrics import QUEUE_DEPTH, counter
 from musical_feedback import MusicalFeedback  # type: ignore
-from publisher import queued, Publisher
+from publisher import Publisher
+from recording_journal import RecordingJournal
 from resettable_timer import ResettableTimer
+from session_stats import SessionStats
+from smf_writer import SMFWriter, smf_from_raw_events, DEFAULT_BPM
 
-DEFAULT_BPM = 120
 RECORDING_END_TIMEOUT = 10
 RECORDING_REARM_TIMEOUT = 3 * 60
+# A session interrupted by the keyboard disconnecting is kept open this long
+# in case it comes back.
+RECORDING_RECONNECT_TIMEOUT = 5 * 60
+# With nothing to do the recorder still wakes this often, to re-anchor the clock.
+IDLE_TICK_INTERVAL = 60.0
+INGEST_BATCH_SIZE = 1024
+# Long sessions can be published in segments of about this length, cut where
+# no note is held and the sustain pedal is up (and of about SEGMENT_MAX_BYTES
+# of MIDI). Off by default: 0 publishes each session whole, as one recording.
+SEGMENT_MAX_SECONDS = 0
+SEGMENT_MAX_BYTES = 1024 * 1024
+# Cut anyway once a segment grows this much past its limits without a break.
+SEGMENT_FORCE_FACTOR = 2
+SUSTAIN_PEDAL = 64
+DEFAULT_JOURNAL_PATH = os.path.join(tempfile.gettempdir(), "pianobot-recording.journal")
+# At most this many seconds of a session are lost if the power goes.
+JOURNAL_SYNC_INTERVAL = 1.0
+
+EVENTS_RECORDED = counter("pianobot_midi_events_total", "MIDI messages taken off the ingest ring.", ("keyboard",))
+EVENTS_DROPPED = counter("pianobot_midi_events_dropped_total", "MIDI messages dropped because the ingest ring was full.",
+                         ("keyboard",))
+SESSIONS_RECORDED = counter("pianobot_sessions_recorded_total", "Recording sessions started.")
+SEGMENTS_PUBLISHED = counter("pianobot_segments_total", "Segments of long sessions handed to the publisher.")
+TRACE_DRAIN = flight_recorder.register("recorder.drain", "events=%d backlog=%d")
+EVENT_STATUS = {"note_on": NOTE_ON, "note_off": NOTE_OFF, "control_change": CONTROL_CHANGE}
 
 log = logging.getLogger('pianobot')
 
 
-class Recorder(Thread):
-    def __init__(self, musical_feedback: MusicalFeedback, publisher: Publisher):
-        Thread.__init__(self)
+class Recorder(Actor):
+    def __init__(self, musical_feedback: MusicalFeedback, publisher: Publisher,
+                 segment_seconds: float = SEGMENT_MAX_SECONDS, segment_bytes: int = SEGMENT_MAX_BYTES,
+                 journal_path: Optional[str] = None, name: Optional[str] = None,
+                 archive: Optional[Archive] = None):
+        # Raw events arrive through self.events rather than the mailbox, and are
+        # drained before every batch of calls; the rtmidi callback wakes the
+        # recorder when an event lands in an empty ring while it sleeps.
+        Actor.__init__(self, "recorder/%s" % name if name else "recorder", idle_interval=IDLE_TICK_INTERVAL)
+        # Names the keyboard when the process serves more than one; it's added
+        # to the session file names and metric labels.
+        self._name = name
         self._armed = False
         self._armed_public = False
         self._recording = False
         self._feedback = musical_feedback
         self._publisher = publisher
-        self._midifile = None
-        self._miditrack = None
+        self._archive = archive
+        self._smf = None
+        # Wall-clock seconds, for naming the session, and the monotonic ns it started at.
         self._started_recording = None
+        self._started_ns = None
         self._recording_timeout = None
         self._rearm_timeout = None
         self._last_recorded_event = None
-        self._raw_events: List[List[Any]] = []
-        self._queue: Queue[List[Any]] = Queue()
-
-    def run(self):
-        while True:
-            item = self._queue.get()
-            logging.debug("recorder dequeued %s", item)
-            if item is None:
-                self._queue.task_done()
-                break
-            else:
-                f = getattr(self, item[0])
-                f.underlying_method(self, *item[1], **item[2])
-                self._queue.task_done()
+        # Raw events of the session (or segment) being recorded, journaled to disk
+        # as they arrive so a crash doesn't lose them.
+        self._raw_events = RecordingJournal(journal_path or DEFAULT_JOURNAL_PATH)
+        self._synced_events = len(self._raw_events)
+        self._last_sync = time.monotonic()
+        self.events = EventRing()
+        self.events.set_wakeup(self._mailbox.wake)
+        QUEUE_DEPTH.labels("ingest_ring/%s" % name if name else "ingest_ring").set_function(self.events.__len__)
+        self._events_recorded = EVENTS_RECORDED.labels(name or "default")
+        EVENTS_DROPPED.labels(name or "default").set_function(lambda: self.events.dropped)
+        self._dropped_at_start = 0
+        self._segment_seconds = segment_seconds
+        self._segment_ns = int(segment_seconds * NANOSECONDS)
+        self._segment_bytes = segment_bytes
+        self._file_prefix = None
+        self._segments: List[dict] = []
+        self._segment_started = None
+        self._held_notes = set()
+        self._sustain = False
+        self._stats: Optional[SessionStats] = None
 
-    @queued
+    def setup(self):
+        self._recover_journal()
+
+    def tick(self):
+        self._drain_events()
+        CLOCK.maybe_reanchor()
+
+    def wait_interval(self):
+        events = self.events
+        events.waiting = True
+        if len(events):
+            events.waiting = False
+            return 0
+        if len(self._raw_events) != self._synced_events:
+            # Back in time to sync the journal's last events to disk.
+            return JOURNAL_SYNC_INTERVAL
+        return self._idle_interval
+
+    def teardown(self):
+        self._drain_events()
+        self._raw_events.close()
+
+    @queued(lane=CONTROL, overflow=COALESCE)
     def arm_public(self):
         self.arm_recording()
         self._armed_public = True
@@ -56,7 +127,7 @@ class Recorder(Thread):
         # self._publisher.slack_text("_the next session will be publicized_")
         pass
 
-    @queued
+    @queued(lane=CONTROL, overflow=COALESCE)
     def arm_recording(self):
         if self._armed:
             logging.info("recording already armed")
@@ -65,7 +136,7 @@ class Recorder(Thread):
         logging.info("recording armed")
         self._publisher.slack_text("_will record for research purposes only when someone plays_")
 
-    @queued
+    @queued(lane=CONTROL, overflow=COALESCE)
     def disarm_recording(self):
         if not self._armed:
             logging.info("recording already disarmed")
@@ -75,7 +146,7 @@ class Recorder(Thread):
         self._armed = False
         logging.info("recording disarmed")
         self._feedback.sad_sound()
-        self._rearm_timeout = ResettableTimer(RECORDING_REARM_TIMEOUT, self.arm_recording(), name="recording_rearm")
+        self._rearm_timeout = ResettableTimer(RECORDING_REARM_TIMEOUT, self.arm_recording, name="recording_rearm")
         self._rearm_timeout.start()
         self._publisher.slack_text("_won't record for now_")
 
@@ -84,39 +155,126 @@ class Recorder(Thread):
         if not self._recording:
             return
         self._recording = False
-        file_prefix = "piano-%s" % (time.strftime('%Y%m%d%H%M%S', time.localtime(self._started_recording)))
-        self._started_recording = None
         self._recording_timeout.cancel()
         self._recording_timeout = None
-        if self._last_recorded_event is None:
+        dropped = self.events.dropped - self._dropped_at_start
+        if dropped:
+            log.warning("%d MIDI events were dropped because the ingest ring was full", dropped)
+        try:
+            if self._segments:
+                if self._segment_started is not None:
+                    self._publish_segment(last=True)
+                self._publisher.publish_manifest(self._file_prefix, {
+                    "session": self._file_prefix,
+                    "started": self._started_recording,
+                    "segments": self._segments,
+                })
+            elif self._segment_started is not None:
+                self._publisher.publish_midi_file(self._file_prefix, self._smf.close(), public=self._armed_public)
+                self._publisher.publish_raw_data(self._file_prefix, self._raw_events)
+            if self._stats.notes:
+                # Summarized only once the recording itself is on its way.
+                summary = self._stats.summary(self._last_recorded_event)
+                self._publisher.publish_stats(self._file_prefix, summary, public=self._armed_public)
+                if self._archive is not None:
+                    self._archive.add(self._file_prefix, self._started_recording, summary, public=self._armed_public)
+        finally:
+            # Reset even if publishing or summarizing failed, so the next session starts clean.
+            self._stats = None
+            self._started_recording = None
+            self._started_ns = None
+            self._last_recorded_event = None
+            self._armed_public = False
+            self._smf = None
+            self._raw_events.reset()
+            self._synced_events = 0
+            self._segments = []
+
+    @queued
+    def disconnected(self):
+        # No events can arrive to reset the idle timer, so give the session
+        # the longer reconnect grace period instead.
+        if not self._recording:
             return
-        self._last_recorded_event = None
+        log.info("keyboard disconnected, keeping the session open for %ds", RECORDING_RECONNECT_TIMEOUT)
+        self._recording_timeout.cancel()
+        self._recording_timeout = ResettableTimer(RECORDING_RECONNECT_TIMEOUT, self.stop_recording,
+                                                  name="recording_reconnect")
+        self._recording_timeout.start()
 
-        midi_bytes = BytesIO()
-        self._midifile.save(file=midi_bytes)
-        self._publisher.publish_midi_file(file_prefix, midi_bytes.getbuffer(), public=self._armed_public)
-        self._publisher.publish_raw_data(file_prefix, self._raw_events)
-        del midi_bytes
-        self._armed_public = False
-        self._midifile = None
-        self._miditrack = None
+    @queued
+    def reconnected(self):
+        if not self._recording:
+            return
+        log.info("keyboard reconnected, resuming the session")
+        self._recording_timeout.cancel()
+        self._recording_timeout = ResettableTimer(RECORDING_END_TIMEOUT, self.stop_recording, name="recording_idle")
+        self._recording_timeout.start()
 
     def start_recording(self, start_time):
         if self._recording:
             return
         self._recording = True
-        self._started_recording = start_time
-        self._midifile = MidiFile()
-        self._miditrack = MidiTrack()
-        self._midifile.tracks.append(self._miditrack)
+        SESSIONS_RECORDED.inc()
+        self._started_recording = CLOCK.wall_seconds(start_time)
+        self._started_ns = start_time
+        self._file_prefix = _session_prefix(self._started_recording, self._name)
+        self._smf = SMFWriter(DEFAULT_BPM)
+        self._segments = []
+        self._segment_started = None
+        self._held_notes = set()
+        self._sustain = False
+        self._stats = SessionStats(start_time)
         self._recording_timeout = ResettableTimer(RECORDING_END_TIMEOUT, self.stop_recording, name="recording_idle")
         self._recording_timeout.start()
         self._last_recorded_event = None
-        self._raw_events = []
+        self._raw_events.reset(started=self._started_recording, public=self._armed_public)
+        self._synced_events = 0
+        self._dropped_at_start = self.events.dropped
         if self._armed_public:
             self._publisher.slack_text("_just started a recording for public consumption_")
 
-    @queued
+    def _drain_events(self):
+        # Events are written into self.events by the rtmidi callback thread and
+        # consumed here in batches, in arrival order.
+        batch = self.events.drain(INGEST_BATCH_SIZE)
+        if batch:
+            flight_recorder.record(TRACE_DRAIN, len(batch), len(self.events))
+        self._events_recorded.inc(len(batch))
+        for t, deltatime, status, data1, data2, message in batch:
+            self.record_raw_event(t, message, deltatime, None)
+            if status == NOTE_ON:
+                self.record_event("note_on", data1, data2, t, deltatime)
+            elif status == NOTE_OFF:
+                self.record_event("note_off", data1, data2, t, deltatime)
+            elif status == CONTROL_CHANGE:
+                self.record_event("control_change", data1, data2, t, deltatime)
+        self._sync_journal()
+
+    def _sync_journal(self):
+        journaled = len(self._raw_events)
+        now = time.monotonic()
+        if journaled != self._synced_events and now - self._last_sync >= JOURNAL_SYNC_INTERVAL:
+            self._raw_events.sync()
+            self._synced_events = journaled
+            self._last_sync = now
+
+    def _recover_journal(self):
+        # A non-empty journal at startup is a session the last run never finished.
+        journal = self._raw_events
+        if not len(journal):
+            return
+        prefix = _session_prefix(journal.started, self._name)
+        if journal.segment:
+            prefix = "%s-part%03d" % (prefix, journal.segment)
+        log.warning("recovering %d events of unfinished recording %s", len(journal), prefix)
+        midi = smf_from_raw_events(((event.t, event.message) for event in journal), DEFAULT_BPM)
+        if midi is not None:
+            self._publisher.publish_midi_file(prefix, midi, public=journal.public)
+        self._publisher.publish_raw_data(prefix, journal)
+        journal.reset()
+        self._synced_events = 0
+
     def record_raw_event(self, t, message, deltatime, data):
         if self._rearm_timeout:
             self._rearm_timeout.reset()
@@ -124,9 +282,27 @@ class Recorder(Thread):
             self.start_recording(t)
         if self._recording:
             self._recording_timeout.reset()
-            self._raw_events.append([t, deltatime, message, data])
+            # The journal keeps wall-clock seconds, offset from the session start so
+            # re-anchoring the clock mid-session can't make them jump.
+            t = self._started_recording + (t - self._started_ns) / NANOSECONDS
+            if not self._raw_events.append(t, deltatime, message):
+                if not self._segment_seconds:
+                    # Segmenting is off, so the session stays one file: make room instead.
+                    try:
+                        self._raw_events.grow()
+                    except OSError as e:
+                        log.error("recording journal is full and could not grow: %s", e)
+                    else:
+                        log.info("recording journal is full, grown to %d events", self._raw_events.capacity)
+                        self._raw_events.append(t, deltatime, message)
+                        return
+                if self._segment_started is None:
+                    log.error("recording journal is full, dropping event")
+                    return
+                log.warning("recording journal is full, cutting a segment early")
+                self._publish_segment()
+                self._raw_events.append(t, deltatime, message)
 
-    @queued
     def record_event(self, event, note, velocity, t, deltatime):
         if self._rearm_timeout:
             self._rearm_timeout.reset()
@@ -136,23 +312,68 @@ class Recorder(Thread):
             self._recording_timeout.reset()
             if self._last_recorded_event is None:
                 self._last_recorded_event = t
-            if event == "note_on" or event == "note_off":
-                self._miditrack.append(Message(event, note=note, velocity=velocity, time=int(
-                    second2tick(t - self._last_recorded_event, self._midifile.ticks_per_beat, bpm2tempo(DEFAULT_BPM)))))
-            elif event == "control_change":
-                self._miditrack.append(Message(event, control=note, value=velocity, time=int(
-                    second2tick(t - self._last_recorded_event, self._midifile.ticks_per_beat, bpm2tempo(DEFAULT_BPM)))))
+            if self._segment_started is None:
+                self._segment_started = t
+            status = EVENT_STATUS.get(event)
+            if status is not None:
+                self._smf.append(self._smf.ns_to_ticks(t - self._last_recorded_event), status, note, velocity)
             else:
                 log.error("record_event: unknown event type %s", event)
                 return
             self._last_recorded_event = t
+            if event == "note_on" and velocity > 0:
+                self._held_notes.add(note)
+                self._stats.note_on(t, note, velocity)
+            elif event in ("note_on", "note_off"):
+                self._held_notes.discard(note)
+                self._stats.note_off(t, note)
+            else:
+                self._stats.control_change(t, note, velocity)
+                if note == SUSTAIN_PEDAL:
+                    self._sustain = velocity >= 64
+            if self._segment_seconds and self._segment_due(t):
+                self._publish_segment()
+
+    def _segment_due(self, t) -> bool:
+        factor = 1 if not self._held_notes and not self._sustain else SEGMENT_FORCE_FACTOR
+        return (t - self._segment_started >= self._segment_ns * factor or
+                len(self._smf) >= self._segment_bytes * factor)
+
+    def _publish_segment(self, last=False):
+        # Hands the segment recorded so far to the publisher and starts the
+        # next one; each segment is a standalone MIDI file starting at tick 0.
+        prefix = "%s-part%03d" % (self._file_prefix, len(self._segments) + 1)
+        SEGMENTS_PUBLISHED.inc()
+        if not last and (self._held_notes or self._sustain):
+            log.warning("cutting segment %s with %d notes held, sustain %s", prefix, len(self._held_notes),
+                        "down" if self._sustain else "up")
+        self._segments.append({
+            "name": prefix,
+            "offset": (self._segment_started - self._started_ns) / NANOSECONDS,
+            "duration": (self._last_recorded_event - self._segment_started) / NANOSECONDS,
+            "raw_events": len(self._raw_events),
+            "midi_bytes": len(self._smf.close()),
+        })
+        self._publisher.publish_midi_file(prefix, self._smf.close(), public=self._armed_public)
+        self._publisher.publish_raw_data(prefix, self._raw_events)
+        self._smf = SMFWriter(DEFAULT_BPM)
+        self._raw_events.reset(started=self._started_recording, segment=len(self._segments) + 1,
+                               public=self._armed_public)
+        self._synced_events = 0
+        self._segment_started = None
+        self._last_recorded_event = None
 
     def shutdown(self):
         self.stop_recording()
-        self._queue.put(None)
+        Actor.shutdown(self)
 
     def toggle(self):
         if self._armed:
             self.disarm_recording()
         else:
             self.arm_recording()
+
+
+def _session_prefix(started: float, name: Optional[str] = None) -> str:
+    stamp = time.strftime('%Y%m%d%H%M%S', time.localtime(started))
+    return "piano-%s-%s" % (name, stamp) if name else "piano-%s" % stamp
@@ -0,0 +1,168 @@
+import mmap
+import os
+import struct
+from typing import Optional
+
+from raw_event_log import RawEventLog
+
+RECORDING_JOURNAL_MAGIC = b'PBRJ'
+RECORDING_JOURNAL_VERSION = 1
+# Room for about an hour and a half of dense playing. A full journal is
+# grown when segmenting is off, and cut into a segment early when it's on.
+JOURNAL_CAPACITY = 1 << 20
+# Bytes of message data reserved per event: three-byte messages plus slack for sysex.
+JOURNAL_DATA_PER_EVENT = 4
+_HEADER = struct.Struct('<4sHBxIQQQQd')
+_HEADER_SIZE = 64
+# Where the event count and data size live in the header.
+_COUNT_OFFSET = struct.calcsize('<4sHBxIQQ')
+
+
+class RecordingJournal(RawEventLog):
+    """
+    The raw events of the session being recorded, in a preallocated
+    memory-mapped file.
+
+    The file is a small header followed by the same four columns as a
+    RawEventLog (times, deltas, message ends, message bytes), each sized for
+    `capacity` events. Appending writes an event into the columns and then
+    bumps the event count in the header, so after a crash the file holds
+    every event up to the last complete one. sync() msyncs it to disk, which
+    bounds what a power cut can lose.
+
+    Since the events live in the page cache rather than in Python objects,
+    recording doesn't grow the heap however long the session is. reset()
+    empties the journal for the next session or segment; a journal found
+    non-empty when opened belongs to a session that never finished. grow()
+    makes room for a session longer than the journal was sized for.
+    """
+
+    def __init__(self, path: str, capacity: int = JOURNAL_CAPACITY):
+        self.path = path
+        size = _HEADER_SIZE + capacity * (8 + 8 + 4 + JOURNAL_DATA_PER_EVENT)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.read(fd, _HEADER.size)
+            if len(header) == _HEADER.size and header[:4] == RECORDING_JOURNAL_MAGIC:
+                capacity = _HEADER.unpack(header)[4]
+                size = _HEADER_SIZE + capacity * (8 + 8 + 4 + JOURNAL_DATA_PER_EVENT)
+            if os.fstat(fd).st_size < size:
+                # Reserve the blocks now so a full disk can't fault a write into the map later.
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+        self.data_capacity = capacity * JOURNAL_DATA_PER_EVENT
+        self._view = view = memoryview(self._map)
+        offset = _HEADER_SIZE
+        self._times = view[offset:offset + 8 * capacity].cast('d')
+        offset += 8 * capacity
+        self._deltas = view[offset:offset + 8 * capacity].cast('d')
+        offset += 8 * capacity
+        self._ends = view[offset:offset + 4 * capacity].cast('I')
+        offset += 4 * capacity
+        self._data = view[offset:offset + self.data_capacity]
+        self._count = 0
+        self._size = 0
+        self.segment = 0
+        self.public = False
+        self.started: Optional[float] = None
+        magic, version, public, segment, _, _, count, size, started = _HEADER.unpack_from(self._map)
+        if magic == RECORDING_JOURNAL_MAGIC and version == RECORDING_JOURNAL_VERSION:
+            self._count = min(count, capacity)
+            self._size = self._ends[self._count - 1] if self._count else 0
+            self.segment = segment
+            self.public = bool(public)
+            self.started = started
+        else:
+            self._write_header()
+            self._map.flush()
+
+    def _write_header(self) -> None:
+        _HEADER.pack_into(self._map, 0, RECORDING_JOURNAL_MAGIC, RECORDING_JOURNAL_VERSION, self.public, self.segment,
+                          self.capacity, self.data_capacity, self._count, self._size, self.started or 0.0)
+
+    @property
+    def times(self):
+        return self._times[:self._count]
+
+    @property
+    def deltas(self):
+        return self._deltas[:self._count]
+
+    @property
+    def ends(self):
+        return self._ends[:self._count]
+
+    @property
+    def data(self):
+        return self._data[:self._size]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, t: float, deltatime: float, message) -> bool:
+        """Journal one event; returns False, and journals nothing, if the journal is full."""
+        count = self._count
+        end = self._size + len(message)
+        if count >= self.capacity or end > self.data_capacity:
+            return False
+        self._times[count] = t
+        self._deltas[count] = deltatime
+        self._data[self._size:end] = bytes(message)
+        self._ends[count] = end
+        self._count = count + 1
+        self._size = end
+        struct.pack_into('<QQ', self._map, _COUNT_OFFSET, self._count, end)
+        return True
+
+    def grow(self) -> None:
+        """
+        Double the capacity. The events are copied into a new file, synced and
+        renamed over this one, so a crash part way leaves the old journal intact.
+        """
+        partial = self.path + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        grown = RecordingJournal(partial, self.capacity * 2)
+        count = self._count
+        grown._times[:count] = self._times[:count]
+        grown._deltas[:count] = self._deltas[:count]
+        grown._ends[:count] = self._ends[:count]
+        grown._data[:self._size] = self._data[:self._size]
+        grown._count = count
+        grown._size = self._size
+        grown.started = self.started
+        grown.segment = self.segment
+        grown.public = self.public
+        grown._write_header()
+        grown.close()
+        self.close()
+        os.replace(partial, self.path)
+        # Reopening reads the new capacity and the events back from the header.
+        self.__init__(self.path)
+
+    def reset(self, started: Optional[float] = None, segment: int = 0, public: bool = False) -> None:
+        self._count = 0
+        self._size = 0
+        self.started = started
+        self.segment = segment
+        self.public = public
+        self._write_header()
+        self.sync()
+
+    def sync(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        self.sync()
+        self._times.release()
+        self._deltas.release()
+        self._ends.release()
+        self._data.release()
+        self._view.release()
+        self._map.close()
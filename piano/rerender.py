@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Re-render and re-encode published sessions in bulk.
+
+Finds the sessions in the given directories by their .mid and raw event
+(.events or .json) files, and renders each into --output in every --formats.
+Used after changing the soundfont, the audio formats or how MIDI files are
+built from raw events: with --rebuild-midi, sessions with raw events have
+their MIDI file rebuilt from them, as Recorder does now, and written to
+--output too; so do sessions with raw events but no MIDI file.
+
+Sessions are spread over a process pool, one process per CPU by default, and
+each process keeps one warm synth for all the sessions it renders; each holds
+its own copy of the soundfont in memory. What every finished session was
+rendered from is checkpointed in --output, so an interrupted run picks up
+where it stopped and a session is only rendered again once its source,
+the soundfont or the settings change.
+
+    python rerender.py DIR... --output DIR [--soundfont PATH] [--formats flac,ogg]
+                       [--rebuild-midi] [--workers N] [--force]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional
+
+from audio_encoder import AUDIO_FORMATS, EncoderSink
+from smf_writer import smf_from_raw_events, DEFAULT_BPM
+from synth import Synth, SAMPLE_RATE
+
+CHECKPOINT_NAME = ".rerender-checkpoint.jsonl"
+# Bumped whenever a change here alters the output for the same inputs.
+RERENDER_VERSION = 1
+RAW_SOURCES = (".events", ".json")
+PROGRESS_INTERVAL = 10.0
+HASH_BLOCK_SIZE = 1024 * 1024
+
+log = logging.getLogger('pianobot')
+
+# The synth of this worker process, loaded by its first render and kept for the rest.
+_synth: Optional[Synth] = None
+
+
+def find_sessions(directories: Iterable[str]) -> Dict[str, Dict[str, str]]:
+    """The .mid and raw event files of each session in the directories, by session name."""
+    sessions: Dict[str, Dict[str, str]] = {}
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith((".manifest.json", ".stats.json")):
+                    continue
+                if name.endswith(".mid"):
+                    sessions.setdefault(name[:-len(".mid")], {})["mid"] = os.path.join(root, name)
+                    continue
+                for suffix in RAW_SOURCES:
+                    # .events is preferred to .json when a session has both.
+                    if name.endswith(suffix):
+                        sources = sessions.setdefault(name[:-len(suffix)], {})
+                        if "raw" not in sources or suffix == ".events":
+                            sources["raw"] = os.path.join(root, name)
+    return sessions
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_raw_events(path: str):
+    """(seconds, message) events of a .events or .json raw event file."""
+    if path.endswith(".events"):
+        from raw_event_log import RawEventLog
+        with open(path, "rb") as f:
+            return [(event.t, event.message) for event in RawEventLog.read_from(f)]
+    with open(path, "rb") as f:
+        return [(event[0], event[2]) for event in json.loads(f.read().decode())]
+
+
+def _replace(path: str, data) -> None:
+    with open(path + ".partial", "wb") as f:
+        f.write(data)
+    os.replace(path + ".partial", path)
+
+
+def rerender(session: str, source: str, rebuild: bool, settings: dict, previous: Optional[dict]) -> dict:
+    """
+    Render one session in a worker process. Returns what was done, with the
+    key the outputs were made under; outputs already made under the same key,
+    or a session found empty under it, are left alone.
+    """
+    global _synth
+    started = time.monotonic()
+    with open(source, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(json.dumps([RERENDER_VERSION, rebuild, settings["soundfont_digest"], settings["formats"],
+                                        settings["sample_rate"]]).encode())
+    digest.update(data)
+    key = digest.hexdigest()
+    output = settings["output"]
+    names = [session + "." + AUDIO_FORMATS[name][0] for name in settings["formats"]]
+    if rebuild:
+        names.append(session + ".mid")
+    if previous is not None and key == previous["key"] and (
+            previous.get("empty") or all(os.path.exists(os.path.join(output, name)) for name in names)):
+        return {"session": session, "key": key, "skipped": True}
+
+    if rebuild:
+        midi = smf_from_raw_events(read_raw_events(source), DEFAULT_BPM)
+        if midi is None:
+            return {"session": session, "key": key, "empty": True}
+        _replace(os.path.join(output, session + ".mid"), midi)
+        midi = bytes(midi)
+    else:
+        midi = data
+
+    if _synth is None:
+        _synth = Synth(settings["soundfont"], settings["sample_rate"], name="rerender[%d]" % os.getpid())
+    sink = EncoderSink(settings["formats"], sample_rate=settings["sample_rate"], open_file=lambda extension: open(
+        os.path.join(output, "%s.%s.partial" % (session, extension)), "w+b"))
+    try:
+        frames = _synth.render(midi, sink)
+        encoded = sink.close()
+    except Exception:
+        for name in names:
+            if os.path.exists(os.path.join(output, name + ".partial")):
+                os.remove(os.path.join(output, name + ".partial"))
+        raise
+    for output_file in encoded:
+        output_file.fileobj.close()
+        path = os.path.join(output, "%s.%s" % (session, output_file.extension))
+        os.replace(path + ".partial", path)
+    return {"session": session, "key": key, "outputs": names, "audio_seconds": frames / settings["sample_rate"],
+            "seconds": round(time.monotonic() - started, 3)}
+
+
+def load_checkpoint(path: str) -> Dict[str, dict]:
+    """The checkpoint entry of each session's last render, with the key it was made under."""
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted run may be cut short.
+                    continue
+                entries[entry["session"]] = entry
+    return entries
+
+
+def run(directories: List[str], output: str, soundfont: str, formats: List[str], rebuild: bool = False,
+        workers: Optional[int] = None, force: bool = False, sample_rate: int = SAMPLE_RATE) -> dict:
+    """Re-render every session in the directories into `output`; returns the counts of what was done."""
+    os.makedirs(output, exist_ok=True)
+    checkpoint_path = os.path.join(output, CHECKPOINT_NAME)
+    previous = {} if force else load_checkpoint(checkpoint_path)
+    settings = {"output": output, "soundfont": soundfont, "soundfont_digest": file_digest(soundfont),
+                "formats": formats, "sample_rate": sample_rate}
+
+    jobs = []
+    for session, sources in find_sessions(directories).items():
+        if "raw" in sources and (rebuild or "mid" not in sources):
+            jobs.append((session, sources["raw"], True))
+        elif "mid" in sources:
+            jobs.append((session, sources["mid"], False))
+    # Largest first, so a long session doesn't start last and hold up the end of the run.
+    jobs.sort(key=lambda job: os.path.getsize(job[1]), reverse=True)
+
+    counts = {"sessions": len(jobs), "rendered": 0, "skipped": 0, "failed": 0, "audio_seconds": 0.0}
+    started = time.monotonic()
+    last_progress = started
+    with open(checkpoint_path, "a") as checkpoint, ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(rerender, session, source, rebuild_midi, settings, previous.get(session)): session
+                   for session, source, rebuild_midi in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                log.exception("couldn't re-render %s", futures[future])
+                counts["failed"] += 1
+            else:
+                if result.get("skipped"):
+                    counts["skipped"] += 1
+                else:
+                    # Empty sessions are checkpointed too, so a resumed run doesn't read them again.
+                    if result.get("empty"):
+                        counts["skipped"] += 1
+                    else:
+                        counts["rendered"] += 1
+                        counts["audio_seconds"] += result["audio_seconds"]
+                    checkpoint.write(json.dumps(result) + "\n")
+                    checkpoint.flush()
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                _progress(counts, now - started)
+    counts["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    _progress(counts, counts["elapsed_seconds"])
+    return counts
+
+
+def _progress(counts: dict, elapsed: float) -> None:
+    done = counts["rendered"] + counts["skipped"] + counts["failed"]
+    rate = counts["rendered"] / elapsed * 60 if elapsed else 0.0
+    remaining = counts["sessions"] - done
+    log.info("%d/%d sessions: %d rendered, %d up to date, %d failed; %.1f sessions/min, %.0fx real time%s",
+             done, counts["sessions"], counts["rendered"], counts["skipped"], counts["failed"], rate,
+             counts["audio_seconds"] / elapsed if elapsed else 0.0,
+             ", about %.0f min to go" % (remaining / rate) if rate and remaining else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--output", required=True, help="where the rendered files and the checkpoint go")
+    parser.add_argument("--soundfont", default=os.environ.get("SOUNDFONT_PATH"))
+    parser.add_argument("--formats", default=os.environ.get("AUDIO_FORMATS", "flac"),
+                        help="comma-separated, of %s" % ", ".join(sorted(AUDIO_FORMATS)))
+    parser.add_argument("--rebuild-midi", action="store_true", help="rebuild MIDI files from raw events")
+    parser.add_argument("--workers", type=int, default=None, help="processes, one per CPU by default")
+    parser.add_argument("--force", action="store_true", help="render sessions again even if up to date")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if not args.soundfont:
+        parser.error("--soundfont or SOUNDFONT_PATH is required")
+    formats = [name.strip() for name in args.formats.split(",") if name.strip()]
+    unknown = [name for name in formats if name not in AUDIO_FORMATS]
+    if unknown:
+        parser.error("unknown audio formats: %s" % ", ".join(unknown))
+    counts = run(args.directories, args.output, args.soundfont, formats, rebuild=args.rebuild_midi,
+                 workers=args.workers, force=args.force)
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
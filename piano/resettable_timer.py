@@ -1,42 +1,119 @@
+import heapq
+import itertools
 import logging
-from threading import Thread, Event
+import time
+from threading import Thread, Condition, Lock
 
 from typing import Optional
 
+log = logging.getLogger('pianobot')
+
 
 def ResettableTimer(*args, **kwargs):
     return _ResettableTimer(*args, **kwargs)
 
 
-class _ResettableTimer(Thread):
+class TimerScheduler(Thread):
+    """
+    Single thread that fires every ResettableTimer in the process.
+
+    Timers live in a heap ordered by deadline. Resetting a timer only moves its
+    deadline later, which doesn't touch the heap or wake this thread: when the
+    stale heap entry comes due, the scheduler notices the newer deadline and
+    re-queues the timer instead of firing it.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name="timer_scheduler", daemon=True)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = Condition(Lock())
+
+    def schedule(self, timer: "_ResettableTimer", deadline: float) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), timer))
+            if self._heap[0][2] is timer:
+                self._condition.notify()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                deadline, _, timer = self._heap[0]
+                if timer._cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                if timer._deadline > deadline:
+                    heapq.heapreplace(self._heap, (timer._deadline, next(self._sequence), timer))
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                timer._scheduled = False
+            timer._fire()
+
+
+_scheduler: Optional[TimerScheduler] = None
+_scheduler_lock = Lock()
+
+
+def scheduler() -> TimerScheduler:
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = TimerScheduler()
+                _scheduler.start()
+    return _scheduler
+
+
+class _ResettableTimer(object):
     def __init__(self, interval: float, fn, name: str="", args=[], kwargs={}):
-        Thread.__init__(self)
         self._interval = interval
         self._fn = fn
         self._name = name
         self._args = args
         self._kwargs = kwargs
-        self._finished = Event()
-        self._reset = True
+        self._deadline = 0.0
+        self._scheduled = False
+        self._cancelled = False
+        self._finished = False
+
+    def start(self):
+        self._deadline = time.monotonic() + self._interval
+        self._scheduled = True
+        scheduler().schedule(self, self._deadline)
 
     def cancel(self):
-        logging.debug("timer %s cancelled", self._name)
-        self._finished.set()
+        log.debug("timer %s cancelled", self._name)
+        self._cancelled = True
 
-    def run(self):
-        while self._reset:
-            self._reset = False
-            self._finished.wait(self._interval)
+    def is_alive(self) -> bool:
+        return self._scheduled and not self._cancelled
 
-        if not self._finished.isSet():
-            logging.info("timer %s timed out", self._name)
+    def _fire(self):
+        if self._cancelled or self._finished:
+            return
+        self._finished = True
+        log.info("timer %s timed out", self._name)
+        try:
             self._fn(*self._args, **self._kwargs)
-        self._finished.set()
+        except Exception:
+            log.exception("timer %s callback failed", self._name)
 
     def reset(self, interval: Optional[float]=None):
-        logging.debug("timer %s reset", self._name)
+        if self._cancelled or self._finished:
+            return
         if interval:
             self._interval = interval
-        self._reset = True
-        self._finished.set()
-        self._finished.clear()
+        deadline = time.monotonic() + self._interval
+        moved_earlier = deadline < self._deadline
+        self._deadline = deadline
+        if moved_earlier:
+            scheduler().schedule(self, deadline)
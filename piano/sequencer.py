@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Thread, Condition, Lock
+from typing import List, Optional, Sequence, Tuple
+
+from rtmidi.midiconstants import NOTE_ON, NOTE_OFF  # type: ignore
+
+import flight_recorder
+from metrics import QUEUE_DEPTH, counter, histogram
+
+log = logging.getLogger('pianobot')
+
+LATENESS_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)
+
+LATENESS = histogram("pianobot_sequencer_lateness_seconds", "How late the sequencer sent a message.",
+                     ("sequencer",), buckets=LATENESS_BUCKETS)
+PHRASES = counter("pianobot_sequencer_phrases_total", "Phrases handed to the sequencer, by outcome.",
+                  ("sequencer", "outcome"))
+TRACE_SEND = flight_recorder.register("sequencer.send", "message=0x%06x late=%dus")
+
+# A phrase is a list of (offset in seconds from its start, MIDI message).
+Phrase = Sequence[Tuple[float, List[int]]]
+
+
+class _Playing(object):
+    __slots__ = ("priority", "pending", "sounding", "cancelled")
+
+    def __init__(self, priority: int, pending: int):
+        self.priority = priority
+        self.pending = pending
+        # Notes this phrase turned on and hasn't turned off yet, released if it's cancelled.
+        self.sounding = set()
+        self.cancelled = False
+
+
+class OutputSequencer(Thread):
+    """
+    Sends phrases of MIDI messages to an output port at their scheduled times.
+
+    Messages of every phrase wait in one heap ordered by their due time on the
+    monotonic clock; the thread sleeps until the earliest is due and sends
+    everything due by then in one wake-up, so offsets don't drift the way
+    sleeping between messages does, and a busy caller never delays playback.
+
+    play() returns immediately. A phrase cancels the phrases of equal or lower
+    priority still playing, so the latest feedback wins instead of a backlog
+    playing out; it is itself dropped while a higher-priority phrase plays.
+    Cancelling a phrase releases the notes it left sounding.
+    """
+
+    def __init__(self, out, name: str = "sequencer"):
+        Thread.__init__(self, name=name, daemon=True)
+        self._out = out
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = Condition(Lock())
+        self._playing: List[_Playing] = []
+        self._stopped = False
+        self._lateness = LATENESS.labels(name)
+        self._played = PHRASES.labels(name, "played")
+        self._cancelled = PHRASES.labels(name, "cancelled")
+        self._dropped = PHRASES.labels(name, "dropped")
+        QUEUE_DEPTH.labels(name).set_function(self.pending)
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def set_output(self, out) -> None:
+        """Send to `out` from now on; while it's None, due messages are discarded."""
+        with self._condition:
+            self._out = out
+
+    def play(self, phrase: Phrase, priority: int = 0) -> Optional[_Playing]:
+        """Schedule `phrase` to start now; returns a handle for cancel(), or None if it was dropped."""
+        start = time.monotonic()
+        with self._condition:
+            if any(playing.priority > priority for playing in self._playing):
+                self._dropped.inc()
+                return None
+            for playing in self._playing:
+                self._cancel(playing)
+            handle = _Playing(priority, len(phrase))
+            self._playing = [handle]
+            for offset, message in phrase:
+                heapq.heappush(self._heap, (start + offset, next(self._sequence), handle, message))
+            self._condition.notify()
+        return handle
+
+    def cancel(self, handle: _Playing) -> None:
+        with self._condition:
+            if handle in self._playing:
+                self._cancel(handle)
+                self._playing.remove(handle)
+                self._condition.notify()
+
+    def _cancel(self, playing: _Playing) -> None:
+        # Called with the lock held. The note-offs sort before anything else due,
+        # so they can't cut short the same note in the phrase that replaces this one.
+        playing.cancelled = True
+        self._cancelled.inc()
+        for note in playing.sounding:
+            heapq.heappush(self._heap, (0.0, next(self._sequence), None, [NOTE_OFF, note, 0]))
+        playing.sounding = set()
+
+    def shutdown(self) -> None:
+        with self._condition:
+            for playing in self._playing:
+                self._cancel(playing)
+            self._playing = []
+            self._heap = [entry for entry in self._heap if entry[2] is None]
+            heapq.heapify(self._heap)
+            self._stopped = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self) -> None:
+        while True:
+            due = []
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    if not self._heap:
+                        if self._stopped:
+                            return
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(self._heap[0][0] - time.monotonic())
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, _, playing, message = heapq.heappop(self._heap)
+                    if playing is None:
+                        deadline = None
+                    elif playing.cancelled:
+                        continue
+                    else:
+                        self._track(playing, message)
+                    due.append((deadline, message))
+            for deadline, message in due:
+                self._send(deadline, message)
+
+    def _track(self, playing: _Playing, message: List[int]) -> None:
+        status = message[0] & 0xF0
+        if status == NOTE_ON and message[2] > 0:
+            playing.sounding.add(message[1])
+        elif status in (NOTE_ON, NOTE_OFF):
+            playing.sounding.discard(message[1])
+        playing.pending -= 1
+        if playing.pending == 0:
+            self._played.inc()
+            if playing in self._playing:
+                self._playing.remove(playing)
+
+    def _send(self, deadline: Optional[float], message: List[int]) -> None:
+        out = self._out
+        if out is None:
+            return
+        try:
+            out.send_message(message)
+        except Exception:
+            log.exception("%s: could not send %s", self.name, message)
+            return
+        # Releases of cancelled phrases have no deadline to be late for.
+        late = time.monotonic() - deadline if deadline is not None else 0.0
+        if deadline is not None:
+            self._lateness.observe(late)
+        packed = 0
+        for byte in message[:3]:
+            packed = packed << 8 | byte
+        flight_recorder.record(TRACE_SEND, packed, int(late * 1e6))
+
+
+def notes_phrase(notes: List[int], duration: float, velocity: int) -> List[Tuple[float, List[int]]]:
+    """Each note in turn, held for `duration` seconds."""
+    phrase = []
+    for i, note in enumerate(notes):
+        phrase.append((i * duration, [NOTE_ON, note, velocity]))
+        phrase.append(((i + 1) * duration, [NOTE_OFF, note, velocity]))
+    return phrase
+
+
+def chords_phrase(chords: List[List[int]], duration: float, velocity: int) -> List[Tuple[float, List[int]]]:
+    """Each chord in turn, held for `duration` seconds."""
+    phrase = []
+    for i, chord in enumerate(chords):
+        phrase.extend((i * duration, [NOTE_ON, note, velocity]) for note in chord)
+        phrase.extend(((i + 1) * duration, [NOTE_OFF, note, 0]) for note in chord)
+    return phrase
@@ -0,0 +1,288 @@
+from array import array
+from typing import List, Optional
+
+NANOSECONDS = 1000000000
+NOTES = 128
+PEDALS = {64: "sustain", 66: "sostenuto", 67: "soft"}
+PEDAL_DOWN = 64
+# A gap this long with no key held counts as idle rather than playing time.
+IDLE_GAP_NS = 2 * NANOSECONDS
+# The summary's timelines are cut into at most this many equal buckets.
+TIMELINE_BUCKETS = 120
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+# Krumhansl-Kessler key profiles, from C.
+MAJOR_PROFILE = (6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88)
+MINOR_PROFILE = (6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17)
+
+# Melodic fingerprint: onsets within CHORD_WINDOW_NS of each other count as one,
+# at their highest note; the intervals between those (clamped to an octave)
+# are packed GRAM_BITS apiece into n-grams of GRAM_LENGTH intervals.
+CHORD_WINDOW_NS = 30 * 1000000
+GRAM_LENGTH = 5
+GRAM_BITS = 5
+GRAM_MASK = (1 << GRAM_BITS * GRAM_LENGTH) - 1
+# The most frequent grams kept per session.
+FINGERPRINT_SIZE = 128
+
+
+class MelodyFingerprint(object):
+    """Counts the interval n-grams of a session's top line as its note-ons arrive."""
+
+    def __init__(self):
+        self._group_started = -1
+        self._top = -1
+        self._previous = -1
+        self._gram = 0
+        self._intervals = 0
+        self._counts = {}
+
+    def onset(self, t: int, note: int) -> None:
+        if self._group_started >= 0 and t - self._group_started < CHORD_WINDOW_NS:
+            if note > self._top:
+                self._top = note
+            return
+        self._close_group()
+        self._group_started = t
+        self._top = note
+
+    def _close_group(self) -> None:
+        if self._top < 0:
+            return
+        if self._previous >= 0:
+            interval = max(-12, min(12, self._top - self._previous))
+            self._gram = (self._gram << GRAM_BITS | interval + 12) & GRAM_MASK
+            self._intervals += 1
+            if self._intervals >= GRAM_LENGTH:
+                self._counts[self._gram] = self._counts.get(self._gram, 0) + 1
+        self._previous = self._top
+        self._top = -1
+
+    def grams(self, size: int = FINGERPRINT_SIZE) -> List[int]:
+        """The `size` most frequent grams so far, most frequent first."""
+        self._close_group()
+        counts = self._counts
+        return sorted(counts, key=lambda gram: (-counts[gram], gram))[:size]
+
+
+class SessionStats(object):
+    """
+    Running statistics of one recording session, updated by the Recorder as
+    it records each event, in constant time and without allocating per event
+    beyond amortized array growth.
+
+    Note-ons are paired with their note-offs into key-down durations. Time
+    spent at each polyphony level, note-ons and polyphony per second of the
+    session, and pedal presses and down time are accumulated as they happen.
+    summary() turns the accumulators into a small JSON-friendly dict with
+    NumPy, once, when the session ends.
+    """
+
+    def __init__(self, started: int):
+        self._started = started
+        self._last = started
+        self._pitches = array('L', bytes(NOTES * array('L').itemsize))
+        self._velocities = array('L', bytes(NOTES * array('L').itemsize))
+        self._down_at = array('q', [-1] * NOTES)
+        self._durations = array('q')
+        self._held = 0
+        self._max_held = 0
+        # Nanoseconds spent with exactly n keys down.
+        self._polyphony_ns = array('q', bytes((NOTES + 1) * 8))
+        # Per second since the start: note-ons, and key-down nanoseconds (for mean polyphony).
+        self._notes_per_second = array('L')
+        self._held_ns_per_second = array('q')
+        self._pedal_down_at = {controller: -1 for controller in PEDALS}
+        self._pedal_ns = {controller: 0 for controller in PEDALS}
+        self._pedal_presses = {controller: 0 for controller in PEDALS}
+        self._idle_ns = 0
+        self._melody = MelodyFingerprint()
+        self.notes = 0
+
+    def _advance(self, t: int) -> None:
+        self._grow((t - self._started) // NANOSECONDS)
+        elapsed = t - self._last
+        if elapsed <= 0:
+            return
+        held = self._held
+        self._polyphony_ns[held] += elapsed
+        if held == 0 and elapsed >= IDLE_GAP_NS:
+            self._idle_ns += elapsed
+        if held:
+            # Spread key-down time over the seconds it covers; each second
+            # boundary is crossed once per session, so this stays amortized O(1).
+            per_second = self._held_ns_per_second
+            start = self._last - self._started
+            end = t - self._started
+            second = start // NANOSECONDS
+            while start < end:
+                boundary = min(end, (second + 1) * NANOSECONDS)
+                per_second[second] += held * (boundary - start)
+                start = boundary
+                second += 1
+        self._last = t
+
+    def _grow(self, second: int) -> None:
+        missing = second + 1 - len(self._notes_per_second)
+        if missing > 0:
+            self._notes_per_second.extend(array('L', bytes(missing * self._notes_per_second.itemsize)))
+            self._held_ns_per_second.extend(array('q', bytes(missing * 8)))
+
+    def note_on(self, t: int, note: int, velocity: int) -> None:
+        if velocity == 0:
+            self.note_off(t, note)
+            return
+        self._advance(t)
+        self.notes += 1
+        self._pitches[note] += 1
+        self._velocities[velocity] += 1
+        self._notes_per_second[(t - self._started) // NANOSECONDS] += 1
+        self._melody.onset(t, note)
+        if self._down_at[note] < 0:
+            self._held += 1
+            if self._held > self._max_held:
+                self._max_held = self._held
+        else:
+            # Struck again without a note-off: close the previous one here.
+            self._durations.append(t - self._down_at[note])
+        self._down_at[note] = t
+
+    def note_off(self, t: int, note: int) -> None:
+        self._advance(t)
+        down_at = self._down_at[note]
+        if down_at >= 0:
+            self._durations.append(t - down_at)
+            self._down_at[note] = -1
+            self._held -= 1
+
+    def control_change(self, t: int, controller: int, value: int) -> None:
+        if controller not in PEDALS:
+            return
+        self._advance(t)
+        down_at = self._pedal_down_at[controller]
+        if value >= PEDAL_DOWN and down_at < 0:
+            self._pedal_down_at[controller] = t
+            self._pedal_presses[controller] += 1
+        elif value < PEDAL_DOWN and down_at >= 0:
+            self._pedal_ns[controller] += t - down_at
+            self._pedal_down_at[controller] = -1
+
+    def summary(self, ended: Optional[int] = None) -> dict:
+        """Statistics of the session up to `ended` (the last event if None), as plain numbers and lists."""
+        import numpy as np  # type: ignore
+
+        ended = self._last if ended is None else max(ended, self._last)
+        self._advance(ended)
+        duration = (ended - self._started) / NANOSECONDS
+        active = max(0.0, duration - self._idle_ns / NANOSECONDS)
+
+        pitches = np.asarray(self._pitches, dtype=np.int64)
+        velocities = np.asarray(self._velocities, dtype=np.int64)
+        durations = np.asarray(self._durations, dtype=np.int64) / NANOSECONDS
+        polyphony_ns = np.asarray(self._polyphony_ns, dtype=np.float64)
+        notes_per_second = np.asarray(self._notes_per_second, dtype=np.int64)
+        held_per_second = np.asarray(self._held_ns_per_second, dtype=np.float64) / NANOSECONDS
+        levels = np.arange(len(polyphony_ns))
+        sounding = polyphony_ns[1:].sum()
+        played = np.nonzero(pitches)[0]
+
+        # Timelines: per-second series summed into at most TIMELINE_BUCKETS equal buckets.
+        seconds = len(notes_per_second)
+        bucket = max(1, -(-seconds // TIMELINE_BUCKETS))
+        padded = -(-seconds // bucket) * bucket
+        notes_timeline = np.pad(notes_per_second, (0, padded - seconds), "constant").reshape(-1, bucket)
+        polyphony_timeline = np.pad(held_per_second, (0, padded - seconds), "constant").reshape(-1, bucket)
+
+        key, key_correlation = _estimate_key(np, pitches)
+
+        return {
+            "duration_seconds": round(duration, 3),
+            "active_seconds": round(active, 3),
+            "idle_seconds": round(duration - active, 3),
+            "notes": self.notes,
+            "notes_per_second": {
+                "mean": round(self.notes / active, 2) if active else 0.0,
+                "peak": int(notes_per_second.max()) if seconds else 0,
+            },
+            "polyphony": {
+                "mean": round(float((levels[1:] * polyphony_ns[1:]).sum() / sounding), 2) if sounding else 0.0,
+                "max": self._max_held,
+            },
+            "pitch": {
+                "lowest": int(played[0]) if len(played) else None,
+                "highest": int(played[-1]) if len(played) else None,
+                "mean": round(float((np.arange(NOTES) * pitches).sum() / self.notes), 1) if self.notes else None,
+                "histogram": pitches.tolist(),
+            },
+            "key": key,
+            "key_correlation": key_correlation,
+            "velocity": {
+                "mean": round(float((np.arange(NOTES) * velocities).sum() / self.notes), 1) if self.notes else None,
+                "median": _histogram_percentile(np, velocities, 50),
+                "histogram": velocities.tolist(),
+            },
+            "note_duration_seconds": {
+                "median": round(float(np.median(durations)), 3) if len(durations) else None,
+                "p90": round(float(np.percentile(durations, 90)), 3) if len(durations) else None,
+            },
+            "pedals": {
+                name: {
+                    "presses": self._pedal_presses[controller],
+                    "down_seconds": round(self._pedal_ns_at(controller, ended) / NANOSECONDS, 3),
+                    "down_fraction": round(self._pedal_ns_at(controller, ended) / NANOSECONDS / duration, 3)
+                    if duration else 0.0,
+                } for controller, name in PEDALS.items()
+            },
+            "timeline": {
+                "bucket_seconds": bucket,
+                "notes_per_second": np.round(notes_timeline.mean(axis=1), 2).tolist(),
+                "polyphony": np.round(polyphony_timeline.mean(axis=1), 2).tolist(),
+            },
+            "fingerprint": self._melody.grams(),
+        }
+
+    def _pedal_ns_at(self, controller: int, t: int) -> int:
+        down_at = self._pedal_down_at[controller]
+        return self._pedal_ns[controller] + (t - down_at if down_at >= 0 else 0)
+
+
+def _estimate_key(np, pitches):
+    """Best-correlated major or minor key of the pitch-class histogram, and its correlation."""
+    classes = np.bincount(np.arange(len(pitches)) % 12, weights=pitches, minlength=12)
+    if not classes.any():
+        return None, None
+    profiles = np.array([np.roll(profile, tonic) for profile in (MAJOR_PROFILE, MINOR_PROFILE)
+                         for tonic in range(12)])
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    centered = classes - classes.mean()
+    norm = np.sqrt((centered ** 2).sum() * (profiles ** 2).sum(axis=1))
+    correlations = profiles.dot(centered) / np.where(norm > 0, norm, 1)
+    best = int(correlations.argmax())
+    return "%s %s" % (NOTE_NAMES[best % 12], "major" if best < 12 else "minor"), round(float(correlations[best]), 3)
+
+
+def _histogram_percentile(np, histogram, q: float) -> Optional[int]:
+    total = histogram.sum()
+    if not total:
+        return None
+    return int(np.searchsorted(np.cumsum(histogram), total * q / 100.0))
+
+
+def note_name(note: int) -> str:
+    return "%s%d" % (NOTE_NAMES[note % 12], note // 12 - 1)
+
+
+def describe(file_prefix: str, summary: dict) -> str:
+    """One Slack-formatted line about a session."""
+    minutes, seconds = divmod(int(summary["active_seconds"]), 60)
+    parts = ["%d notes in %d:%02d of playing" % (summary["notes"], minutes, seconds),
+             "%.1f notes/s (peak %d)" % (summary["notes_per_second"]["mean"], summary["notes_per_second"]["peak"]),
+             "polyphony %.1f (max %d)" % (summary["polyphony"]["mean"], summary["polyphony"]["max"])]
+    if summary.get("key"):
+        parts.append("mostly in %s" % summary["key"])
+    if summary["pitch"]["lowest"] is not None:
+        parts.append("range %s-%s" % (note_name(summary["pitch"]["lowest"]), note_name(summary["pitch"]["highest"])))
+        parts.append("median velocity %d" % summary["velocity"]["median"])
+    sustain = summary["pedals"]["sustain"]
+    if sustain["presses"]:
+        parts.append("sustain down %d%% of the time" % round(100 * sustain["down_fraction"]))
+    return "_%s: %s_" % (file_prefix, ", ".join(parts))
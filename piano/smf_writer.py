@@ -0,0 +1,97 @@
+import struct
+from typing import Iterable, List, Optional, Tuple
+
+DEFAULT_BPM = 120
+DEFAULT_TICKS_PER_BEAT = 480
+# Note off, note on and control change on the first channel: what Recorder records.
+RECORDED_STATUSES = frozenset((0x80, 0x90, 0xb0))
+_END_OF_TRACK = b'\x00\xff\x2f\x00'
+
+
+def bpm2tempo(bpm: float) -> int:
+    """Microseconds per beat, as mido.bpm2tempo; kept here so recording doesn't import mido."""
+    return int(round(60 * 1e6 / bpm))
+
+
+class SMFWriter(object):
+    """
+    Incremental single-track Standard MIDI File encoder.
+
+    Events are encoded into one growable bytearray as they arrive, with the
+    same running-status and delta-time rules as mido's MidiFile.save(), so the
+    output is byte-for-byte what the equivalent MidiFile would have produced.
+    The MTrk length is patched in by close(), which returns the finished file
+    without copying it.
+    """
+
+    def __init__(self, bpm: float, ticks_per_beat: int = DEFAULT_TICKS_PER_BEAT):
+        self._ticks_per_beat = ticks_per_beat
+        # Same scale as mido.second2tick, computed once per session.
+        self._seconds_per_tick = bpm2tempo(bpm) * 1e-6 / ticks_per_beat
+        self._data = bytearray(b'MThd' + struct.pack('>Lhhh', 6, 1, 1, ticks_per_beat) + b'MTrk\x00\x00\x00\x00')
+        self._track_start = len(self._data)
+        self._running_status = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    # Both conversions truncate, as int(mido.second2tick(...)) does with the
+    # pinned mido 1.2.9 (1.3 rounds to the nearest tick), with the same float
+    # arithmetic, so delta times come out exactly as they always have.
+    def seconds_to_ticks(self, seconds: float) -> int:
+        return int(seconds / self._seconds_per_tick)
+
+    def ns_to_ticks(self, ns: int) -> int:
+        return int(ns / 1e9 / self._seconds_per_tick)
+
+    def append(self, delta_ticks: int, status: int, data1: int, data2: int) -> None:
+        if self._closed:
+            raise ValueError("SMFWriter is closed")
+        data = self._data
+        if delta_ticks < 0x80:
+            data.append(delta_ticks if delta_ticks > 0 else 0)
+        else:
+            data += _encode_variable_int(delta_ticks)
+        if status == self._running_status:
+            data.append(data1)
+            data.append(data2)
+        else:
+            data.append(status)
+            data.append(data1)
+            data.append(data2)
+            self._running_status = status if status < 0xf0 else None
+
+    def close(self) -> memoryview:
+        if not self._closed:
+            self._data += _END_OF_TRACK
+            struct.pack_into('>L', self._data, self._track_start - 4, len(self._data) - self._track_start)
+            self._closed = True
+        return memoryview(self._data)
+
+
+def smf_from_raw_events(events: Iterable[Tuple[float, List[int]]], bpm: float) -> Optional[memoryview]:
+    """
+    Rebuild the MIDI file of a recording from its raw (seconds, message)
+    events, starting at the first recorded message; None if there are none.
+    Delta times are converted event by event, as Recorder does.
+    """
+    smf = SMFWriter(bpm)
+    previous = None
+    for t, message in events:
+        if len(message) == 3 and message[0] in RECORDED_STATUSES:
+            if previous is None:
+                previous = t
+            smf.append(smf.seconds_to_ticks(t - previous), message[0], message[1], message[2])
+            previous = t
+    return smf.close() if previous is not None else None
+
+
+def _encode_variable_int(value: int) -> bytes:
+    out = [value & 0x7f]
+    value >>= 7
+    while value:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.reverse()
+    return bytes(out)
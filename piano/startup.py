@@ -0,0 +1,41 @@
+import logging
+import os
+import time
+from threading import Lock
+
+from metrics import gauge
+
+log = logging.getLogger('pianobot')
+
+STARTUP = gauge("pianobot_startup_seconds", "Seconds from process start to the end of each startup phase.",
+                ("phase",))
+
+
+def _process_started() -> float:
+    """The monotonic time this process started, including interpreter startup where Linux tells us."""
+    now = time.monotonic()
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 (starttime) in clock ticks since boot; the command name before it may contain spaces.
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return now
+    return now - max(0.0, uptime - started_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+STARTED = _process_started()
+_reached = set()
+_lock = Lock()
+
+
+def reached(phase: str) -> None:
+    """Record that startup got through `phase`; only the first call per phase counts."""
+    with _lock:
+        if phase in _reached:
+            return
+        _reached.add(phase)
+    elapsed = time.monotonic() - STARTED
+    STARTUP.labels(phase).set(elapsed)
+    log.info("startup: %s after %.0fms", phase, elapsed * 1000)
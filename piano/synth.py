@@ -0,0 +1,252 @@
+import logging
+import os
+import time
+import wave
+from concurrent.futures import Future
+from ctypes import create_string_buffer
+from io import BytesIO
+from queue import Queue
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from typing import List, Optional
+
+from metrics import QUEUE_DEPTH, histogram
+
+log = logging.getLogger('pianobot')
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAMES_PER_BLOCK = 4096
+# After the last MIDI event, renders go on until the synth falls silent (the
+# release and reverb of the last notes), but for no longer than this.
+RELEASE_TAIL_SECONDS = 2.0
+# Each worker holds its own copy of the soundfont in memory (~140 MB for FluidR3_GM).
+RENDER_MAX_WORKERS = 2
+
+# pyfluidsynth loads libfluidsynth when imported; render workers import it on
+# their own thread so it stays off the startup path.
+fluidsynth = None
+
+RENDER_DURATION = histogram("pianobot_render_seconds", "Time taken to render and encode one MIDI file.")
+
+
+class WavSink(object):
+    """Receives 16-bit stereo PCM from a render and writes it as a WAV file."""
+
+    def __init__(self, fileobj, sample_rate: int = SAMPLE_RATE):
+        self._fileobj = fileobj
+        self._wav = wave.open(fileobj, "wb")
+        self._wav.setnchannels(CHANNELS)
+        self._wav.setsampwidth(SAMPLE_WIDTH)
+        self._wav.setframerate(sample_rate)
+
+    def write(self, pcm) -> None:
+        self._wav.writeframesraw(pcm)
+
+    def close(self):
+        self._wav.close()
+        return self._fileobj
+
+
+class _Renderer(object):
+    """An in-process FluidSynth instance with the soundfont already loaded."""
+
+    def __init__(self, soundfont_path: str, sample_rate: int):
+        self._sample_rate = sample_rate
+        self._synth = fluidsynth.Synth(samplerate=float(sample_rate))
+        self._sfid = self._synth.sfload(soundfont_path)
+        if self._sfid < 0:
+            raise IOError("could not load soundfont %s" % soundfont_path)
+        self._buffer = create_string_buffer(FRAMES_PER_BLOCK * CHANNELS * SAMPLE_WIDTH)
+
+    def _write_frames(self, frames: int, sink) -> None:
+        while frames > 0:
+            n = min(frames, FRAMES_PER_BLOCK)
+            fluidsynth.fluid_synth_write_s16(self._synth.synth, n, self._buffer, 0, 2, self._buffer, 1, 2)
+            sink.write(memoryview(self._buffer)[:n * CHANNELS * SAMPLE_WIDTH])
+            frames -= n
+
+    def _write_tail(self, sink) -> int:
+        limit = int(RELEASE_TAIL_SECONDS * self._sample_rate)
+        frames = 0
+        while frames < limit:
+            n = min(limit - frames, FRAMES_PER_BLOCK)
+            fluidsynth.fluid_synth_write_s16(self._synth.synth, n, self._buffer, 0, 2, self._buffer, 1, 2)
+            size = n * CHANNELS * SAMPLE_WIDTH
+            if not self._buffer.raw[:size].strip(b"\0"):
+                break
+            sink.write(memoryview(self._buffer)[:size])
+            frames += n
+        return frames
+
+    def render(self, midi_bytes, sink) -> int:
+        from mido import MidiFile  # type: ignore
+
+        synth = self._synth
+        synth.system_reset()
+        elapsed = 0.0
+        rendered = 0
+        for message in MidiFile(file=BytesIO(midi_bytes)):
+            elapsed += message.time
+            due = int(round(elapsed * self._sample_rate))
+            self._write_frames(due - rendered, sink)
+            rendered = max(rendered, due)
+            if message.type == "note_on":
+                synth.noteon(message.channel, message.note, message.velocity)
+            elif message.type == "note_off":
+                synth.noteoff(message.channel, message.note)
+            elif message.type == "control_change":
+                synth.cc(message.channel, message.control, message.value)
+            elif message.type == "program_change":
+                synth.program_change(message.channel, message.program)
+            elif message.type == "pitchwheel":
+                synth.pitch_bend(message.channel, message.pitch)
+        return rendered + self._write_tail(sink)
+
+
+def _render_with_subprocess(soundfont_path: str, sample_rate: int, midi_bytes, sink) -> int:
+    """Fallback: shell out to the fluidsynth binary and stream its WAV into the sink."""
+    from midi2audio import FluidSynth  # type: ignore
+
+    with NamedTemporaryFile("wb", suffix=".mid") as midi_output:
+        midi_output.write(midi_bytes)
+        midi_output.flush()
+        wav_output_name = midi_output.name + ".wav"
+        try:
+            FluidSynth(soundfont_path, sample_rate=sample_rate).midi_to_audio(midi_output.name, wav_output_name)
+            with wave.open(wav_output_name, "rb") as wav:
+                frames = wav.getnframes()
+                while True:
+                    pcm = wav.readframes(FRAMES_PER_BLOCK)
+                    if not pcm:
+                        break
+                    sink.write(pcm)
+        finally:
+            if os.path.exists(wav_output_name):
+                os.remove(wav_output_name)
+    return frames
+
+
+def _load_fluidsynth() -> bool:
+    global fluidsynth
+    if fluidsynth is None:
+        try:
+            import fluidsynth as module  # type: ignore
+        except ImportError:
+            return False
+        fluidsynth = module
+    return True
+
+
+class Synth(object):
+    """
+    Renders MIDI into sinks with a warm in-process synth, loading the
+    soundfont once for every render after. Without pyfluidsynth, or if the
+    synth can't be started, renders run the fluidsynth binary instead.
+    """
+
+    def __init__(self, soundfont_path: str, sample_rate: int = SAMPLE_RATE, name: str = "synth"):
+        self.soundfont_path = soundfont_path
+        self.sample_rate = sample_rate
+        self._renderer = None
+        if _load_fluidsynth():
+            try:
+                self._renderer = _Renderer(soundfont_path, sample_rate)
+            except Exception:
+                log.exception("%s: could not start in-process synth, using the fluidsynth binary", name)
+        else:
+            log.info("%s: pyfluidsynth not available, using the fluidsynth binary", name)
+
+    def render(self, midi_bytes, sink) -> int:
+        """Render `midi_bytes` into `sink`; returns the number of frames rendered."""
+        if self._renderer is not None:
+            return self._renderer.render(midi_bytes, sink)
+        return _render_with_subprocess(self.soundfont_path, self.sample_rate, midi_bytes, sink)
+
+    def close(self) -> None:
+        if self._renderer is not None:
+            self._renderer._synth.delete()
+            self._renderer = None
+
+
+class _RenderWorker(Thread):
+    def __init__(self, service: "RenderService", index: int):
+        Thread.__init__(self, name="render_%d" % index, daemon=True)
+        self._service = service
+
+    def run(self):
+        service = self._service
+        synth = Synth(service.soundfont_path, service.sample_rate, name=self.name)
+        while True:
+            item = service._queue.get()
+            if item is None:
+                service._queue.task_done()
+                break
+            midi_bytes, sink, future = item
+            if future.set_running_or_notify_cancel():
+                started = time.monotonic()
+                try:
+                    frames = synth.render(midi_bytes, sink)
+                    RENDER_DURATION.observe(time.monotonic() - started)
+                    log.info("%s: rendered %.1fs of audio", self.name, frames / service.sample_rate)
+                    future.set_result(sink.close())
+                except Exception as e:
+                    future.set_exception(e)
+            service._queue.task_done()
+        synth.close()
+
+
+class RenderService(object):
+    """
+    Pool of warm synthesizers that render MIDI to PCM in memory.
+
+    Each worker thread has a Synth that loads the soundfont once when the
+    service starts and keeps it for the life of the process, so back-to-back
+    sessions render in parallel without reloading it.
+    """
+
+    def __init__(self, soundfont_path: str, workers: Optional[int] = None, sample_rate: int = SAMPLE_RATE):
+        self.soundfont_path = soundfont_path
+        self.sample_rate = sample_rate
+        if workers is None:
+            workers = min(os.cpu_count() or 1, RENDER_MAX_WORKERS)
+        self._queue: Queue = Queue()
+        QUEUE_DEPTH.labels("render").set_function(self._queue.qsize)
+        self._workers: List[_RenderWorker] = [_RenderWorker(self, i) for i in range(max(1, workers))]
+
+    def start(self) -> None:
+        for worker in self._workers:
+            worker.start()
+
+    def shutdown(self) -> None:
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def submit(self, midi_bytes, sink) -> Future:
+        """Render `midi_bytes` into `sink`; the future resolves to `sink.close()`."""
+        future: Future = Future()
+        self._queue.put((bytes(midi_bytes), sink, future))
+        return future
+
+    def submit_wav(self, midi_bytes, fileobj=None) -> Future:
+        """
+        Render to a WAV file. The future resolves to the WAV bytes, or to
+        `fileobj` (which must be seekable) when one is given.
+        """
+        if fileobj is not None:
+            return self.submit(midi_bytes, WavSink(fileobj, self.sample_rate))
+        future: Future = Future()
+
+        def done(f):
+            if f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                future.set_result(f.result().getvalue())
+
+        self.submit(midi_bytes, WavSink(BytesIO(), self.sample_rate)).add_done_callback(done)
+        return future
+
+    def render_to_fd(self, midi_bytes, fd: int) -> Future:
+        """Render a WAV file into an open, seekable file descriptor."""
+        return self.submit_wav(midi_bytes, os.fdopen(fd, "wb", closefd=False))
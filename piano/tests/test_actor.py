@@ -0,0 +1,94 @@
+import time
+
+import actor
+from actor import Actor, queued, MAX_RESTARTS
+from metrics import REGISTRY
+
+
+class TickingActor(Actor):
+    def __init__(self, name, failing_ticks=0, failing_setups=0):
+        Actor.__init__(self, name, idle_interval=0.001)
+        self.daemon = True
+        self.failing_ticks = failing_ticks
+        self.failing_setups = failing_setups
+        self.ticks = 0
+        self.setups = 0
+        self.handled = []
+        self.restarts = []
+
+    def setup(self):
+        self.setups += 1
+        if self.setups <= self.failing_setups:
+            raise IOError("setup %d failed" % self.setups)
+
+    def tick(self):
+        self.ticks += 1
+        if self.ticks <= self.failing_ticks:
+            raise ValueError("tick %d failed" % self.ticks)
+
+    def restart(self, error):
+        self.restarts.append(error)
+
+    def join_queue(self):
+        self._mailbox.join()
+
+    @queued
+    def handle(self, value):
+        self.handled.append(value)
+
+
+def restarts(name):
+    return REGISTRY.snapshot().get('pianobot_actor_restarts_total{actor="%s"}' % name, 0)
+
+
+def test_tick_that_raises_is_restarted_and_the_actor_carries_on():
+    a = TickingActor("test/tick", failing_ticks=3)
+    a.start()
+    deadline = time.monotonic() + 5
+    while a.ticks <= 3 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    for i in range(5):
+        a.handle(i)
+    a.join_queue()
+    assert a.handled == list(range(5))
+    assert [str(e) for e in a.restarts] == ["tick 1 failed", "tick 2 failed", "tick 3 failed"]
+    assert restarts("test/tick") == 3
+    assert a.is_alive()
+    a.shutdown()
+    a.join(1)
+    assert not a.is_alive()
+
+
+def test_tick_that_keeps_raising_stops_the_actor_and_refuses_calls():
+    a = TickingActor("test/tick-forever", failing_ticks=1000)
+    a.start()
+    a.join(5)
+    assert not a.is_alive()
+    assert len(a.restarts) == MAX_RESTARTS
+    a.handle(1)
+    assert a.handled == []
+
+
+def test_setup_that_raises_is_retried_before_any_call_runs(monkeypatch):
+    monkeypatch.setattr(actor, "SETUP_RETRY_DELAY", 0.01)
+    a = TickingActor("test/setup", failing_setups=2)
+    a.handle("queued before start")
+    a.start()
+    a.join_queue()
+    assert a.setups == 3
+    assert a.handled == ["queued before start"]
+    assert len(a.restarts) == 2
+    a.shutdown()
+    a.join(1)
+
+
+def test_shutdown_while_setup_keeps_failing_drops_queued_calls(monkeypatch):
+    monkeypatch.setattr(actor, "SETUP_RETRY_DELAY", 10)
+    a = TickingActor("test/setup-shutdown", failing_setups=1000)
+    a.handle("never runs")
+    a.start()
+    a.shutdown()
+    a.join(1)
+    assert not a.is_alive()
+    a.join_queue()
+    assert a.handled == []
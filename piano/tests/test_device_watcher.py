@@ -0,0 +1,44 @@
+import threading
+import types
+
+import pytest
+
+import device_watcher
+from device_watcher import DeviceWatcher
+
+
+class FakeMidiIn(object):
+    ports = ["Midi Through Port-0"]
+
+    def get_ports(self):
+        return list(self.ports)
+
+
+def failing_sequencer(name):
+    raise OSError("no ALSA sequencer")
+
+
+@pytest.mark.parametrize("alsa_midi", [None, types.SimpleNamespace(SequencerClient=failing_sequencer)])
+def test_watcher_polls_without_the_alsa_sequencer(monkeypatch, alsa_midi):
+    monkeypatch.setattr(device_watcher, "alsa_midi", alsa_midi)
+    monkeypatch.setattr(device_watcher.rtmidi, "MidiIn", FakeMidiIn, raising=False)
+    monkeypatch.setattr(FakeMidiIn, "ports", ["Midi Through Port-0"])
+    changes = []
+    changed = threading.Event()
+
+    def on_change(ports, detected):
+        changes.append(ports)
+        changed.set()
+
+    watcher = DeviceWatcher(on_change, poll_interval=0.01)
+    watcher.start()
+    try:
+        assert changed.wait(1.0)
+        changed.clear()
+        FakeMidiIn.ports = ["Midi Through Port-0", "Digital Piano MIDI 1"]
+        assert changed.wait(1.0)
+    finally:
+        watcher.shutdown()
+        watcher.join(1.0)
+    assert changes == [["Midi Through Port-0"], ["Midi Through Port-0", "Digital Piano MIDI 1"]]
+    assert not watcher.is_alive()
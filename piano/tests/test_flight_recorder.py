@@ -0,0 +1,31 @@
+import io
+
+import flight_recorder
+from flight_recorder import FlightRecorder, format_payload, read_trace
+
+# Imported for the events they register.
+import actor  # noqa: F401
+import keyboard  # noqa: F401
+import recorder  # noqa: F401
+import sequencer  # noqa: F401
+
+
+def test_every_registered_event_round_trips_through_a_dump():
+    trace = FlightRecorder(capacity=1024)
+    names = list(flight_recorder.TRACE._names)
+    assert ("active_sense_timeout", "timeout=%ds") in names
+    for name, payload_format in names:
+        trace.record(trace.register(name, payload_format), 0x123, 45)
+    dump = io.BytesIO()
+    assert trace.write_to(dump) == len(names)
+    dump.seek(0)
+    _, records = read_trace(dump)
+    assert [(name, payload_format) for _, name, payload_format, _, _ in records] == names
+    for _, name, payload_format, a, b in records:
+        assert (a, b) == (0x123, 45)
+        assert format_payload(payload_format, a, b)
+
+
+def test_single_field_formats_show_only_the_first_payload():
+    assert format_payload("timeout=%ds", 5, 0) == "timeout=5s"
+    assert format_payload("%d%% of %d", 50, 8) == "50% of 8"
@@ -0,0 +1,38 @@
+import pytest
+
+from hotkeys import HotkeyMatcher
+
+NANOSECONDS = 1000000000
+C, D, E = 60, 62, 64
+
+
+def play(sequence, notes, window=None, gap=0.1):
+    fired = []
+    matcher = HotkeyMatcher([{"sequence": sequence, "window": window, "fn": lambda: fired.append(True)}])
+    results = []
+    for i, note in enumerate(notes):
+        results.append(matcher.note_on(note, int(i * gap * NANOSECONDS)))
+        matcher.note_off(note)
+    return results
+
+
+@pytest.mark.parametrize("sequence, notes", [
+    ([C, C, D], [C, C, C, D]),
+    ([C, C, D], [C, C, C, C, C, D]),
+    ([C, D, C, E], [C, D, C, D, C, E]),
+    ([C, D, E], [C, D, C, D, E]),
+    ([C, C, D], [C, C, D]),
+])
+def test_sequence_fires_when_it_repeats_its_own_opening(sequence, notes):
+    assert play(sequence, notes) == [False] * (len(notes) - 1) + [True]
+
+
+@pytest.mark.parametrize("notes", [[C, C, E, D], [C, E, C, D], [C, D]])
+def test_sequence_does_not_fire_on_other_notes(notes):
+    assert not any(play([C, C, D], notes))
+
+
+def test_fallback_keeps_only_the_notes_within_the_window():
+    # C-C-C-D over 0.9s: only the last C-C-D is within 0.5s.
+    assert play([C, C, D], [C, C, C, D], window=0.5, gap=0.3) == [False, False, False, False]
+    assert play([C, C, D], [C, C, C, D], window=0.7, gap=0.3) == [False, False, False, True]
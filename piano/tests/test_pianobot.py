@@ -0,0 +1,34 @@
+from unittest import mock
+
+import pytest
+
+from pianobot import Pianobot
+
+
+@pytest.fixture
+def pianobot(tmp_path):
+    bot = Pianobot(["Digital Piano:0"], publisher=mock.MagicMock(), journal_path=str(tmp_path / "recording.journal"))
+    yield bot
+    for instrument in bot.instruments():
+        bot.remove_port(instrument.port_name)
+
+
+def test_single_configured_port_keeps_unqualified_names(pianobot, tmp_path):
+    pianobot.add_port("Digital Piano:0")
+    instrument, = pianobot.instruments()
+    assert instrument.name is None
+    assert pianobot._journal_for(instrument.name) == str(tmp_path / "recording.journal")
+
+
+def test_port_added_at_runtime_is_named_apart_from_the_configured_one(pianobot):
+    pianobot.add_port("Digital Piano:0")
+    pianobot.add_port("Stage Piano:1")
+    names = [instrument.name for instrument in pianobot.instruments()]
+    assert names == [None, "stage-piano-1"]
+    assert len({pianobot._journal_for(name) for name in names}) == 2
+
+
+def test_ports_with_the_same_slug_get_distinct_names(pianobot):
+    pianobot.add_port("Stage Piano:1")
+    pianobot.add_port("Stage-Piano 1")
+    assert [instrument.name for instrument in pianobot.instruments()] == ["stage-piano-1", "stage-piano-1-2"]
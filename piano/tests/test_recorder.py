@@ -0,0 +1,94 @@
+import time
+from unittest import mock
+
+import pytest
+
+from recorder import Recorder
+from recording_journal import RecordingJournal
+
+NANOSECONDS = 1000000000
+
+
+def record(tmp_path, seconds, **options):
+    publisher = mock.MagicMock()
+    recorder = Recorder(mock.MagicMock(), publisher, journal_path=str(tmp_path / "recording.journal"), **options)
+    recorder._armed = True
+    t = NANOSECONDS
+    for i in range(int(seconds)):
+        recorder.record_event("note_on", 60 + i % 12, 64, t, 0.0)
+        recorder.record_event("note_off", 60 + i % 12, 0, t + NANOSECONDS // 2, 0.0)
+        t += NANOSECONDS
+    Recorder.stop_recording.__wrapped__(recorder)
+    return publisher
+
+
+@pytest.mark.parametrize("options, parts", [({}, 1), ({"segment_seconds": 600}, 3)])
+def test_segmenting_is_opt_in(tmp_path, options, parts):
+    publisher = record(tmp_path, 25 * 60, **options)
+    assert publisher.publish_midi_file.call_count == parts
+    assert publisher.publish_manifest.called == (parts > 1)
+
+
+def test_idle_recorder_sleeps_until_an_event_arrives(tmp_path):
+    recorder = Recorder(mock.MagicMock(), mock.MagicMock(), journal_path=str(tmp_path / "recording.journal"),
+                        name="wakeup")
+    recorder.daemon = True
+    ticks = []
+    tick = recorder.tick
+    recorder.tick = lambda: (ticks.append(time.monotonic()), tick())
+    recorder.start()
+    try:
+        time.sleep(0.3)
+        assert len(ticks) <= 2
+        pushed = time.monotonic()
+        recorder.events.push(NANOSECONDS, [0x90, 60, 64], 0.0)
+        deadline = pushed + 1.0
+        while len(recorder.events) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert not len(recorder.events)
+        assert ticks[-1] - pushed < 0.1
+    finally:
+        recorder.shutdown()
+        recorder.join()
+
+
+
+def test_failed_summary_leaves_the_recorder_ready_for_the_next_session(tmp_path):
+    publisher = mock.MagicMock()
+    recorder = Recorder(mock.MagicMock(), publisher, journal_path=str(tmp_path / "recording.journal"))
+    recorder._armed = True
+    recorder.record_event("note_on", 60, 64, NANOSECONDS, 0.0)
+    recorder.record_event("note_off", 60, 0, 2 * NANOSECONDS, 0.0)
+    with mock.patch.object(recorder._stats, "summary", side_effect=ImportError("no numpy")):
+        with pytest.raises(ImportError):
+            Recorder.stop_recording.__wrapped__(recorder)
+    assert publisher.publish_midi_file.call_count == 1
+    assert recorder._stats is None and recorder._started_recording is None and not len(recorder._raw_events)
+
+    recorder.record_event("note_on", 62, 64, 10 * NANOSECONDS, 0.0)
+    recorder.record_event("note_off", 62, 0, 11 * NANOSECONDS, 0.0)
+    Recorder.stop_recording.__wrapped__(recorder)
+    assert publisher.publish_midi_file.call_count == 2
+    assert publisher.publish_stats.call_args[0][1]["notes"] == 1
+
+
+@pytest.mark.parametrize("segment_seconds, parts", [(0, 1), (600, 2)])
+def test_full_journal_grows_unless_segmenting(tmp_path, segment_seconds, parts):
+    publisher = mock.MagicMock()
+    recorder = Recorder(mock.MagicMock(), publisher, journal_path=str(tmp_path / "recording.journal"),
+                        segment_seconds=segment_seconds)
+    recorder._raw_events.close()
+    recorder._raw_events = RecordingJournal(str(tmp_path / "small.journal"), capacity=16)
+    recorder._armed = True
+    t = NANOSECONDS
+    for i in range(20):
+        recorder.record_event("note_on", 60, 64, t, 0.0)
+        recorder.record_raw_event(t, [0x90, 60, 64], 0.0, None)
+        t += NANOSECONDS // 10
+    journal = recorder._raw_events
+    assert len(journal) == (20 if parts == 1 else 4)
+    assert [bytes(event.message) for event in journal] == [b"\x90\x3c\x40"] * len(journal)
+    assert list(journal.times) == sorted(journal.times)
+    Recorder.stop_recording.__wrapped__(recorder)
+    assert publisher.publish_midi_file.call_count == parts
+    assert publisher.publish_manifest.called == (parts > 1)
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import rerender
+
+
+class ThreadPool(object):
+    """Runs the jobs in this process, so the test can see what they read."""
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(workers)
+
+    def __enter__(self):
+        return self._executor
+
+    def __exit__(self, *exc_info):
+        self._executor.shutdown()
+
+
+def test_cli_does_not_import_the_recording_runtime():
+    imported = subprocess.check_output([sys.executable, "-c", "import sys, rerender; print(sorted(sys.modules))"],
+                                       cwd=os.path.dirname(os.path.abspath(rerender.__file__)))
+    for module in ("recorder", "rtmidi", "actor", "publisher"):
+        assert "'%s'" % module not in imported.decode()
+
+
+def test_empty_sessions_are_checkpointed(tmp_path, monkeypatch):
+    sessions = tmp_path / "sessions"
+    sessions.mkdir()
+    # Only active sensing: nothing Recorder would have written to the MIDI file.
+    (sessions / "piano-20260101120000.json").write_text(json.dumps([[1.0, 0.0, [0xfe], None]]))
+    soundfont = tmp_path / "piano.sf2"
+    soundfont.write_bytes(b"soundfont")
+    output = tmp_path / "output"
+    reads = []
+    monkeypatch.setattr(rerender, "ProcessPoolExecutor", ThreadPool)
+    monkeypatch.setattr(rerender, "read_raw_events", lambda path: reads.append(path) or [(1.0, [0xfe])])
+
+    for _ in range(2):
+        counts = rerender.run([str(sessions)], str(output), str(soundfont), ["flac"], workers=1)
+        assert (counts["sessions"], counts["skipped"], counts["failed"]) == (1, 1, 0)
+    assert len(reads) == 1
+    entries = rerender.load_checkpoint(str(output / rerender.CHECKPOINT_NAME))
+    assert entries["piano-20260101120000"]["empty"]
@@ -0,0 +1,105 @@
+import random
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from mido import MidiFile, MidiTrack, Message, bpm2tempo  # type: ignore
+
+from recorder import Recorder
+from smf_writer import SMFWriter, smf_from_raw_events, DEFAULT_BPM
+
+NANOSECONDS = 1000000000
+
+
+def performance(n, seed=0):
+    """(event, note, velocity, monotonic ns) with chords, pedalling and gaps needing multi-byte deltas."""
+    rng = random.Random(seed)
+    t = 123 * NANOSECONDS + rng.randrange(NANOSECONDS)
+    events = []
+    for _ in range(n):
+        t += int(rng.choice((0, 0.0005, 0.013, 0.25, 0.7, 3.2, 9.9)) * rng.random() * NANOSECONDS)
+        kind = rng.random()
+        if kind < 0.45:
+            events.append(("note_on", rng.randrange(21, 109), rng.randrange(1, 128), t))
+        elif kind < 0.9:
+            events.append(("note_off", rng.randrange(21, 109), rng.randrange(0, 128), t))
+        else:
+            events.append(("control_change", rng.choice((64, 66, 67)), rng.randrange(0, 128), t))
+    return events
+
+
+def second2tick(second, ticks_per_beat, tempo):
+    """mido.second2tick as of mido 1.2.9, the version requirements.txt pins; 1.3 rounds the result."""
+    scale = tempo * 1e-6 / ticks_per_beat
+    return second / scale
+
+
+def mido_file(events):
+    """The events through mido the way Recorder.record_event did before SMFWriter."""
+    midifile = MidiFile()
+    track = MidiTrack()
+    midifile.tracks.append(track)
+    last = None
+    for event, note, velocity, t in events:
+        if last is None:
+            last = t
+        ticks = int(second2tick((t - last) / NANOSECONDS, midifile.ticks_per_beat, bpm2tempo(DEFAULT_BPM)))
+        if event == "control_change":
+            track.append(Message(event, control=note, value=velocity, time=ticks))
+        else:
+            track.append(Message(event, note=note, velocity=velocity, time=ticks))
+        last = t
+    out = BytesIO()
+    midifile.save(file=out)
+    return out.getvalue()
+
+
+@pytest.fixture
+def recorder(tmp_path):
+    recorder = Recorder(mock.MagicMock(), mock.MagicMock(), segment_seconds=0,
+                        journal_path=str(tmp_path / "recording.journal"))
+    recorder._armed = True
+    yield recorder
+    if recorder._recording_timeout is not None:
+        recorder._recording_timeout.cancel()
+
+
+@pytest.mark.parametrize("n", [1, 2, 100, 5000])
+def test_recorder_midi_matches_mido(recorder, n):
+    events = performance(n)
+    for event, note, velocity, t in events:
+        recorder.record_event(event, note, velocity, t, 0.0)
+    assert bytes(recorder._smf.close()) == mido_file(events)
+
+
+def test_conversions_truncate_like_mido_1_2():
+    smf = SMFWriter(DEFAULT_BPM)
+    tick = bpm2tempo(DEFAULT_BPM) * 1000 // smf._ticks_per_beat
+    assert smf.ns_to_ticks(0) == 0
+    assert smf.ns_to_ticks(tick - 1) == 0
+    assert smf.ns_to_ticks(tick + 1) == 1
+    assert smf.ns_to_ticks(10 * tick + 2 * tick // 3) == 10
+    for ns in range(0, 50 * tick, 997):
+        expected = int(second2tick(ns / NANOSECONDS, smf._ticks_per_beat, bpm2tempo(DEFAULT_BPM)))
+        assert smf.ns_to_ticks(ns) == smf.seconds_to_ticks(ns / NANOSECONDS) == expected
+
+
+def test_rebuilt_from_raw_events_matches_mido():
+    events = performance(1000, seed=1)
+    raw = [((t - events[0][3]) / NANOSECONDS + 1.7e9,
+            [{"note_on": 0x90, "note_off": 0x80, "control_change": 0xb0}[event], note, velocity])
+           for event, note, velocity, t in events]
+    # Raw events carry float wall-clock seconds, as Recorder's events did
+    # before the nanosecond clock; compare against mido given those seconds.
+    midifile = MidiFile()
+    track = MidiTrack()
+    midifile.tracks.append(track)
+    last = raw[0][0]
+    for seconds, message in raw:
+        ticks = int(second2tick(seconds - last, midifile.ticks_per_beat, bpm2tempo(DEFAULT_BPM)))
+        track.append(Message.from_bytes(message, time=ticks))
+        last = seconds
+    out = BytesIO()
+    midifile.save(file=out)
+    assert bytes(smf_from_raw_events(raw, DEFAULT_BPM)) == out.getvalue()
+    assert smf_from_raw_events([], DEFAULT_BPM) is None
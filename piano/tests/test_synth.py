@@ -0,0 +1,77 @@
+import ctypes
+import types
+
+import pytest
+
+import synth
+from smf_writer import SMFWriter
+
+SAMPLE_RATE = 1000
+FRAMES_PER_BLOCK = 100
+
+
+class FakeFluidSynth(object):
+    """Stands in for pyfluidsynth: a note sounds until `release` seconds after its note-off."""
+
+    def __init__(self, release):
+        self.release = release
+        self.module = types.SimpleNamespace(Synth=self._synth, fluid_synth_write_s16=self._write)
+
+    def _synth(self, samplerate):
+        self.frame = 0
+        self.sounding = {}
+        self.released = {}
+        return types.SimpleNamespace(synth=self, sfload=lambda path: 1, system_reset=lambda: None, delete=lambda: None,
+                                     noteon=self._noteon, noteoff=self._noteoff)
+
+    def _noteon(self, channel, note, velocity):
+        self.sounding[note] = True
+
+    def _noteoff(self, channel, note):
+        self.sounding.pop(note, None)
+        self.released[note] = self.frame + int(self.release * SAMPLE_RATE)
+
+    def _write(self, synth, n, buffer, *offsets):
+        for i in range(n):
+            self.released = {note: end for note, end in self.released.items() if end > self.frame}
+            loud = self.sounding or self.released
+            ctypes.memset(ctypes.addressof(buffer) + i * 4, 1 if loud else 0, 4)
+            self.frame += 1
+
+
+class Sink(object):
+    def __init__(self):
+        self.pcm = bytearray()
+
+    def write(self, pcm):
+        self.pcm += pcm
+
+
+def note(seconds, release=True):
+    midi = SMFWriter(120)
+    midi.append(0, 0x90, 60, 80)
+    if release:
+        midi.append(midi.seconds_to_ticks(seconds), 0x80, 60, 0)
+    else:
+        midi.append(midi.seconds_to_ticks(seconds), 0x90, 62, 80)
+    return bytes(midi.close())
+
+
+@pytest.mark.parametrize("release, tail", [(0.5, 0.5), (0.0, 0.0), (10.0, synth.RELEASE_TAIL_SECONDS)])
+def test_render_runs_past_the_last_note_off(monkeypatch, release, tail):
+    monkeypatch.setattr(synth, "fluidsynth", FakeFluidSynth(release).module)
+    monkeypatch.setattr(synth, "FRAMES_PER_BLOCK", FRAMES_PER_BLOCK)
+    sink = Sink()
+    frames = synth.Synth("soundfont.sf2", SAMPLE_RATE).render(note(1.0), sink)
+    assert len(sink.pcm) == frames * synth.CHANNELS * synth.SAMPLE_WIDTH
+    # The tail stops at the first silent block, so it may run up to a block past the release.
+    assert (1.0 + tail) * SAMPLE_RATE <= frames <= (1.0 + tail) * SAMPLE_RATE + FRAMES_PER_BLOCK
+    assert frames <= (1.0 + synth.RELEASE_TAIL_SECONDS) * SAMPLE_RATE
+
+
+def test_tail_of_held_notes_is_capped(monkeypatch):
+    monkeypatch.setattr(synth, "fluidsynth", FakeFluidSynth(0.5).module)
+    monkeypatch.setattr(synth, "FRAMES_PER_BLOCK", FRAMES_PER_BLOCK)
+    sink = Sink()
+    frames = synth.Synth("soundfont.sf2", SAMPLE_RATE).render(note(1.0, release=False), sink)
+    assert frames == (1.0 + synth.RELEASE_TAIL_SECONDS) * SAMPLE_RATE
@@ -0,0 +1,69 @@
+import io
+from email.parser import BytesParser
+from unittest import mock
+
+import requests
+
+from uploaders import DriveBackend, SlackBackend, RESUMABLE_UPLOAD_THRESHOLD
+
+
+def response(status_code=200, body=None, headers=None):
+    return mock.MagicMock(status_code=status_code, headers=headers or {}, json=lambda: body or {"ok": True, "id": "1"})
+
+
+def sent_body(call):
+    body = call[1]["data"]
+    assert hasattr(body, "read"), "the body should be streamed, not built in memory"
+    prepared = requests.Request("POST", "http://localhost/", data=body, headers=call[1]["headers"]).prepare()
+    assert prepared.body is body
+    assert prepared.headers["Content-Length"] == str(len(body))
+    data = body.read()
+    assert len(data) == len(body)
+    return prepared.headers["Content-Type"], data
+
+
+def parts(content_type, data):
+    message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + data)
+    return [(part.get_param("name", header="content-disposition"), part.get_payload(decode=True))
+            for part in message.get_payload()]
+
+
+def test_slack_upload_streams_the_file():
+    slack = SlackBackend("token")
+    slack._session = mock.MagicMock()
+    slack._session.post.return_value = response()
+    artifact = io.BytesIO(b"\x00\x01audio\r\n--" * 1000)
+    slack.upload("channel", 'take "one".flac', artifact)
+    content_type, data = sent_body(slack._session.post.call_args)
+    assert dict(parts(content_type, data)) == {"channels": b"channel", "title": b'take "one".flac',
+                                               "filename": b'take "one".flac', "token": b"token",
+                                               "file": artifact.getvalue()}
+
+
+def test_drive_upload_streams_small_files():
+    drive = DriveBackend(None, "folder")
+    drive._session = mock.MagicMock()
+    drive._session.post.return_value = response()
+    artifact = io.BytesIO(b"ogg" * 1000)
+    assert drive.upload("take.ogg", "audio/ogg", artifact) == "1"
+    content_type, data = sent_body(drive._session.post.call_args)
+    (_, metadata), (_, payload) = parts(content_type, data)
+    assert b'"title": "take.ogg"' in metadata
+    assert payload == artifact.getvalue()
+
+
+def test_drive_upload_of_large_files_is_resumable():
+    drive = DriveBackend(None, "folder")
+    drive._session = mock.MagicMock()
+    drive._session.post.return_value = response(headers={"Location": "http://localhost/session"})
+    size = 2 * RESUMABLE_UPLOAD_THRESHOLD + 1
+
+    def put(uri, data, headers, **kwargs):
+        last = int(headers["Content-Range"].split("-")[1].split("/")[0])
+        return response(200) if last == size - 1 else response(308, headers={"Range": "bytes=0-%d" % last})
+
+    drive._session.put.side_effect = put
+    assert drive.upload("take.flac", "audio/flac", b"f" * size) == "1"
+    assert drive._session.post.call_args[1]["params"]["uploadType"] == "resumable"
+    chunks = [len(call[1]["data"]) for call in drive._session.put.call_args_list]
+    assert sum(chunks) == size and max(chunks) <= RESUMABLE_UPLOAD_THRESHOLD
@@ -0,0 +1,63 @@
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread
+from typing import Dict, List
+
+from metrics import QUEUE_DEPTH
+
+
+class _DestinationWorker(Thread):
+    def __init__(self, destination: str, queue: Queue, index: int):
+        Thread.__init__(self, name="upload_%s_%d" % (destination, index), daemon=True)
+        self.destination = destination
+        self._queue = queue
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            fn, args, future = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            self._queue.task_done()
+
+
+class UploadStage(object):
+    """
+    Runs uploads on a fixed set of worker threads per destination.
+
+    Each destination ("slack", "drive", ...) has its own queue and as many
+    workers as its concurrency limit, so uploads of one artifact to different
+    destinations run at the same time and a slow destination only delays its
+    own queue.
+    """
+
+    def __init__(self, concurrency: Dict[str, int]):
+        self._queues: Dict[str, Queue] = {}
+        self._workers: List[_DestinationWorker] = []
+        for destination, limit in concurrency.items():
+            queue: Queue = Queue()
+            self._queues[destination] = queue
+            QUEUE_DEPTH.labels("upload_" + destination).set_function(queue.qsize)
+            self._workers.extend(_DestinationWorker(destination, queue, i) for i in range(max(1, limit)))
+
+    def start(self) -> None:
+        for worker in self._workers:
+            worker.start()
+
+    def shutdown(self) -> None:
+        for worker in self._workers:
+            self._queues[worker.destination].put(None)
+
+    def submit(self, destination: str, fn, *args) -> Future:
+        future: Future = Future()
+        self._queues[destination].put((fn, args, future))
+        return future
+
+    def pending(self, destination: str) -> int:
+        return self._queues[destination].qsize()
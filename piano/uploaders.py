@@ -0,0 +1,342 @@
+import io
+import json
+import logging
+import os
+import time
+import uuid
+from base64 import b64decode
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests  # type: ignore
+
+log = logging.getLogger('pianobot')
+
+SLACK_API_URL = "https://slack.com/api"
+GOOGLE_API_URL = "https://www.googleapis.com"
+GOOGLE_SCOPES = ['https://www.googleapis.com/auth/drive']
+UPLOAD_TIMEOUT = 120
+IDEMPOTENCY_PROPERTY = "pianobot_id"
+# Drive requires resumable chunks to be multiples of 256 KiB.
+RESUMABLE_CHUNK_GRANULARITY = 256 * 1024
+DRIVE_CHUNK_SIZE = 4 * RESUMABLE_CHUNK_GRANULARITY
+# DriveBackend.upload() switches to the resumable protocol for files larger than this.
+RESUMABLE_UPLOAD_THRESHOLD = DRIVE_CHUNK_SIZE
+
+
+class UploadError(Exception):
+    pass
+
+
+def _session(max_concurrency: int, session: Optional["requests.Session"] = None) -> "requests.Session":
+    # requests is imported by whichever thread builds the first backend, not at startup.
+    import requests  # type: ignore
+    from requests.adapters import HTTPAdapter  # type: ignore
+
+    session = session if session is not None else requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _file(data):
+    """`data` as a seekable file object at its start; bytes-like data is wrapped, not copied again."""
+    if hasattr(data, "read"):
+        data.seek(0)
+        return data
+    return io.BytesIO(data)
+
+
+class _MultipartBody(object):
+    """
+    A request body read part by part from bytes and seekable file objects, so
+    requests streams an artifact from disk instead of holding it in memory.
+    Its length is known up front and sent as Content-Length.
+    """
+
+    def __init__(self, parts):
+        self._parts = []
+        self._length = 0
+        for part in parts:
+            part = _file(part)
+            part.seek(0, 2)
+            self._length += part.tell()
+            part.seek(0)
+            self._parts.append(part)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._parts and size:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+
+def _form_data(boundary: str, fields: dict, files: dict) -> _MultipartBody:
+    """A multipart/form-data body of the fields and the (filename, data) files."""
+    delimiter = b"--" + boundary.encode()
+    parts = []
+    for name, value in fields.items():
+        parts.append(b'%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (
+            delimiter, name.encode(), str(value).encode()))
+    for name, (filename, data) in files.items():
+        parts.append(b'%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                     b'Content-Type: application/octet-stream\r\n\r\n' % (
+                         delimiter, name.encode(), filename.replace('"', "%22").encode()))
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(delimiter + b"--\r\n")
+    return _MultipartBody(parts)
+
+
+class SlackBackend(object):
+    """Slack Web API client sharing one connection pool across upload workers."""
+
+    def __init__(self, api_token: str, max_concurrency: int = 2, base_url: str = SLACK_API_URL):
+        self._api_token = api_token
+        self._base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self._session = _session(max_concurrency)
+
+    def _call(self, method: str, data: dict, files: Optional[dict] = None) -> dict:
+        data = dict(data, token=self._api_token)
+        headers = None
+        if files is not None:
+            boundary = uuid.uuid4().hex
+            data = _form_data(boundary, data, files)
+            headers = {"Content-Type": "multipart/form-data; boundary=%s" % boundary}
+        response = self._session.post("%s/%s" % (self._base_url, method), data=data, headers=headers,
+                                      timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200:
+            raise UploadError("slack %s: HTTP %d" % (method, response.status_code))
+        result = response.json()
+        if not result.get("ok"):
+            raise UploadError("slack %s: %s" % (method, result.get("error")))
+        return result
+
+    def post_message(self, channel: str, text: str) -> None:
+        self._call("chat.postMessage", {"channel": channel, "text": text})
+
+    def upload(self, channel: str, name: str, data) -> None:
+        self._call("files.upload", {"channels": channel, "title": name, "filename": name},
+                   files={"file": (name, data)})
+
+
+class DriveBackend(object):
+    """
+    Google Drive v2 client sharing one authorized connection pool across
+    upload workers. `credentials` may be None when talking to a local
+    stand-in server.
+    """
+
+    def __init__(self, credentials, folder_id: str, max_concurrency: int = 2, base_url: str = GOOGLE_API_URL):
+        self._folder_id = folder_id
+        self._base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        if credentials is not None:
+            from google.auth.transport.requests import AuthorizedSession  # type: ignore
+            self._session = _session(max_concurrency, AuthorizedSession(credentials))
+        else:
+            self._session = _session(max_concurrency)
+
+    def find(self, idempotency_key: str) -> Optional[str]:
+        """Id of a file previously uploaded with `idempotency_key`, if any."""
+        query = "properties has { key='%s' and value='%s' and visibility='PRIVATE' }" % (
+            IDEMPOTENCY_PROPERTY, idempotency_key)
+        response = self._session.get("%s/drive/v2/files" % self._base_url, params={"q": query, "fields": "items/id"},
+                                     timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200:
+            raise UploadError("drive lookup of %s: HTTP %d" % (idempotency_key, response.status_code))
+        items = response.json().get("items", [])
+        return items[0]["id"] if items else None
+
+    def _existing(self, name: str, idempotency_key: Optional[str], check_existing: bool) -> Optional[str]:
+        if idempotency_key is None or not check_existing:
+            return None
+        existing = self.find(idempotency_key)
+        if existing is not None:
+            log.info("drive: %s was already uploaded as %s", name, existing)
+        return existing
+
+    def _metadata(self, name: str, idempotency_key: Optional[str]) -> dict:
+        metadata = {
+            'title': name,
+            'parents': [{'id': self._folder_id}]
+        }
+        if idempotency_key is not None:
+            metadata['properties'] = [{'key': IDEMPOTENCY_PROPERTY, 'value': idempotency_key, 'visibility': 'PRIVATE'}]
+        return metadata
+
+    def upload(self, name: str, mime: str, data, idempotency_key: Optional[str] = None,
+               check_existing: bool = False) -> str:
+        """
+        Uploads `data` as `name`. With an idempotency key the file is tagged
+        with it, and `check_existing` skips the upload if an earlier attempt
+        already got through. Files larger than RESUMABLE_UPLOAD_THRESHOLD go
+        through upload_resumable(), a chunk at a time.
+        """
+        data = _file(data)
+        data.seek(0, 2)
+        if data.tell() > RESUMABLE_UPLOAD_THRESHOLD:
+            return self.upload_resumable(name, mime, data, idempotency_key, check_existing)
+        existing = self._existing(name, idempotency_key, check_existing)
+        if existing is not None:
+            return existing
+        metadata = self._metadata(name, idempotency_key)
+        boundary = uuid.uuid4().hex
+        delimiter = b"--" + boundary.encode()
+        body = _MultipartBody([
+            delimiter + b"\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n",
+            json.dumps(metadata).encode() + b"\r\n",
+            delimiter + b"\r\nContent-Type: " + mime.encode() + b"\r\n\r\n",
+            data,
+            b"\r\n" + delimiter + b"--\r\n",
+        ])
+        response = self._session.post("%s/upload/drive/v2/files" % self._base_url,
+                                      params={"uploadType": "multipart", "fields": "id"},
+                                      headers={"Content-Type": "multipart/related; boundary=%s" % boundary},
+                                      data=body, timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200:
+            raise UploadError("drive upload of %s: HTTP %d" % (name, response.status_code))
+        return response.json().get("id")
+
+    def upload_resumable(self, name: str, mime: str, source, idempotency_key: Optional[str] = None,
+                         check_existing: bool = False, session_path: Optional[str] = None,
+                         chunk_size: int = DRIVE_CHUNK_SIZE) -> str:
+        """
+        Uploads a file (path or seekable file object) with Drive's resumable
+        protocol, reading and sending it `chunk_size` bytes at a time.
+
+        The upload session URI is saved to `session_path`, so a later call for
+        the same file (after a network error or a restart) asks Drive how much
+        it already has and continues from there.
+        """
+        if chunk_size % RESUMABLE_CHUNK_GRANULARITY:
+            raise ValueError("chunk_size must be a multiple of %d" % RESUMABLE_CHUNK_GRANULARITY)
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                return self.upload_resumable(name, mime, f, idempotency_key, check_existing, session_path, chunk_size)
+
+        source.seek(0, 2)
+        size = source.tell()
+        started = time.monotonic()
+        offset = None
+        session_uri = _load_session(session_path, size)
+        if session_uri is not None:
+            offset, file_id = self._resumable_status(session_uri, size)
+            if file_id is not None:
+                _remove_session(session_path)
+                return file_id
+            if offset is not None:
+                log.info("drive: resuming upload of %s at byte %d of %d", name, offset, size)
+        if offset is None:
+            existing = self._existing(name, idempotency_key, check_existing)
+            if existing is not None:
+                return existing
+            session_uri = self._start_resumable(name, mime, size, idempotency_key)
+            _save_session(session_path, session_uri, size)
+            offset = 0
+
+        resumed_at = offset
+        chunks = 0
+        while True:
+            source.seek(offset)
+            chunk = source.read(chunk_size)
+            last = offset + len(chunk) - 1
+            response = self._session.put(session_uri, data=chunk, allow_redirects=False, timeout=UPLOAD_TIMEOUT,
+                                         headers={"Content-Range": "bytes %d-%d/%d" % (offset, last, size)
+                                                  if chunk else "bytes */%d" % size})
+            chunks += 1
+            if response.status_code in (200, 201):
+                _remove_session(session_path)
+                elapsed = time.monotonic() - started
+                log.info("drive: uploaded %s, %d bytes in %d chunks of up to %d bytes (resumed at %d), %.1f kB/s",
+                         name, size, chunks, chunk_size, resumed_at, (size - resumed_at) / 1024 / max(elapsed, 1e-6))
+                return response.json().get("id")
+            if response.status_code == 308:
+                committed = _committed(response)
+                if committed <= offset and (chunk or committed < size):
+                    raise UploadError("drive resumable upload of %s made no progress at byte %d" % (name, offset))
+                offset = committed
+                continue
+            if response.status_code in (404, 410):
+                # The session expired; the next attempt starts a new one.
+                _remove_session(session_path)
+            raise UploadError("drive resumable upload of %s at byte %d: HTTP %d" % (name, offset, response.status_code))
+
+    def _start_resumable(self, name: str, mime: str, size: int, idempotency_key: Optional[str]) -> str:
+        response = self._session.post("%s/upload/drive/v2/files" % self._base_url,
+                                      params={"uploadType": "resumable", "fields": "id"},
+                                      headers={"X-Upload-Content-Type": mime, "X-Upload-Content-Length": str(size)},
+                                      json=self._metadata(name, idempotency_key), timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200 or "Location" not in response.headers:
+            raise UploadError("drive resumable upload of %s: HTTP %d starting session" % (name, response.status_code))
+        return response.headers["Location"]
+
+    def _resumable_status(self, session_uri: str, size: int):
+        """Returns (committed offset, None), (None, file id) when finished, or (None, None) if the session is gone."""
+        response = self._session.put(session_uri, data=b"", allow_redirects=False, timeout=UPLOAD_TIMEOUT,
+                                     headers={"Content-Range": "bytes */%d" % size})
+        if response.status_code == 308:
+            return _committed(response), None
+        if response.status_code in (200, 201):
+            return None, response.json().get("id")
+        if response.status_code in (404, 410):
+            return None, None
+        raise UploadError("drive resumable status: HTTP %d" % response.status_code)
+
+
+def _committed(response) -> int:
+    """Next byte to send, from the Range header of a 308 Resume Incomplete response."""
+    committed = response.headers.get("Range")
+    if not committed:
+        return 0
+    return int(committed.rsplit("-", 1)[1]) + 1
+
+
+def _load_session(session_path: Optional[str], size: int) -> Optional[str]:
+    if session_path is None or not os.path.exists(session_path):
+        return None
+    try:
+        with open(session_path) as f:
+            state = json.load(f)
+    except ValueError:
+        return None
+    return state["uri"] if state.get("size") == size else None
+
+
+def _save_session(session_path: Optional[str], uri: str, size: int) -> None:
+    if session_path is None:
+        return
+    partial = session_path + ".partial"
+    with open(partial, "w") as f:
+        json.dump({"uri": uri, "size": size}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, session_path)
+
+
+def _remove_session(session_path: Optional[str]) -> None:
+    if session_path is not None and os.path.exists(session_path):
+        os.remove(session_path)
+
+
+def drive_credentials(google_credentials_json):
+    """Service account credentials from a parsed key, or from its JSON text, base64-encoded or not."""
+    from google.oauth2 import service_account  # type: ignore
+
+    if isinstance(google_credentials_json, (str, bytes)):
+        text = google_credentials_json.strip()
+        if not text.startswith("{" if isinstance(text, str) else b"{"):
+            text = b64decode(text)
+        google_credentials_json = json.loads(text)
+    return service_account.Credentials.from_service_account_info(google_credentials_json, scopes=GOOGLE_SCOPES)